@@ -0,0 +1,397 @@
+# Copyright 2015, Kevin Carter.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Example Usage:
+>>> import asyncio
+>>> from cloudlib import async_http
+>>> async def main():
+...     async with async_http.AsyncMakeRequest() as make_req:
+...         return await make_req.get('https://api.github.com/orgs/openstack')
+>>> get_req = asyncio.get_event_loop().run_until_complete(main())
+
+This module requires python 3.5+ and the optional ``aiohttp`` package.
+"""
+
+import asyncio
+import ssl
+import threading
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import requests
+
+from cloudlib import http
+from cloudlib import logger
+from cloudlib import utils
+
+
+def _aiohttp_kwargs(kwargs):
+    """Return ``requests`` keyword arguments as ``aiohttp`` ones.
+
+    ``timeout`` becomes an ``aiohttp.ClientTimeout``, a ``(connect, read)``
+    tuple included, and ``verify`` becomes ``ssl``. ``stream`` is dropped,
+    as response bodies are always read.
+
+    :param kwargs: ``dict``
+    :return: ``dict``
+    """
+    _kwargs = dict(kwargs or {})
+    _kwargs.pop('stream', None)
+    timeout = _kwargs.get('timeout')
+    if isinstance(timeout, tuple):
+        _kwargs['timeout'] = aiohttp.ClientTimeout(
+            sock_connect=timeout[0], sock_read=timeout[1]
+        )
+    elif isinstance(timeout, (int, float)):
+        _kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+
+    if 'verify' in _kwargs:
+        verify = _kwargs.pop('verify')
+        if verify is False:
+            _kwargs['ssl'] = False
+        elif isinstance(verify, str):
+            _kwargs['ssl'] = ssl.create_default_context(cafile=verify)
+    return _kwargs
+
+
+class AsyncMakeRequest(object):
+
+    def __init__(self, config=None, log_name=__name__):
+        """Make an HTTP request from within an asyncio event loop.
+
+        This is the asyncio counterpart of ``http.MakeRequest``. All requests
+        made by an instance share one connection pool and the number of
+        requests in flight is bounded by a semaphore. Responses are returned
+        as ``aiohttp.ClientResponse`` objects with the body already read.
+
+        The ``config`` keys ``timeout``, ``headers`` and ``pool_maxsize`` are
+        used the same way ``http.MakeRequest`` uses them. In addition:
+
+            * ``concurrency`` maximum requests in flight, default 100.
+
+        :param config: ``dict``
+        :param log_name: ``str`` This is used to log against an existing log
+                                 handler.
+        """
+        if aiohttp is None:
+            raise ImportError(
+                'The "aiohttp" package is required to use AsyncMakeRequest.'
+            )
+
+        self.config = config
+        if self.config is None:
+            self.config = {}
+
+        self.log = logger.getLogger(log_name)
+        self.request_kwargs = {'timeout': self.config.get('timeout', 60)}
+        self.headers = {
+            'User-Agent': 'cloudlib'
+        }
+
+        if 'headers' in self.config:
+            self.headers.update(self.config.get('headers'))
+
+        self.concurrency = self.config.get('concurrency', 100)
+        self.pool_maxsize = self.config.get('pool_maxsize', 10)
+        self._session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        """Close the session and every pooled connection."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        """Return the shared session, creating it within the running loop.
+
+        :return: ``object``
+        """
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.concurrency,
+                limit_per_host=self.pool_maxsize
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    def _report_error(self, request, exp):
+        """When making the request, if an error happens, log it."""
+        message = (
+            "Failure to perform %s due to [ %s ]" % (request, exp)
+        )
+        self.log.fatal(message)
+        raise requests.RequestException(message)
+
+    async def _request(self, method, url, headers=None, body=None,
+                       kwargs=None):
+        """Make a request.
+
+        To make a request pass the ``method`` and the ``url``. Valid methods
+        are, ``['post', 'put', 'get', 'delete', 'patch', 'options', 'head']``.
+
+        :param url: ``str``
+        :param headers: ``dict``
+        :param body: ``object``
+        :param kwargs: ``dict``
+        """
+        _kwargs = _aiohttp_kwargs(
+            utils.dict_update(self.request_kwargs.copy(), kwargs)
+        )
+        _headers = utils.dict_update(self.headers.copy(), headers)
+        _url = http.MakeRequest._get_url(url=url)
+
+        session = self._get_session()
+        try:
+            func = getattr(session, method.lower())
+        except AttributeError as exp:
+            self._report_error(request=method.upper(), exp=exp)
+
+        async with self._semaphore:
+            if body is None:
+                resp = await func(_url, headers=_headers, **_kwargs)
+            else:
+                resp = await func(
+                    _url, data=body, headers=_headers, **_kwargs
+                )
+            # Read the body so the connection is released back to the pool.
+            await resp.read()
+
+        self.log.debug('%s %s %s', resp.status, resp.reason, resp.url)
+        return resp
+
+    async def post(self, url, headers=None, body=None, kwargs=None):
+        """Make a POST request.
+
+        To make a POST request pass, ``url``
+
+        :param url: ``str``
+        :param headers: ``dict``
+        :param body: ``object``
+        :param kwargs: ``dict``
+        """
+        return await self._request(
+            method='post',
+            url=url,
+            headers=headers,
+            body=body,
+            kwargs=kwargs
+        )
+
+    async def head(self, url, headers=None, kwargs=None):
+        """Make a HEAD request.
+
+        To make a HEAD request pass, ``url``
+
+        :param url: ``str``
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        """
+        return await self._request(
+            method='head',
+            url=url,
+            headers=headers,
+            kwargs=kwargs
+        )
+
+    async def patch(self, url, headers=None, body=None, kwargs=None):
+        """Make a PATCH request.
+
+        To make a PATCH request pass, ``url``
+
+        :param url: ``str``
+        :param headers: ``dict``
+        :param body: ``object``
+        :param kwargs: ``dict``
+        """
+        return await self._request(
+            method='patch',
+            url=url,
+            headers=headers,
+            body=body,
+            kwargs=kwargs
+        )
+
+    async def put(self, url, headers=None, body=None, kwargs=None):
+        """Make a PUT request.
+
+        To make a PUT request pass, ``url``
+
+        :param url: ``str``
+        :param headers: ``dict``
+        :param body: ``object``
+        :param kwargs: ``dict``
+        """
+        return await self._request(
+            method='put',
+            url=url,
+            headers=headers,
+            body=body,
+            kwargs=kwargs
+        )
+
+    async def delete(self, url, headers=None, kwargs=None):
+        """Make a DELETE request.
+
+        To make a DELETE request pass, ``url``
+
+        :param url: ``str``
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        """
+        return await self._request(
+            method='delete',
+            url=url,
+            headers=headers,
+            kwargs=kwargs
+        )
+
+    async def get(self, url, headers=None, kwargs=None):
+        """Make a GET request.
+
+        To make a GET request pass, ``url``
+
+        :param url: ``str``
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        """
+        return await self._request(
+            method='get',
+            url=url,
+            headers=headers,
+            kwargs=kwargs
+        )
+
+    async def option(self, url, headers=None, kwargs=None):
+        """Make a OPTION request.
+
+        To make a OPTION request pass, ``url``
+
+        :param url: ``str``
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        """
+        return await self._request(
+            method='options',
+            url=url,
+            headers=headers,
+            kwargs=kwargs
+        )
+
+
+class AsyncTransport(http.Transport):
+
+    def __init__(self, concurrency=100, limit_per_host=10):
+        """Transport sending requests through aiohttp on an event loop.
+
+        The event loop runs on a background thread, so ``http.MakeRequest``
+        can share one asyncio connection pool between its threads. Use it
+        with ``http.MakeRequest(config={'transport': AsyncTransport()})``.
+        Streamed request bodies and every response body are read into
+        memory.
+
+        :param concurrency: ``int`` Maximum connections.
+        :param limit_per_host: ``int`` Maximum connections to one host.
+        """
+        if aiohttp is None:
+            raise ImportError(
+                'The "aiohttp" package is required to use AsyncTransport.'
+            )
+
+        self.concurrency = concurrency
+        self.limit_per_host = limit_per_host
+        self._session = None
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self.loop.run_forever, name='cloudlib-async-transport'
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _get_session(self):
+        """Return the shared session, creating it within the event loop.
+
+        :return: ``object``
+        """
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.concurrency,
+                limit_per_host=self.limit_per_host
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def _request(self, method, url, headers, data, kwargs):
+        session = self._get_session()
+        async with session.request(
+                method, url, headers=headers, data=data, **kwargs) as resp:
+            body = await resp.read()
+            return http.build_response(
+                method=method,
+                url=str(resp.url),
+                status=resp.status,
+                headers=resp.headers,
+                body=body,
+                reason=resp.reason,
+                request_headers=headers,
+                request_body=data
+            )
+
+    def request(self, method, url, headers=None, data=None, **kwargs):
+        kwargs = _aiohttp_kwargs(kwargs)
+        if isinstance(data, http.StreamBody):
+            data = b''.join(data)
+        elif data is not None and not isinstance(data, (bytes, str, dict)):
+            data = b''.join(http.StreamBody(source=data, md5=False))
+
+        future = asyncio.run_coroutine_threadsafe(
+            self._request(
+                method=method.upper(),
+                url=url,
+                headers=headers,
+                data=data,
+                kwargs=kwargs
+            ),
+            self.loop
+        )
+        try:
+            return future.result()
+        except asyncio.TimeoutError as exp:
+            raise requests.Timeout(exp)
+        except aiohttp.ClientError as exp:
+            raise requests.ConnectionError(exp)
+
+    def close(self):
+        """Close the session and stop the event loop."""
+        if self.loop.is_closed():
+            return
+
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(
+                self._session.close(), self.loop
+            ).result()
+            self._session = None
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
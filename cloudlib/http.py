@@ -18,8 +18,27 @@
 >>> get_req = make_req.get('https://api.github.com/orgs/openstack')
 """
 
+import bisect
+import codecs
+import collections
+import contextlib
+import copy
+from email import utils as email_utils
+import functools
+import hashlib
+import io
+import itertools
+import json
+import os
+import random
+import socket
+import ssl
 import sys
+import tempfile
+import threading
+import time
 import urllib
+import zlib
 
 
 # Added for python3 support
@@ -28,14 +47,53 @@ try:
 except ImportError:
     import http.client as httplib
 
+# Added for python2 support, provided by the "futures" backport
+from concurrent import futures
+
 # Added for python3 support
 try:
     import urlparse
 except ImportError:
     import urllib.parse as urlparse
 
+# Optional compression codecs
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Optional JSON codec
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# File locking is only available on POSIX systems
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 import requests
+from requests import adapters
+from requests import structures
+from requests import utils as requests_utils
+from urllib3 import connection as urllib3_connection
+from urllib3 import connectionpool
+from urllib3 import exceptions as urllib3_exceptions
+from urllib3.util import connection as urllib3_util_connection
+from urllib3.util import request as urllib3_util_request
+from urllib3.util import retry as urllib3_util_retry
+from urllib3.util import ssl_ as urllib3_util_ssl
+from urllib3.util import timeout as urllib3_util_timeout
+from urllib3.util import wait as urllib3_util_wait
 
+import cloudlib
 from cloudlib import logger
 from cloudlib import utils
 
@@ -67,90 +125,4586 @@ def html_encode(path):
         return urllib.quote(utils.ensure_string(path))
 
 
-class MakeRequest(object):
+def update_query(url, params):
+    """Return a URL with its query string updated from ``params``.
 
-    def __init__(self, config=None, log_name=__name__):
-        """Make an HTTP request.
+    Parameters whose value is None are left out.
 
-        This class allows you to create custom request args and or enable
-        debug mode.
+    :param url: ``str``
+    :param params: ``dict``
+    :return: ``str``
+    """
+    parsed = urlparse.urlparse(url)
+    query = [
+        i for i in urlparse.parse_qsl(parsed.query, keep_blank_values=True)
+        if i[0] not in params
+    ]
+    for key, value in sorted(params.items()):
+        if value is not None:
+            query.append((key, utils.ensure_string(value)))
 
-        Presently the ``config`` argument would only be used to enable
-        debug.
+    if sys.version_info > (3, 2, 0):
+        query = urllib.parse.urlencode(query)
+    else:
+        query = urllib.urlencode(query)
+    return urlparse.urlunparse(parsed._replace(query=query))
 
-        :param config: ``dict``
-        :param log_name: ``str`` This is used to log against an existing log
-                                 handler.
+
+def replace_file(src, dst):
+    """Move a file over another, replacing it.
+
+    ``os.rename`` fails on Windows when ``dst`` exists, ``os.replace`` is
+    used where it is available.
+
+    :param src: ``str``
+    :param dst: ``str``
+    """
+    getattr(os, 'replace', os.rename)(src, dst)
+
+
+NDJSON_TYPES = [
+    'application/json-seq',
+    'application/jsonl',
+    'application/jsonlines',
+    'application/x-jsonlines',
+    'application/x-ndjson'
+]
+
+# Whitespace between JSON values, with the record separator of json-seq.
+JSON_WHITESPACE = ' \t\n\r\x1e'
+
+
+def iter_json(resp, chunk_size=65536, ndjson=None):
+    """Iterate over the values of a streamed JSON response.
+
+    The elements of a top level JSON array, or each value of an NDJSON
+    stream, are decoded and yielded as the body is read, so only one value
+    and one chunk are held in memory. Make the request with
+    ``kwargs={'stream': True}``; the response is closed when iteration
+    stops.
+
+    :param resp: ``object``
+    :param chunk_size: ``int``
+    :param ndjson: ``bol`` Read the body as NDJSON. By default this is
+                           found from the Content-Type, falling back to
+                           reading an array when the body starts with ``[``.
+    :return: ``object`` generator
+    """
+    if ndjson is None:
+        content_type = resp.headers.get('Content-Type', '')
+        if content_type.split(';')[0].strip().lower() in NDJSON_TYPES:
+            array = False
+        else:
+            array = None
+    else:
+        array = not ndjson
+
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder(
+        getattr(resp, 'encoding', None) or 'utf-8'
+    )()
+    chunks = resp.iter_content(chunk_size=chunk_size)
+
+    buf = ''
+    pos = 0
+    eof = False
+    more = False
+    # Characters to buffer before decoding again. A value cut short by the
+    # end of the buffer is only decoded again once the buffer has doubled,
+    # so large values are decoded a few times rather than once per chunk.
+    need = 0
+    # None until the first array element, then False after each element.
+    expect_value = None
+    closed = False
+    try:
+        while True:
+            while pos < len(buf) and buf[pos] in JSON_WHITESPACE:
+                pos += 1
+
+            if more or pos == len(buf):
+                if eof:
+                    break
+                pending = [buf[pos:]]
+                size = len(pending[0])
+                while not eof:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        eof = True
+                        chunk = text.decode(b'', True)
+                    else:
+                        chunk = text.decode(chunk)
+                    pending.append(chunk)
+                    size += len(chunk)
+                    if size >= need:
+                        break
+                buf = ''.join(pending)
+                pos = 0
+                more = False
+                need = 0
+                continue
+
+            char = buf[pos]
+            if array is None:
+                array = char == '['
+                if array:
+                    pos += 1
+                    continue
+
+            if array:
+                if char == ']' and not expect_value:
+                    closed = True
+                    break
+                elif expect_value is False:
+                    if char != ',':
+                        raise ValueError(
+                            'Expecting "," or "]" in JSON array, found'
+                            ' [ %s ]' % char
+                        )
+                    expect_value = True
+                    pos += 1
+                    continue
+
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                more = True
+                need = 2 * (len(buf) - pos)
+                continue
+
+            # A number at the end of the buffer, or one followed by number
+            # characters, may have been cut short by a chunk boundary.
+            cut = end == len(buf)
+            if not cut and isinstance(value, (int, float)):
+                cut = buf[end] in '+-.0123456789Ee'
+            if cut and not eof:
+                more = True
+                continue
+
+            yield value
+            pos = end
+            expect_value = not array
+
+        if array and not closed:
+            raise ValueError('Unterminated JSON array')
+    finally:
+        resp.close()
+
+
+RESUME_SUFFIX = '.resume'
+
+TRACE_METRICS = ['dns', 'connect', 'tls', 'ttfb', 'transfer', 'total']
+
+TRACE_BUCKETS = [
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+    30, 60
+]
+
+# Per thread state of the request being sent. Requests are sent
+# synchronously so connections opened while sending a request are opened on
+# the same thread, which lets the connection classes find the trace record
+# of the request they belong to.
+_local = threading.local()
+
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+RETRY_METHODS = ['delete', 'get', 'head', 'option', 'options', 'put']
+
+
+def retry_after_seconds(resp):
+    """Return the seconds a response asks the client to wait, or None.
+
+    :param resp: ``object``
+    :return: ``int`` || ``None``
+    """
+    retry_after = resp.headers.get('Retry-After')
+    if not retry_after:
+        return None
+
+    seconds = utils.is_int(retry_after)
+    if not isinstance(seconds, int):
+        date = email_utils.parsedate_tz(retry_after)
+        if date is None:
+            return None
+        seconds = email_utils.mktime_tz(date) - time.time()
+    return max(seconds, 0)
+
+
+class TokenBucket(object):
+    """Thread safe token bucket.
+
+    Tokens are added at ``rate`` per second up to ``burst`` and every request
+    takes one, waiting when the bucket is empty. The rate is halved when the
+    server asks the client to back off and recovers as requests succeed.
+    """
+
+    def __init__(self, rate, burst=None):
+        """Create the bucket.
+
+        :param rate: ``float`` Requests per second.
+        :param burst: ``int`` Most requests which may be made at once.
         """
+        self.base_rate = float(rate)
+        self.rate = self.base_rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+        self._blocked_until = 0
+        self._lock = threading.Lock()
 
-        self.config = config
-        if self.config is None:
-            self.config = {}
+    def acquire(self, tokens=1):
+        """Take tokens, waiting until they are available.
 
-        self.log = logger.getLogger(log_name)
-        self.request_kwargs = {'timeout': self.config.get('timeout', 60)}
-        self.headers = {
-            'User-Agent': 'cloudlib'
-        }
+        Taking more tokens than ``burst`` waits for a full bucket and leaves
+        it in debt, so later callers wait for the excess.
 
-        if isinstance(self.config, dict):
-            if 'headers'in self.config:
-                self.headers.update(self.config.get('headers'))
+        :param tokens: ``int``
+        """
+        needed = min(tokens, self.burst)
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(
+                    self.burst,
+                    self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if now >= self._blocked_until and self._tokens >= needed:
+                    self._tokens -= tokens
+                    return
+                wait = max(
+                    self._blocked_until - now,
+                    (needed - self._tokens) / self.rate
+                )
+            time.sleep(wait)
 
-            if self.config.get('debug', False):
-                httplib.HTTPConnection.debuglevel = 1
+    def penalize(self, seconds=None):
+        """Halve the rate and optionally block for ``seconds``.
+
+        :param seconds: ``int``
+        """
+        with self._lock:
+            self.rate = max(self.rate / 2, self.base_rate / 64)
+            if seconds:
+                self._blocked_until = max(
+                    self._blocked_until, time.time() + seconds
+                )
+                self._tokens = 0
+
+    def reward(self):
+        """Move the rate back towards the configured rate."""
+        if self.rate < self.base_rate:
+            with self._lock:
+                self.rate = min(
+                    self.base_rate, self.rate + self.base_rate / 20
+                )
+
+
+class RateLimiter(object):
+    """Client side rate limiter with global and per host token buckets."""
+
+    def __init__(self, rate=None, per_host=None, hosts=None, burst=None):
+        """Create the limiter.
+
+        :param rate: ``float`` Requests per second to all hosts.
+        :param per_host: ``float`` Requests per second to any one host.
+        :param hosts: ``dict`` Requests per second to specific hosts.
+        :param burst: ``int`` Most requests which may be made at once.
+        """
+        self.burst = burst
+        self.per_host = per_host
+        self.hosts = hosts or {}
+        self.global_bucket = None
+        if rate:
+            self.global_bucket = TokenBucket(rate=rate, burst=burst)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, host):
+        """Return the token bucket of a host or None.
+
+        :param host: ``str``
+        :return: ``object`` || ``None``
+        """
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            rate = self.hosts.get(host, self.per_host)
+            if not rate:
+                return None
+            with self._lock:
+                bucket = self._buckets.setdefault(
+                    host, TokenBucket(rate=rate, burst=self.burst)
+                )
+        return bucket
+
+    def acquire(self, host, tokens=1):
+        """Wait until a request to a host is allowed.
+
+        :param host: ``str``
+        :param tokens: ``int`` Tokens taken, more than one when the limiter
+                               counts bytes rather than requests.
+        """
+        bucket = self.bucket(host=host)
+        if bucket is not None:
+            bucket.acquire(tokens=tokens)
+        if self.global_bucket is not None:
+            self.global_bucket.acquire(tokens=tokens)
+
+    def update(self, host, resp):
+        """Adapt the rate of a host from a response.
+
+        ``429`` responses, and ``503`` responses carrying ``Retry-After``,
+        slow the host down, anything else lets it speed back up.
+
+        :param host: ``str``
+        :param resp: ``object``
+        """
+        bucket = self.bucket(host=host) or self.global_bucket
+        if bucket is None:
+            return
+
+        retry_after = retry_after_seconds(resp=resp)
+        if resp.status_code == 429 or (
+                resp.status_code == 503 and retry_after is not None):
+            bucket.penalize(seconds=retry_after)
+        else:
+            bucket.reward()
+
+
+class SingleFlight(object):
+    """Share one call among concurrent callers asking for the same thing.
+
+    The first caller of ``do`` for a key makes the call while later callers
+    with the same key wait for, and receive a copy of, its result. Results
+    which ``shareable`` rejects are not copied, every waiting caller makes
+    the call itself instead.
+    """
+
+    def __init__(self, shareable=None):
+        """Create the single flight group.
+
+        :param shareable: ``object`` Callable returning False for results
+                                     which may not be shared.
+        """
+        self.shareable = shareable
+        self.stats = {'calls': 0, 'shared': 0}
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, **kwargs):
+        """Return the result of ``func``, sharing it with identical callers.
+
+        :param key: ``object`` Identifies identical calls.
+        :param func: ``object`` Callable which makes the call.
+        :param kwargs: ``dict`` Keyword arguments for ``func``.
+        :return: ``object``
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'event': threading.Event(), 'result': None,
+                        'error': None, 'shared': True}
+                self._calls[key] = call
+                self.stats['calls'] += 1
+            else:
+                self.stats['shared'] += 1
+
+        if not leader:
+            call['event'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            elif not call['shared']:
+                return func(**kwargs)
+            return copy.copy(call['result'])
+
+        try:
+            call['result'] = func(**kwargs)
+            if self.shareable is not None:
+                call['shared'] = self.shareable(call['result'])
+        except Exception as exp:
+            call['error'] = exp
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call['event'].set()
+        return call['result']
+
+
+class CircuitOpen(requests.RequestException):
+    """Raised when a request is refused because a host's circuit is open."""
+    pass
+
+
+class CircuitBreaker(object):
+    """Per host circuit breaker.
+
+    After ``threshold`` consecutive failures the circuit for a host opens and
+    requests to it are refused. Once ``timeout`` seconds have passed a single
+    trial request is allowed through; success closes the circuit and failure
+    opens it again.
+    """
+
+    def __init__(self, threshold, timeout=30):
+        """Create the breaker.
+
+        :param threshold: ``int`` Consecutive failures which open a circuit.
+        :param timeout: ``int`` Seconds a circuit stays open.
+        """
+        self.threshold = threshold
+        self.timeout = timeout
+        self.stats = {'trips': 0, 'rejected': 0}
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def state(self, host):
+        """Return the state of a host's circuit.
+
+        :param host: ``str``
+        :return: ``str`` One of ``closed``, ``open`` or ``half-open``.
+        """
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or state['opened'] is None:
+                return 'closed'
+            elif time.time() - state['opened'] >= self.timeout:
+                return 'half-open'
+            else:
+                return 'open'
+
+    def allow(self, host):
+        """Return True if a request to a host may be made.
+
+        :param host: ``str``
+        :return: ``bol``
+        """
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or state['opened'] is None:
+                return True
+
+            elapsed = time.time() - state['opened']
+            if not state['trial'] and elapsed >= self.timeout:
+                state['trial'] = True
+                return True
+            else:
+                self.stats['rejected'] += 1
+                return False
+
+    def success(self, host):
+        """Record a successful request, closing the host's circuit.
+
+        :param host: ``str``
+        """
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def failure(self, host):
+        """Record a failed request, opening the circuit at the threshold.
+
+        :param host: ``str``
+        """
+        with self._lock:
+            state = self._hosts.setdefault(
+                host, {'failures': 0, 'opened': None, 'trial': False}
+            )
+            state['failures'] += 1
+            state['trial'] = False
+            if state['failures'] >= self.threshold:
+                if state['opened'] is None:
+                    self.stats['trips'] += 1
+                state['opened'] = time.time()
+
+
+class StreamBody(object):
+    """Request body streamed from a file object or an iterable.
+
+    The source is read ``chunk_size`` bytes at a time, or a chunk per item
+    for iterables, while an optional md5 sum of everything sent is kept.
+    When the length of the body is known, from ``length`` or the size of the
+    file, it is sent with a ``Content-Length`` header, otherwise it is sent
+    with chunked transfer encoding.
+    """
+
+    def __init__(self, source, chunk_size=65536, length=None, md5=True,
+                 throttle=None):
+        """Create the body.
+
+        :param source: ``object`` File object, iterator or generator.
+        :param chunk_size: ``int``
+        :param length: ``int`` Bytes which will be read from ``source``.
+        :param md5: ``bol`` Keep an md5 sum of the body.
+        :param throttle: ``object`` Callable given the size of every chunk
+                                    before it is sent.
+        """
+        self.source = source
+        self.chunk_size = chunk_size
+        self.throttle = throttle
+        self.bytes_sent = 0
+        self.md5 = None
+        if md5:
+            self.md5 = hashlib.md5()
+
+        if length is None and hasattr(source, 'read'):
+            length = self._file_length(source)
+        # ``requests`` reads the length of a streamed body from ``len``.
+        self.len = length
 
     @staticmethod
-    def _get_url(url):
-        """Returns a URL string.
+    def _file_length(source):
+        """Return the bytes left in a file object or None.
 
-        If the ``url`` parameter is a ParsedResult from `urlparse` the full url
-        will be unparsed and made into a string. Otherwise the ``url``
-        parameter is returned as is.
+        Text files are encoded as they are read, so their length in bytes
+        is not known.
 
-        :param url: ``str`` || ``object``
+        :param source: ``object``
+        :return: ``int`` || ``None``
         """
-        if isinstance(url, urlparse.ParseResult):
-            return urlparse.urlunparse(url)
+        if isinstance(source, io.TextIOBase):
+            return None
+
+        try:
+            position = source.tell()
+            try:
+                size = os.fstat(source.fileno()).st_size
+            except Exception:
+                source.seek(0, 2)
+                size = source.tell()
+                source.seek(position)
+            return max(size - position, 0)
+        except Exception:
+            return None
+
+    def _read_chunks(self):
+        """Yield chunks read from a file object until it is empty.
+
+        Text files return ``''`` rather than ``b''`` once empty.
+
+        :yield: ``bytes`` || ``str``
+        """
+        while True:
+            chunk = self.source.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def __iter__(self):
+        if hasattr(self.source, 'read'):
+            chunks = self._read_chunks()
         else:
-            return url
+            chunks = iter(self.source)
 
-    def _report_error(self, request, exp):
-        """When making the request, if an error happens, log it."""
-        message = (
-            "Failure to perform %s due to [ %s ]" % (request, exp)
-        )
-        self.log.fatal(message)
-        raise requests.RequestException(message)
+        for chunk in chunks:
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode('utf-8')
+            if not chunk:
+                continue
+            if self.throttle is not None:
+                self.throttle(len(chunk))
+            if self.md5 is not None:
+                self.md5.update(chunk)
+            self.bytes_sent += len(chunk)
+            yield chunk
 
-    def _request(self, method, url, headers=None, body=None, kwargs=None):
-        """Make a request.
+    def hexdigest(self):
+        """Return the md5 sum of the body sent so far.
 
-        To make a request pass the ``method`` and the ``url``. Valid methods
-        are, ``['post', 'put', 'get', 'delete', 'patch', 'option', 'head']``.
+        :return: ``str`` || ``None``
+        """
+        if self.md5 is not None:
+            return self.md5.hexdigest()
 
-        :param url: ``str``
-        :param headers: ``dict``
-        :param body: ``object``
-        :param kwargs: ``dict``
+
+class DNSCache(object):
+    """Cache of ``getaddrinfo`` results.
+
+    Successful lookups are kept for ``ttl`` seconds and failed lookups for
+    ``negative_ttl`` seconds, so repeated connections to the same hosts skip
+    the system resolver.
+    """
+
+    def __init__(self, ttl=300, negative_ttl=30, max_entries=1024):
+        """Create the cache.
+
+        :param ttl: ``int`` Seconds a lookup is kept.
+        :param negative_ttl: ``int`` Seconds a failed lookup is kept.
+        :param max_entries: ``int``
         """
-        _kwargs = utils.dict_update(self.request_kwargs.copy(), kwargs)
-        _headers = utils.dict_update(self.headers.copy(), headers)
-        _url = self._get_url(url=url)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.stats = {'hits': 0, 'misses': 0, 'negative_hits': 0}
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _store(self, key, expires, result):
+        """Store a lookup result, dropping the oldest when full.
+
+        :param key: ``tuple``
+        :param expires: ``float``
+        :param result: ``list`` || ``tuple`` Addresses or error arguments.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, result)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def resolve(self, host, port, family=0, socktype=0):
+        """Return ``getaddrinfo`` results for a host, using the cache.
+
+        :param host: ``str``
+        :param port: ``int``
+        :param family: ``int``
+        :param socktype: ``int``
+        :return: ``list``
+        """
+        key = (host, port, family, socktype)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.time():
+            if isinstance(entry[1], tuple):
+                self.stats['negative_hits'] += 1
+                raise socket.gaierror(*entry[1])
+            self.stats['hits'] += 1
+            return entry[1]
+
+        self.stats['misses'] += 1
+        try:
+            result = socket.getaddrinfo(host, port, family, socktype)
+        except socket.gaierror as exp:
+            if self.negative_ttl:
+                self._store(
+                    key, time.time() + self.negative_ttl, exp.args
+                )
+            raise
+        else:
+            self._store(key, time.time() + self.ttl, result)
+            return result
+
+    def clear(self):
+        """Discard every cached lookup."""
+        with self._lock:
+            self._entries.clear()
+
+
+def create_connection(address, timeout=None, source_address=None,
+                      socket_options=None, trace=None, resolver=None):
+    """Return a connected socket, recording DNS and connect times.
+
+    This follows ``urllib3.util.connection.create_connection``, trying every
+    address the host resolves to in turn.
+
+    :param address: ``tuple`` Host and port.
+    :param timeout: ``float``
+    :param source_address: ``tuple``
+    :param socket_options: ``list``
+    :param trace: ``dict`` Trace record updated with the times taken.
+    :param resolver: ``object`` Callable used in place of ``getaddrinfo``.
+    :return: ``object``
+    """
+    host, port = address
+    if host.startswith('['):
+        host = host.strip('[]')
 
+    if resolver is None:
+        resolver = socket.getaddrinfo
+
+    start = time.time()
+    try:
+        addresses = resolver(
+            host,
+            port,
+            urllib3_util_connection.allowed_gai_family(),
+            socket.SOCK_STREAM
+        )
+    finally:
+        if trace is not None:
+            trace['dns'] += time.time() - start
+
+    error = None
+    for family, socktype, proto, _, sockaddr in addresses:
+        sock = None
+        start = time.time()
         try:
-            func = getattr(requests, method.lower())
-            if body is None:
-                resp = func(_url, headers=_headers, **_kwargs)
+            sock = socket.socket(family, socktype, proto)
+            for option in socket_options or []:
+                sock.setsockopt(*option)
+            if timeout is None or isinstance(timeout, (int, float)):
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except socket.error as exp:
+            error = exp
+            if sock is not None:
+                sock.close()
+        finally:
+            if trace is not None:
+                trace['connect'] += time.time() - start
+
+    if error is not None:
+        raise error
+    raise socket.error('getaddrinfo returns an empty list')
+
+
+class TLSSessionCache(object):
+    """TLS contexts and sessions shared by new connections.
+
+    New connections to a host resume the last TLS session made with it,
+    which skips most of the handshake. Connections with the same TLS
+    settings share one ``SSLContext``, which sessions can only be resumed
+    with, rather than loading the certificate store for each connection.
+    """
+
+    def __init__(self, max_entries=256):
+        """Create the cache.
+
+        :param max_entries: ``int`` Most hosts whose session is kept.
+        """
+        self.max_entries = max_entries
+        self.stats = {'resumed': 0, 'full': 0}
+        self._contexts = {}
+        self._sessions = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def context(self, conn):
+        """Return the shared ``SSLContext`` for the settings of a connection.
+
+        :param conn: ``object`` urllib3 HTTPS connection.
+        :return: ``object``
+        """
+        settings = [
+            'cert_reqs', 'ssl_version', 'ssl_minimum_version',
+            'ssl_maximum_version', 'ca_certs', 'ca_cert_dir', 'ca_cert_data',
+            'cert_file', 'key_file'
+        ]
+        key = tuple([getattr(conn, i, None) for i in settings])
+        with self._lock:
+            context = self._contexts.get(key)
+            if context is None:
+                context = urllib3_util_ssl.create_urllib3_context(
+                    ssl_version=urllib3_util_ssl.resolve_ssl_version(
+                        getattr(conn, 'ssl_version', None)
+                    ),
+                    cert_reqs=urllib3_util_ssl.resolve_cert_reqs(
+                        getattr(conn, 'cert_reqs', None)
+                    )
+                )
+                if not any(key[4:7]):
+                    context.load_default_certs()
+                self._contexts[key] = context
+        return context
+
+    def get(self, host, port, context):
+        """Return the session to resume for a host or None.
+
+        :param host: ``str``
+        :param port: ``int``
+        :param context: ``object`` SSLContext the session must come from.
+        :return: ``object`` || ``None``
+        """
+        with self._lock:
+            entry = self._sessions.get((host, port))
+        if entry is not None and entry[0] is context:
+            return entry[1]
+
+    def save(self, host, port, sock):
+        """Keep the session of a connected socket.
+
+        :param host: ``str``
+        :param port: ``int``
+        :param sock: ``object``
+        """
+        session = getattr(sock, 'session', None)
+        if session is None:
+            return
+
+        with self._lock:
+            self._sessions.pop((host, port), None)
+            self._sessions[(host, port)] = (sock.context, session)
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+
+    def record(self, sock):
+        """Count whether a handshake resumed a session.
+
+        :param sock: ``object``
+        """
+        with self._lock:
+            if getattr(sock, 'session_reused', False):
+                self.stats['resumed'] += 1
             else:
-                resp = func(_url, data=body, headers=_headers, **_kwargs)
-            self.log.debug(
-                '%s %s %s', resp.status_code, resp.reason, resp.request
+                self.stats['full'] += 1
+
+
+class ResumingContext(object):
+    """``SSLContext`` proxy resuming the cached TLS session of a host."""
+
+    def __init__(self, context, sessions, host, port):
+        """Create the proxy.
+
+        :param context: ``object`` Shared SSLContext.
+        :param sessions: ``object`` TLSSessionCache.
+        :param host: ``str``
+        :param port: ``int``
+        """
+        self.__dict__.update(
+            {
+                '_context': context,
+                '_sessions': sessions,
+                '_host': host,
+                '_port': port
+            }
+        )
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._context, name, value)
+
+    def wrap_socket(self, sock, **kwargs):
+        session = self._sessions.get(
+            host=self._host, port=self._port, context=self._context
+        )
+        if session is not None:
+            kwargs['session'] = session
+        sock = self._context.wrap_socket(sock, **kwargs)
+        self._sessions.record(sock=sock)
+        return sock
+
+
+class TracedConnectionMixin(object):
+    """Open connections with ``create_connection``.
+
+    This is done while a request is traced or uses a DNS cache, otherwise
+    connections are opened by ``urllib3``.
+    """
+
+    def _new_conn(self):
+        trace = getattr(_local, 'trace', None)
+        dns_cache = getattr(_local, 'dns_cache', None)
+        if trace is None and dns_cache is None:
+            return super(TracedConnectionMixin, self)._new_conn()
+
+        resolver = None
+        if dns_cache is not None:
+            resolver = dns_cache.resolve
+
+        try:
+            return create_connection(
+                (self._dns_host, self.port),
+                self.timeout,
+                source_address=self.source_address,
+                socket_options=self.socket_options,
+                trace=trace,
+                resolver=resolver
             )
-        except AttributeError as exp:
-            self._report_error(request=method.upper(), exp=exp)
+        except socket.timeout:
+            raise urllib3_exceptions.ConnectTimeoutError(
+                self,
+                'Connection to %s timed out. (connect timeout=%s)' % (
+                    self.host, self.timeout
+                )
+            )
+        except socket.error as exp:
+            raise urllib3_exceptions.NewConnectionError(
+                self, 'Failed to establish a new connection: %s' % exp
+            )
+
+
+class TracedHTTPConnection(TracedConnectionMixin,
+                           urllib3_connection.HTTPConnection):
+    pass
+
+
+class TracedHTTPSConnection(TracedConnectionMixin,
+                            urllib3_connection.HTTPSConnection):
+
+    def connect(self):
+        """Connect, recording the time spent on the TLS handshake."""
+        tls_sessions = getattr(_local, 'tls_sessions', None)
+        if tls_sessions is not None and self.ssl_context is None:
+            self.ssl_context = ResumingContext(
+                context=tls_sessions.context(conn=self),
+                sessions=tls_sessions,
+                host=self.host,
+                port=self.port
+            )
+
+        trace = getattr(_local, 'trace', None)
+        if trace is None:
+            super(TracedHTTPSConnection, self).connect()
         else:
-            return resp
+            start = time.time()
+            opened = trace['dns'] + trace['connect']
+            try:
+                super(TracedHTTPSConnection, self).connect()
+            finally:
+                opened = trace['dns'] + trace['connect'] - opened
+                trace['tls'] += max(time.time() - start - opened, 0)
+
+        if tls_sessions is not None:
+            tls_sessions.save(host=self.host, port=self.port, sock=self.sock)
+
+    def read_tickets(self, wait):
+        """Read TLS 1.3 session tickets sent after the handshake.
+
+        TLS 1.3 servers send tickets once the handshake is done and they
+        are only read with a response. An idle connection holding unread
+        tickets looks dropped to the pool, which throws it away, and its
+        session can not be resumed, so warmed connections read them here.
+
+        :param wait: ``float`` Seconds to wait for tickets.
+        """
+        sock = self.sock
+        if sock is None or getattr(sock, 'version', lambda: None)() != (
+                'TLSv1.3'):
+            return
+
+        end = time.time() + wait
+        previous = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            while urllib3_util_wait.wait_for_read(
+                    sock, timeout=max(end - time.time(), 0)):
+                try:
+                    data = sock.recv(1)
+                except ssl.SSLWantReadError:
+                    continue
+                if data:
+                    raise IOError('Unexpected data from an idle connection')
+                break
+        finally:
+            sock.settimeout(previous)
+
+        tls_sessions = getattr(_local, 'tls_sessions', None)
+        if tls_sessions is not None:
+            tls_sessions.save(host=self.host, port=self.port, sock=sock)
+
+    def getresponse(self, *args, **kwargs):
+        """Return the response, keeping the TLS session for resumption.
+
+        The session is kept again once the response has arrived as TLS 1.3
+        servers only send session tickets after the handshake. The socket
+        is taken first as the connection lets go of it when the response
+        closes the connection.
+        """
+        sock = self.sock
+        resp = super(TracedHTTPSConnection, self).getresponse(*args, **kwargs)
+        tls_sessions = getattr(_local, 'tls_sessions', None)
+        if tls_sessions is not None and sock is not None:
+            tls_sessions.save(host=self.host, port=self.port, sock=sock)
+        return resp
+
+
+class TracedHTTPConnectionPool(connectionpool.HTTPConnectionPool):
+    ConnectionCls = TracedHTTPConnection
+
+
+class TracedHTTPSConnectionPool(connectionpool.HTTPSConnectionPool):
+    ConnectionCls = TracedHTTPSConnection
+
+
+class LatencyWindow(object):
+    """Recent request latencies of each host.
+
+    Only the last ``size`` latencies of a host are kept, so percentiles
+    follow changes in how a host performs.
+    """
+
+    def __init__(self, size=100, min_samples=20):
+        """Create the window.
+
+        :param size: ``int`` Latencies kept per host.
+        :param min_samples: ``int`` Latencies needed for a percentile.
+        """
+        self.size = size
+        self.min_samples = min_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, host, seconds):
+        """Record the latency of a request.
+
+        :param host: ``str``
+        :param seconds: ``float``
+        """
+        with self._lock:
+            samples = self._samples.get(host)
+            if samples is None:
+                samples = self._samples[host] = collections.deque(
+                    maxlen=self.size
+                )
+            samples.append(seconds)
+
+    def percentile(self, host, percent):
+        """Return a percentile of the recent latencies of a host.
+
+        :param host: ``str``
+        :param percent: ``float``
+        :return: ``float`` || ``None`` None until ``min_samples`` are kept.
+        """
+        with self._lock:
+            samples = sorted(self._samples.get(host) or [])
+        if not samples or len(samples) < self.min_samples:
+            return None
+        index = int(round(percent / 100.0 * (len(samples) - 1)))
+        return samples[min(max(index, 0), len(samples) - 1)]
+
+
+class Histogram(object):
+    """Histogram of observed values over fixed buckets."""
+
+    def __init__(self, buckets=None):
+        """Create the histogram.
+
+        :param buckets: ``list`` Sorted upper bounds of the buckets.
+        """
+        self.buckets = buckets or TRACE_BUCKETS
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        """Add a value to the histogram.
+
+        :param value: ``float``
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        """Return a ``dict`` of the histogram.
+
+        :return: ``dict``
+        """
+        return {
+            'buckets': list(zip(self.buckets + ['+Inf'], self.counts)),
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max
+        }
+
+
+class RequestMetrics(object):
+    """Per host and method histograms of request timings.
+
+    Every request produces a trace record holding the seconds spent on
+    ``dns``, ``connect`` and ``tls`` while opening a connection, if one was
+    opened, the time to the first byte of the response, ``ttfb``, the time
+    reading the body, ``transfer``, the ``total`` time and the bytes sent and
+    received. Records are aggregated into histograms and, when a callback is
+    given, passed to it.
+    """
+
+    def __init__(self, buckets=None, callback=None):
+        """Create the metrics.
+
+        :param buckets: ``list`` Sorted upper bounds of histogram buckets.
+        :param callback: ``object`` Callable receiving every trace record.
+        """
+        self.buckets = buckets
+        self.callback = callback
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def trace(method, url):
+        """Return a new trace record.
+
+        :param method: ``str``
+        :param url: ``str``
+        :return: ``dict``
+        """
+        trace = {
+            'method': method.upper(),
+            'url': url,
+            'host': urlparse.urlparse(url).netloc,
+            'status': None,
+            'error': None,
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'start': time.time()
+        }
+        for metric in TRACE_METRICS:
+            trace[metric] = 0.0
+        return trace
+
+    def record(self, trace):
+        """Aggregate a finished trace record.
+
+        :param trace: ``dict``
+        """
+        key = (trace['host'], trace['method'])
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = {
+                    'requests': 0,
+                    'errors': 0,
+                    'bytes_in': 0,
+                    'bytes_out': 0
+                }
+                for metric in TRACE_METRICS:
+                    stats[metric] = Histogram(buckets=self.buckets)
+
+            stats['requests'] += 1
+            if trace['error'] is not None:
+                stats['errors'] += 1
+            stats['bytes_in'] += trace['bytes_in']
+            stats['bytes_out'] += trace['bytes_out']
+            for metric in TRACE_METRICS:
+                stats[metric].observe(trace[metric])
+
+        if self.callback is not None:
+            self.callback(trace)
+
+    def snapshot(self):
+        """Return a ``dict`` of statistics keyed by host then method.
+
+        :return: ``dict``
+        """
+        snapshot = {}
+        with self._lock:
+            for (host, method), stats in self._stats.items():
+                item = snapshot.setdefault(host, {})[method] = {}
+                for key, value in stats.items():
+                    if isinstance(value, Histogram):
+                        item[key] = value.snapshot()
+                    else:
+                        item[key] = value
+        return snapshot
+
+    def reset(self):
+        """Discard every aggregated statistic."""
+        with self._lock:
+            self._stats = {}
+
+
+class Compressor(object):
+    """Incremental compressor for a ``Content-Encoding``.
+
+    ``gzip`` and ``deflate`` are always available, ``br`` needs the
+    ``brotli`` package and ``zstd`` the ``zstandard`` package.
+    """
+
+    def __init__(self, encoding, level=None):
+        """Create the compressor.
+
+        :param encoding: ``str`` One of ``gzip``, ``deflate``, ``br``, ``zstd``
+        :param level: ``int`` Compression level, default the codec default.
+        """
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self._obj = zlib.compressobj(
+                -1 if level is None else level, zlib.DEFLATED, 31
+            )
+        elif encoding == 'deflate':
+            self._obj = zlib.compressobj(-1 if level is None else level)
+        elif encoding == 'br' and brotli is not None:
+            self._obj = brotli.Compressor(
+                quality=5 if level is None else level
+            )
+        elif encoding == 'zstd' and zstandard is not None:
+            self._obj = zstandard.ZstdCompressor(
+                level=3 if level is None else level
+            ).compressobj()
+        else:
+            raise ValueError(
+                'Content encoding [ %s ] is not available' % encoding
+            )
+
+    @staticmethod
+    def available():
+        """Return the content encodings which can be used.
+
+        :return: ``list``
+        """
+        encodings = ['gzip', 'deflate']
+        if brotli is not None:
+            encodings.append('br')
+        if zstandard is not None:
+            encodings.append('zstd')
+        return encodings
+
+    def compress(self, data):
+        """Return compressed output for some data.
+
+        :param data: ``bytes``
+        :return: ``bytes``
+        """
+        if self.encoding == 'br':
+            return self._obj.process(data)
+        return self._obj.compress(data)
+
+    def flush(self):
+        """Return the remaining compressed output.
+
+        :return: ``bytes``
+        """
+        if self.encoding == 'br':
+            return self._obj.finish()
+        return self._obj.flush()
+
+
+def compress_body(body, encoding, level=None, chunk_size=65536):
+    """Return a request body compressed with a ``Content-Encoding``.
+
+    ``bytes`` and ``str`` bodies are compressed at once. File objects and
+    iterables are compressed as they are read and returned as a generator.
+
+    :param body: ``object``
+    :param encoding: ``str``
+    :param level: ``int``
+    :param chunk_size: ``int``
+    :return: ``bytes`` || ``object``
+    """
+    compressor = Compressor(encoding=encoding, level=level)
+    if isinstance(body, (bytes, str)):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        return compressor.compress(body) + compressor.flush()
+
+    if not isinstance(body, StreamBody):
+        body = StreamBody(source=body, chunk_size=chunk_size, md5=False)
+
+    def chunks():
+        for chunk in body:
+            chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+        yield compressor.flush()
+
+    return chunks()
+
+
+class JSONCodec(object):
+    """Encode and decode JSON with ``orjson`` when it is installed.
+
+    ``orjson`` is much faster than the standard library but is stricter,
+    for example about non-string object keys. Values it will not encode
+    are encoded with the standard library instead.
+    """
+
+    def __init__(self, name='auto'):
+        """Create the codec.
+
+        :param name: ``str`` One of ``auto``, ``orjson`` or ``json``.
+        """
+        if name == 'auto':
+            name = 'json' if orjson is None else 'orjson'
+
+        if name == 'orjson' and orjson is None:
+            raise ValueError('JSON codec [ orjson ] is not available')
+        elif name not in ('json', 'orjson'):
+            raise ValueError('JSON codec [ %s ] is not available' % name)
+        self.name = name
+
+    def dumps(self, obj):
+        """Return an object encoded as JSON.
+
+        :param obj: ``object``
+        :return: ``bytes``
+        """
+        if self.name == 'orjson':
+            try:
+                return orjson.dumps(obj)
+            except TypeError:
+                pass
+        return json.dumps(obj).encode('utf-8')
+
+    def loads(self, data):
+        """Return the object a JSON document holds.
+
+        :param data: ``bytes`` || ``str``
+        :return: ``object``
+        """
+        if self.name == 'orjson':
+            return orjson.loads(data)
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+
+def build_response(method, url, status, headers=None, body=b'', raw=None,
+                   reason=None, request_headers=None, request_body=None):
+    """Return a ``requests.Response`` made from the parts of a response.
+
+    Transports which do not use ``requests`` return responses made here, so
+    MakeRequest sees the same response type from every transport.
+
+    :param method: ``str``
+    :param url: ``str``
+    :param status: ``int``
+    :param headers: ``dict``
+    :param body: ``bytes`` Used when there is no ``raw`` response.
+    :param raw: ``object`` File like object the body is read from.
+    :param reason: ``str``
+    :param request_headers: ``dict``
+    :param request_body: ``object``
+    :return: ``object``
+    """
+    resp = requests.Response()
+    resp.status_code = status
+    resp.reason = reason or httplib.responses.get(status, '')
+    resp.headers = structures.CaseInsensitiveDict(headers or {})
+    resp.encoding = requests_utils.get_encoding_from_headers(resp.headers)
+    resp.url = url
+    if raw is None:
+        if not isinstance(body, bytes):
+            body = (body or '').encode('utf-8')
+        raw = io.BytesIO(body)
+    resp.raw = raw
+
+    request = requests.PreparedRequest()
+    request.method = method.upper()
+    request.url = url
+    request.headers = structures.CaseInsensitiveDict(request_headers or {})
+    request.body = request_body
+    resp.request = request
+    return resp
+
+
+class CompactResponse(object):
+    """Small response holding only the status, headers and body.
+
+    Unlike ``requests.Response`` it keeps no reference to the request, the
+    connection or the raw response, and has no instance ``__dict__``. The
+    body is kept as bytes and ``text`` and ``json`` decode it each time
+    they are used, so the body is never held twice.
+    """
+
+    __slots__ = ('status_code', 'reason', 'url', 'headers', 'content',
+                 'encoding')
+
+    def __init__(self, status_code, reason, url, headers, content,
+                 encoding=None):
+        """Create the response.
+
+        :param status_code: ``int``
+        :param reason: ``str``
+        :param url: ``str``
+        :param headers: ``object`` CaseInsensitiveDict.
+        :param content: ``bytes``
+        :param encoding: ``str``
+        """
+        self.status_code = status_code
+        self.reason = reason
+        self.url = url
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+
+    @classmethod
+    def from_response(cls, resp, headers=None):
+        """Return a compact copy of a response and close the response.
+
+        :param resp: ``object``
+        :param headers: ``list`` Names of the headers kept, default all.
+        :return: ``object``
+        """
+        if headers is None:
+            _headers = structures.CaseInsensitiveDict(resp.headers)
+        else:
+            _headers = structures.CaseInsensitiveDict()
+            for name in headers:
+                if name in resp.headers:
+                    _headers[name] = resp.headers[name]
+
+        compact = cls(
+            status_code=resp.status_code,
+            reason=resp.reason,
+            url=resp.url,
+            headers=_headers,
+            content=resp.content or b'',
+            encoding=resp.encoding
+        )
+        resp.close()
+        return compact
+
+    def __repr__(self):
+        return '<CompactResponse [%s]>' % self.status_code
+
+    def __bool__(self):
+        return self.ok
+
+    __nonzero__ = __bool__
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', 'replace')
+
+    @property
+    def links(self):
+        links = {}
+        header = self.headers.get('Link')
+        if header:
+            for link in requests_utils.parse_header_links(header):
+                links[link.get('rel') or link.get('url')] = link
+        return links
+
+    def json(self, **kwargs):
+        return json.loads(self.text, **kwargs)
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        chunk_size = chunk_size or len(self.content) or 1
+        for i in range(0, len(self.content), chunk_size):
+            chunk = self.content[i:i + chunk_size]
+            if decode_unicode:
+                chunk = chunk.decode(self.encoding or 'utf-8', 'replace')
+            yield chunk
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 500:
+            kind = 'Client'
+        elif 500 <= self.status_code < 600:
+            kind = 'Server'
+        else:
+            return
+        raise requests.HTTPError(
+            '%s %s Error: %s for url: %s' % (
+                self.status_code, kind, self.reason, self.url
+            ),
+            response=self
+        )
+
+    def close(self):
+        pass
+
+
+class Transport(object):
+    """Base class of the transports MakeRequest sends requests through.
+
+    A transport has the part of the ``requests.Session`` interface which
+    MakeRequest uses, so a session is a transport too: ``request`` taking
+    the method, url, ``headers``, ``data`` and request kwargs and returning
+    a ``requests.Response``, a method for each HTTP verb, and ``close``.
+    Subclasses implement ``request``.
+    """
+
+    def request(self, method, url, headers=None, data=None, **kwargs):
+        """Send a request.
+
+        :param method: ``str``
+        :param url: ``str``
+        :param headers: ``dict``
+        :param data: ``object``
+        :param kwargs: ``dict``
+        :return: ``object``
+        """
+        raise NotImplementedError
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('HEAD', url, **kwargs)
+
+    def options(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('OPTIONS', url, **kwargs)
+
+    option = options
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def close(self):
+        """Release the resources held by the transport."""
+        pass
+
+
+class Urllib3Transport(Transport):
+    """Transport sending requests straight through a urllib3 pool manager.
+
+    This skips the request preparation and adapter layers of ``requests``.
+    The ``params``, ``json``, ``stream``, ``timeout`` and
+    ``allow_redirects`` request kwargs are supported, other kwargs raise
+    ``TypeError``.
+    """
+
+    def __init__(self, poolmanager):
+        """Create the transport.
+
+        :param poolmanager: ``object`` urllib3 PoolManager.
+        """
+        self.poolmanager = poolmanager
+
+    def request(self, method, url, headers=None, data=None, **kwargs):
+        params = kwargs.pop('params', None)
+        json_body = kwargs.pop('json', None)
+        stream = kwargs.pop('stream', False)
+        timeout = kwargs.pop('timeout', None)
+        allow_redirects = kwargs.pop('allow_redirects', True)
+        if kwargs:
+            raise TypeError(
+                'Unsupported request kwargs [ %s ]' % ', '.join(sorted(kwargs))
+            )
+
+        if params:
+            url = update_query(url=url, params=params)
+
+        headers = dict(headers or {})
+        if json_body is not None and data is None:
+            data = json.dumps(json_body).encode('utf-8')
+            headers.setdefault('Content-Type', 'application/json')
+        elif isinstance(data, (dict, list, tuple)):
+            data = requests_utils.to_key_val_list(data)
+            if sys.version_info > (3, 2, 0):
+                data = urllib.parse.urlencode(data)
+            else:
+                data = urllib.urlencode(data)
+            headers.setdefault(
+                'Content-Type', 'application/x-www-form-urlencoded'
+            )
+
+        if isinstance(timeout, tuple):
+            timeout = urllib3_util_timeout.Timeout(
+                connect=timeout[0], read=timeout[1]
+            )
+        elif timeout is None:
+            timeout = urllib3_util_timeout.Timeout(connect=None, read=None)
+
+        # Match requests, failing at once and only following redirects.
+        retries = urllib3_util_retry.Retry(
+            total=None,
+            connect=0,
+            read=False,
+            redirect=30 if allow_redirects else False
+        )
+        try:
+            raw = self.poolmanager.urlopen(
+                method.upper(),
+                url,
+                body=data,
+                headers=headers,
+                retries=retries,
+                redirect=allow_redirects,
+                timeout=timeout,
+                preload_content=False,
+                decode_content=True
+            )
+        except urllib3_exceptions.MaxRetryError as exp:
+            self._raise(exp=exp.reason or exp)
+        except urllib3_exceptions.HTTPError as exp:
+            self._raise(exp=exp)
+
+        resp = build_response(
+            method=method,
+            url=raw.geturl() or url,
+            status=raw.status,
+            headers=raw.headers,
+            raw=raw,
+            reason=raw.reason,
+            request_headers=headers,
+            request_body=data
+        )
+        if not stream:
+            try:
+                resp.content
+            finally:
+                raw.release_conn()
+        return resp
+
+    @staticmethod
+    def _raise(exp):
+        """Raise the ``requests`` exception matching a urllib3 one.
+
+        :param exp: ``object``
+        """
+        if isinstance(exp, urllib3_exceptions.NewConnectionError):
+            raise requests.ConnectionError(exp)
+        elif isinstance(exp, urllib3_exceptions.ConnectTimeoutError):
+            raise requests.ConnectTimeout(exp)
+        elif isinstance(exp, urllib3_exceptions.ReadTimeoutError):
+            raise requests.ReadTimeout(exp)
+        elif isinstance(exp, urllib3_exceptions.SSLError):
+            raise requests.exceptions.SSLError(exp)
+        raise requests.ConnectionError(exp)
+
+    def close(self):
+        self.poolmanager.clear()
+
+
+class FakeTransport(Transport):
+    """In-process transport answering requests without any sockets.
+
+    Responses are set per method and URL with ``add``. Requests without
+    one are passed to ``handler`` when it is set, otherwise they get a
+    ``404``. Every request is recorded in ``calls``. Streamed request
+    bodies are read as they would be by a real transport.
+    """
+
+    def __init__(self, handler=None):
+        """Create the transport.
+
+        :param handler: ``object`` Callable answering requests without a
+                                   response of their own.
+        """
+        self.handler = handler
+        self.routes = {}
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def add(self, method, url, status=200, headers=None, body=b'',
+            handler=None):
+        """Set the response to a method and URL.
+
+        A ``handler`` is called with ``method``, ``url``, ``headers`` and
+        ``body`` keyword arguments and returns a ``(status, headers, body)``
+        tuple.
+
+        :param method: ``str``
+        :param url: ``str``
+        :param status: ``int``
+        :param headers: ``dict``
+        :param body: ``bytes`` || ``str``
+        :param handler: ``object``
+        """
+        if handler is None:
+            handler = (status, headers, body)
+        self.routes[(method.upper(), url)] = handler
+
+    def request(self, method, url, headers=None, data=None, **kwargs):
+        method = method.upper()
+        if method == 'OPTION':
+            method = 'OPTIONS'
+
+        params = kwargs.get('params')
+        if params:
+            url = update_query(url=url, params=params)
+
+        headers = dict(headers or {})
+        if kwargs.get('json') is not None and data is None:
+            data = json.dumps(kwargs['json']).encode('utf-8')
+            headers.setdefault('Content-Type', 'application/json')
+
+        body = data
+        if isinstance(data, StreamBody):
+            body = b''.join(data)
+        elif data is not None and not isinstance(data, (bytes, str, dict)):
+            body = b''.join(StreamBody(source=data, md5=False))
+
+        with self._lock:
+            self.calls.append(
+                {
+                    'method': method,
+                    'url': url,
+                    'headers': headers,
+                    'body': body,
+                    'kwargs': kwargs
+                }
+            )
+            route = self.routes.get((method, url), self.handler)
+
+        if route is None:
+            status, resp_headers, resp_body = 404, None, b''
+        elif callable(route):
+            status, resp_headers, resp_body = route(
+                method=method, url=url, headers=headers, body=body
+            )
+        else:
+            status, resp_headers, resp_body = route
+
+        return build_response(
+            method=method,
+            url=url,
+            status=status,
+            headers=resp_headers,
+            body=resp_body,
+            request_headers=headers,
+            request_body=data
+        )
+
+
+class PoolAdapter(adapters.HTTPAdapter):
+    """HTTP adapter which keeps track of connection pool usage.
+
+    The adapter behaves like the stock ``requests`` adapter with the addition
+    of pool statistics and the ability to evict host pools that have not been
+    used for ``idle_timeout`` seconds.
+    """
+
+    def __init__(self, idle_timeout=None, **kwargs):
+        """Create the adapter.
+
+        :param idle_timeout: ``int`` Seconds a host pool may sit unused before
+                                     it is evicted. ``None`` disables eviction.
+        :param kwargs: ``dict`` Keyword arguments for ``HTTPAdapter``.
+        """
+        self.idle_timeout = idle_timeout
+        self._stats_lock = threading.Lock()
+        self._last_used = {}
+        self._retired = {'opened': 0, 'requests': 0, 'evicted': 0}
+        self._warmed = 0
+        super(PoolAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        """Initialize the pool manager and hook pool disposal."""
+        super(PoolAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pools.dispose_func = self._dispose_pool
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TracedHTTPConnectionPool,
+            'https': TracedHTTPSConnectionPool
+        }
+
+    @staticmethod
+    def _pool_key(url):
+        """Return a ``tuple`` of scheme, host and port for a URL.
+
+        :param url: ``str``
+        :return: ``tuple``
+        """
+        parsed = urlparse.urlparse(url)
+        scheme = parsed.scheme.lower()
+        port = parsed.port
+        if port is None:
+            port = 443 if scheme == 'https' else 80
+        return scheme, parsed.hostname, port
+
+    def _dispose_pool(self, pool):
+        """Close a host pool, retaining its counters.
+
+        :param pool: ``object`` urllib3 connection pool.
+        """
+        idle = getattr(getattr(pool, 'pool', None), 'queue', None) or []
+        with self._stats_lock:
+            self._retired['opened'] += pool.num_connections
+            self._retired['requests'] += pool.num_requests
+            self._retired['evicted'] += len([i for i in idle if i is not None])
+        pool.close()
+
+    def _evict_idle(self):
+        """Evict every host pool that has been idle for too long."""
+        if not self.idle_timeout:
+            return
+
+        now = time.time()
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            host = (key.key_scheme, key.key_host, key.key_port)
+            last_used = self._last_used.get(host)
+            if last_used is not None and now - last_used > self.idle_timeout:
+                self._last_used.pop(host, None)
+                try:
+                    del pools[key]
+                except KeyError:
+                    pass
+
+    def connection_pool(self, url, verify=True, cert=None, proxies=None):
+        """Return the host pool requests to a URL are sent through.
+
+        :param url: ``str``
+        :param verify: ``bol`` || ``str``
+        :param cert: ``str`` || ``tuple``
+        :param proxies: ``dict``
+        :return: ``object``
+        """
+        self._last_used[self._pool_key(url)] = time.time()
+        if not hasattr(self, 'get_connection_with_tls_context'):
+            return self.get_connection(url, proxies=proxies)
+        request = requests.Request(method='GET', url=url).prepare()
+        return self.get_connection_with_tls_context(
+            request, verify, proxies=proxies, cert=cert
+        )
+
+    def warmed(self, connections):
+        """Count connections opened ahead of any request.
+
+        :param connections: ``int``
+        """
+        with self._stats_lock:
+            self._warmed += connections
+
+    def send(self, request, **kwargs):
+        """Send a request, evicting idle pools first.
+
+        :param request: ``object`` Prepared request.
+        :param kwargs: ``dict``
+        """
+        self._evict_idle()
+        try:
+            return super(PoolAdapter, self).send(request, **kwargs)
+        finally:
+            now = time.time()
+            self._last_used[self._pool_key(request.url)] = now
+            trace = getattr(_local, 'trace', None)
+            if trace is not None:
+                trace['ttfb'] = now - trace['start']
+
+    @property
+    def stats(self):
+        """Return a ``dict`` of connection pool statistics.
+
+        * ``opened`` connections created.
+        * ``warmed`` connections created ahead of any request.
+        * ``reused`` requests served from an already open connection.
+        * ``evicted`` idle connections discarded when their pool was evicted.
+        * ``pools`` host pools presently held open.
+
+        :return: ``dict``
+        """
+        with self._stats_lock:
+            opened = self._retired['opened']
+            requests_made = self._retired['requests']
+            evicted = self._retired['evicted']
+            warmed = self._warmed
+
+        pools = self.poolmanager.pools
+        live = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                live += 1
+                opened += pool.num_connections
+                requests_made += pool.num_requests
+
+        return {
+            'opened': opened,
+            'warmed': warmed,
+            'reused': max(requests_made - opened + warmed, 0),
+            'evicted': evicted,
+            'pools': live
+        }
+
+
+class ResponseCache(object):
+    """Cache of GET and HEAD responses honoring ``Cache-Control``.
+
+    Entries are kept in an in-memory LRU bounded by ``max_entries`` and
+    ``max_size`` bytes of body. When ``cache_dir`` is set every entry is also
+    written there, as a JSON file of the status and headers next to a file
+    of the body, and memory misses are loaded from disk.
+    """
+
+    def __init__(self, max_entries=1000, max_size=67108864, cache_dir=None):
+        """Create the cache.
+
+        :param max_entries: ``int``
+        :param max_size: ``int`` Maximum bytes of body kept in memory.
+        :param cache_dir: ``str`` Directory used for the on-disk tier.
+        """
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self.stats = {'hits': 0, 'misses': 0, 'revalidated': 0}
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(method, url):
+        """Return the cache key of a request.
+
+        :param method: ``str``
+        :param url: ``str``
+        :return: ``str``
+        """
+        return '%s %s' % (method.upper(), url)
+
+    @staticmethod
+    def _insensitive(headers):
+        """Return headers as a case insensitive ``dict``.
+
+        :param headers: ``dict``
+        :return: ``object``
+        """
+        return structures.CaseInsensitiveDict(headers or {})
+
+    @staticmethod
+    def cache_control(headers):
+        """Return a ``dict`` of ``Cache-Control`` directives.
+
+        :param headers: ``dict``
+        :return: ``dict``
+        """
+        directives = {}
+        for item in (headers.get('Cache-Control') or '').split(','):
+            name, _, value = item.strip().partition('=')
+            if name:
+                directives[name.lower()] = value.strip('"')
+        return directives
+
+    def _ttl(self, headers):
+        """Return the seconds a response is fresh for.
+
+        :param headers: ``dict``
+        :return: ``int``
+        """
+        directives = self.cache_control(headers)
+        if 'no-cache' in directives:
+            return 0
+        elif 'max-age' in directives:
+            max_age = utils.is_int(directives['max-age'])
+            if isinstance(max_age, int):
+                return max_age
+            return 0
+
+        expires = headers.get('Expires')
+        if expires:
+            expires = email_utils.parsedate_tz(expires)
+            if expires is not None:
+                date = email_utils.parsedate_tz(headers.get('Date') or '')
+                if date is not None:
+                    now = email_utils.mktime_tz(date)
+                else:
+                    now = time.time()
+                return email_utils.mktime_tz(expires) - now
+        return 0
+
+    def _disk_path(self, key):
+        """Return the on-disk path of a cache key, without a suffix.
+
+        :param key: ``str``
+        :return: ``str``
+        """
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, name)
+
+    def _put(self, key, entry):
+        """Add an entry to the memory tier, evicting the oldest entries.
+
+        :param key: ``str``
+        :param entry: ``dict``
+        """
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old['size']
+
+            if entry['size'] > self.max_size:
+                return
+
+            self._entries[key] = entry
+            self._size += entry['size']
+            while any([len(self._entries) > self.max_entries,
+                       self._size > self.max_size]):
+                _, old = self._entries.popitem(last=False)
+                self._size -= old['size']
+
+    def _write(self, key, entry):
+        """Write an entry to the on-disk tier.
+
+        :param key: ``str``
+        :param entry: ``dict``
+        """
+        if self.cache_dir is None:
+            return
+
+        resp = entry['response']
+        body = resp.content or b''
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        meta = {
+            'key': key,
+            'status': resp.status_code,
+            'reason': resp.reason,
+            'headers': dict(resp.headers),
+            'expires': entry['expires'],
+            'etag': entry['etag'],
+            'last_modified': entry['last_modified'],
+            'vary': entry['vary'],
+            'size': len(body),
+            'sha1': hashlib.sha1(body).hexdigest()
+        }
+        path = self._disk_path(key=key)
+        try:
+            with open('%s.body.tmp' % path, 'wb') as f:
+                f.write(body)
+            replace_file('%s.body.tmp' % path, '%s.body' % path)
+            with open('%s.json.tmp' % path, 'w') as f:
+                json.dump(meta, f)
+            replace_file('%s.json.tmp' % path, '%s.json' % path)
+        except (IOError, OSError, TypeError, ValueError):
+            pass
+
+    def _read(self, key):
+        """Return an entry from the on-disk tier or None.
+
+        :param key: ``str``
+        :return: ``dict`` || ``None``
+        """
+        if self.cache_dir is None:
+            return None
+
+        path = self._disk_path(key=key)
+        try:
+            with open('%s.json' % path, 'r') as f:
+                meta = json.load(f)
+            with open('%s.body' % path, 'rb') as f:
+                body = f.read()
+        except (IOError, OSError, ValueError):
+            return None
+
+        if not isinstance(meta, dict) or meta.get('key') != key:
+            return None
+
+        # The body file is replaced before the metadata, so a body which
+        # does not match belongs to an entry still being written.
+        if meta.get('sha1') != hashlib.sha1(body).hexdigest():
+            return None
+
+        method, _, url = key.partition(' ')
+        try:
+            resp = build_response(
+                method=method,
+                url=url,
+                status=meta['status'],
+                headers=meta['headers'],
+                body=body,
+                reason=meta['reason']
+            )
+            resp._content = body
+            return {
+                'response': resp,
+                'expires': meta['expires'],
+                'etag': meta['etag'],
+                'last_modified': meta['last_modified'],
+                'vary': meta['vary'],
+                'size': meta['size']
+            }
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def get(self, method, url, headers=None):
+        """Return the cache entry matching a request or None.
+
+        :param method: ``str``
+        :param url: ``str``
+        :param headers: ``dict`` Request headers.
+        :return: ``dict`` || ``None``
+        """
+        key = self._key(method=method, url=url)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+
+        if entry is None:
+            entry = self._read(key=key)
+            if entry is not None:
+                self._put(key=key, entry=entry)
+
+        if entry is not None:
+            request_headers = self._insensitive(headers)
+            for name, value in entry['vary'].items():
+                if request_headers.get(name) != value:
+                    entry = None
+                    break
+
+        if entry is None:
+            self.stats['misses'] += 1
+        return entry
+
+    def is_fresh(self, entry, headers=None):
+        """Return True if an entry may be used without revalidation.
+
+        :param entry: ``dict``
+        :param headers: ``dict`` Request headers.
+        :return: ``bol``
+        """
+        directives = self.cache_control(self._insensitive(headers))
+        if 'no-cache' in directives or directives.get('max-age') == '0':
+            return False
+        return time.time() < entry['expires']
+
+    @staticmethod
+    def conditional_headers(entry, headers):
+        """Return request headers which revalidate an entry.
+
+        :param entry: ``dict``
+        :param headers: ``dict``
+        :return: ``dict``
+        """
+        _headers = dict(headers or {})
+        if entry['etag']:
+            _headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            _headers['If-Modified-Since'] = entry['last_modified']
+        return _headers
+
+    @staticmethod
+    def _copy(resp):
+        """Return a copy of a response with headers of its own.
+
+        :param resp: ``object``
+        :return: ``object``
+        """
+        _resp = copy.copy(resp)
+        _resp.headers = structures.CaseInsensitiveDict(resp.headers)
+        return _resp
+
+    def response(self, entry):
+        """Return a copy of the response held by an entry.
+
+        :param entry: ``dict``
+        :return: ``object``
+        """
+        self.stats['hits'] += 1
+        with self._lock:
+            return self._copy(entry['response'])
+
+    def store(self, method, url, headers, resp):
+        """Store a response if it may be cached.
+
+        Only ``200`` responses that are fresh for some time or carry an
+        ``ETag`` or ``Last-Modified`` validator are stored. A copy is kept,
+        so callers may change the response they were given.
+
+        :param method: ``str``
+        :param url: ``str``
+        :param headers: ``dict`` Request headers.
+        :param resp: ``object``
+        """
+        key = self._key(method=method, url=url)
+        request_directives = self.cache_control(self._insensitive(headers))
+        directives = self.cache_control(resp.headers)
+        if any([resp.status_code != 200,
+                'no-store' in directives,
+                'no-store' in request_directives]):
+            return
+
+        # Bodies spooled to disk are too large to be held in the cache.
+        if getattr(resp, 'spool', None) is not None:
+            return
+
+        vary = [
+            i.strip().lower()
+            for i in (resp.headers.get('Vary') or '').split(',')
+            if i.strip()
+        ]
+        if '*' in vary:
+            return
+
+        etag = resp.headers.get('ETag')
+        last_modified = resp.headers.get('Last-Modified')
+        ttl = self._ttl(headers=resp.headers)
+        if ttl <= 0 and not (etag or last_modified):
+            return
+
+        # The body is read before the response is copied, so the copy kept
+        # here does not share the unread body of the one returned.
+        size = len(resp.content or b'')
+        request_headers = self._insensitive(headers)
+        entry = {
+            'response': self._copy(resp),
+            'expires': time.time() + ttl,
+            'etag': etag,
+            'last_modified': last_modified,
+            'vary': dict([(i, request_headers.get(i)) for i in vary]),
+            'size': size
+        }
+        self._put(key=key, entry=entry)
+        self._write(key=key, entry=entry)
+
+    def revalidate(self, method, url, entry, resp):
+        """Refresh an entry from a ``304 Not Modified`` response.
+
+        :param method: ``str``
+        :param url: ``str``
+        :param entry: ``dict``
+        :param resp: ``object`` The ``304`` response.
+        :return: ``object`` A copy of the cached response.
+        """
+        key = self._key(method=method, url=url)
+        with self._lock:
+            cached = entry['response']
+            for name in ['Cache-Control', 'Date', 'ETag', 'Expires',
+                         'Last-Modified']:
+                if resp.headers.get(name):
+                    cached.headers[name] = resp.headers[name]
+            entry['etag'] = cached.headers.get('ETag')
+            entry['last_modified'] = cached.headers.get('Last-Modified')
+            entry['expires'] = time.time() + self._ttl(headers=cached.headers)
+            self.stats['revalidated'] += 1
+
+        self._write(key=key, entry=entry)
+        return self.response(entry=entry)
+
+
+class Middleware(object):
+    """Hooks run around every request made by ``MakeRequest``.
+
+    Subclass this and override any of ``pre_request``, ``post_response``
+    and ``on_error``. The hooks of every middleware are gathered once, when
+    the ``MakeRequest`` is made, and only overridden hooks are called.
+    ``pre_request`` hooks run in the order the middleware is given,
+    ``post_response`` and ``on_error`` hooks in the reverse order.
+
+    Each hook is passed the request as a ``dict`` with the keys ``method``,
+    ``url``, ``headers``, ``body`` and ``kwargs``. The ``headers`` and
+    ``kwargs`` are copied once per request, so hooks may change them, and
+    the request itself, in place.
+    """
+
+    def pre_request(self, request):
+        """Called before a request is sent.
+
+        :param request: ``dict``
+        :return: ``object`` || ``None`` A response to return without sending
+                                        the request, or None.
+        """
+        return None
+
+    def post_response(self, request, resp):
+        """Called with every response, including ones from ``pre_request``.
+
+        :param request: ``dict``
+        :param resp: ``object``
+        :return: ``object`` The response to return.
+        """
+        return resp
+
+    def on_error(self, request, exp):
+        """Called when sending a request raises an exception.
+
+        :param request: ``dict``
+        :param exp: ``object``
+        :return: ``object`` || ``None`` A response to return instead of
+                                        raising, or None.
+        """
+        return None
+
+
+def middleware_hooks(middleware, name):
+    """Return the overridden hooks called ``name`` of a list of middleware.
+
+    :param middleware: ``list``
+    :param name: ``str``
+    :return: ``tuple``
+    """
+    default = getattr(Middleware, name)
+    default = getattr(default, '__func__', default)
+    hooks = []
+    for item in middleware:
+        hook = getattr(item, name, None)
+        if hook is not None and getattr(hook, '__func__', hook) is not default:
+            hooks.append(hook)
+    return tuple(hooks)
+
+
+class TokenProvider(Middleware):
+    """Middleware adding a cached auth token to every request.
+
+    Tokens come from ``fetch``, a callable returning the token, or a tuple
+    of the token and the seconds it is valid for. A token is fetched when
+    it is first needed and then refreshed on a background thread ahead of
+    its expiry, so requests only wait on a fetch when there is no valid
+    token at all.
+
+    With ``cache_file`` the token is also kept in a file shared by every
+    process using it. Refreshes take an exclusive lock on the file and
+    reuse a token another process has already refreshed rather than
+    fetching a new one. Without ``fcntl``, on Windows, there is no lock
+    between processes: the file is still shared, and replaced atomically,
+    but processes refreshing at the same time each fetch a token.
+
+    A ``401`` response drops the token so the next request fetches one.
+    """
+
+    def __init__(self, fetch, cache_file=None, refresh_margin=60,
+                 default_ttl=3600, retry_interval=10,
+                 header='X-Auth-Token', header_format='%s',
+                 log_name=__name__):
+        """Create the provider.
+
+        :param fetch: ``object`` Callable returning a new token.
+        :param cache_file: ``str`` File shared between processes.
+        :param refresh_margin: ``int`` Seconds before expiry a token is
+                                       refreshed.
+        :param default_ttl: ``int`` Seconds a token is valid for when
+                                    ``fetch`` does not say.
+        :param retry_interval: ``int`` Seconds between failed background
+                                       refreshes.
+        :param header: ``str`` Request header set to the token.
+        :param header_format: ``str`` Format of the header value, for
+                                      example ``Bearer %s``.
+        :param log_name: ``str``
+        """
+        self.fetch = fetch
+        self.cache_file = cache_file
+        self.refresh_margin = refresh_margin
+        self.default_ttl = default_ttl
+        self.retry_interval = retry_interval
+        self.header = header
+        self.header_format = header_format
+        self.log = logger.getLogger(log_name)
+        self.stats = {'fetched': 0, 'shared': 0, 'failed': 0}
+        self._entry = None
+        self._rejected = None
+        self._timer = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def token(self):
+        """Return a valid token, fetching one only when there is none.
+
+        :return: ``str``
+        """
+        with self._lock:
+            if self._entry is None or self._entry['expires'] <= time.time():
+                self._entry = self._refresh()
+                self._schedule(entry=self._entry)
+            return self._entry['token']
+
+    def invalidate(self, token=None):
+        """Drop a rejected token.
+
+        The token is also not reused from the cache file, where other
+        processes may have left it, the next refresh fetches a new one.
+
+        :param token: ``str`` The rejected token, default the cached one.
+                              A token other than the cached one is only
+                              kept from the cache file.
+        """
+        with self._lock:
+            if self._entry is not None and token in (
+                    None, self._entry['token']):
+                token = self._entry['token']
+                self._entry = None
+            if token is not None:
+                self._rejected = token
+
+    def close(self):
+        """Stop refreshing the token in the background."""
+        with self._lock:
+            self._closed = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def pre_request(self, request):
+        request['headers'][self.header] = self.header_format % self.token()
+
+    def post_response(self, request, resp):
+        if resp.status_code == 401:
+            entry = self._entry
+            sent = request['headers'].get(self.header)
+            if entry is not None and sent == (
+                    self.header_format % entry['token']):
+                self.invalidate(token=entry['token'])
+        return resp
+
+    def _fetch(self):
+        """Return a new token with the times it expires and is refreshed.
+
+        Tokens living for less than twice the refresh margin are refreshed
+        half way through their life.
+
+        :return: ``dict``
+        """
+        result = self.fetch()
+        if isinstance(result, tuple):
+            token, ttl = result
+        else:
+            token, ttl = result, self.default_ttl
+        self.stats['fetched'] += 1
+        now = time.time()
+        return {
+            'token': token,
+            'expires': now + ttl,
+            'refresh': now + ttl - min(self.refresh_margin, ttl / 2.0)
+        }
+
+    def _load(self):
+        """Return the token saved in the cache file or None.
+
+        :return: ``dict`` || ``None``
+        """
+        try:
+            with open(self.cache_file, 'r') as f:
+                entry = json.load(f)
+            if entry['token'] is not None:
+                return {
+                    'token': entry['token'],
+                    'expires': float(entry['expires']),
+                    'refresh': float(entry['refresh'])
+                }
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _save(self, entry):
+        """Atomically write a token to the cache file, readable by its owner.
+
+        :param entry: ``dict``
+        """
+        fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.cache_file))
+        )
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            replace_file(tmp, self.cache_file)
+        except Exception:
+            os.remove(tmp)
+            raise
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        """Hold an exclusive lock shared by every process using the file.
+
+        Without ``fcntl`` this locks nothing.
+        """
+        with open('%s.lock' % self.cache_file, 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """Return a token which is not due for a refresh.
+
+        :return: ``dict``
+        """
+        if self.cache_file is None:
+            return self._fetch()
+
+        with self._file_lock():
+            entry = self._load()
+            if entry is not None and entry['token'] != self._rejected:
+                if entry['refresh'] > time.time():
+                    self.stats['shared'] += 1
+                    return entry
+            entry = self._fetch()
+            self._save(entry=entry)
+            return entry
+
+    def _schedule(self, entry=None, delay=None):
+        """Start the timer refreshing the token, called with the lock held.
+
+        Refreshes are spread over the first half of the time between the
+        refresh time and the expiry of the token, so processes sharing a
+        cache file do not all refresh at once.
+
+        :param entry: ``dict`` The current token.
+        :param delay: ``float`` Seconds to wait instead.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._closed:
+            return
+
+        if delay is None:
+            delay = entry['refresh'] - time.time() + random.uniform(
+                0, (entry['expires'] - entry['refresh']) / 2.0
+            )
+        self._timer = threading.Timer(max(delay, 0), self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        """Refresh the token while the current one is still used."""
+        try:
+            entry = self._refresh()
+        except Exception as exp:
+            self.stats['failed'] += 1
+            self.log.warn('Failed to refresh the auth token: %s', exp)
+            with self._lock:
+                self._schedule(delay=self.retry_interval)
+        else:
+            with self._lock:
+                self._entry = entry
+                self._schedule(entry=entry)
+
+
+class Endpoint(object):
+    """Request template for a base URL.
+
+    The base URL is parsed and the headers and request kwargs are merged
+    once, when the endpoint is made, so each request only joins a path
+    suffix onto the base URL. Changes made to the ``MakeRequest`` headers
+    or kwargs afterwards are not seen by the endpoint.
+    """
+
+    def __init__(self, make_request, base_url, headers=None, kwargs=None):
+        """Create the endpoint.
+
+        :param make_request: ``object`` MakeRequest used to send requests.
+        :param base_url: ``str`` || ``object``
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        """
+        if not isinstance(base_url, urlparse.ParseResult):
+            base_url = parse_url(base_url)
+        self.make_request = make_request
+        self.base_url = urlparse.urlunparse(base_url).rstrip('/')
+        self.headers = utils.dict_update(
+            make_request.headers.copy(), headers
+        )
+        self.kwargs = utils.dict_update(
+            make_request.request_kwargs.copy(), kwargs
+        )
+
+    def url(self, path=None):
+        """Return the full URL for a path suffix.
+
+        :param path: ``str``
+        :return: ``str``
+        """
+        if not path:
+            return self.base_url
+        return '%s/%s' % (self.base_url, path.lstrip('/'))
+
+    def _request(self, method, path=None, headers=None, body=None,
+                 kwargs=None):
+        """Make a request against a path suffix.
+
+        The pre-merged headers and kwargs are only copied when the request
+        has headers or kwargs of its own.
+
+        :param method: ``str``
+        :param path: ``str``
+        :param headers: ``dict``
+        :param body: ``object``
+        :param kwargs: ``dict``
+        """
+        _headers = self.headers
+        if headers:
+            _headers = utils.dict_update(_headers.copy(), headers)
+
+        _kwargs = self.kwargs
+        if kwargs:
+            _kwargs = utils.dict_update(_kwargs.copy(), kwargs)
+
+        return self.make_request._dispatch(
+            method=method,
+            url=self.url(path=path),
+            headers=_headers,
+            body=body,
+            kwargs=_kwargs
+        )
+
+    def post(self, path=None, headers=None, body=None, kwargs=None):
+        """Make a POST request.
+
+        :param path: ``str``
+        :param headers: ``dict``
+        :param body: ``object``
+        :param kwargs: ``dict``
+        """
+        return self._request(
+            method='post',
+            path=path,
+            headers=headers,
+            body=body,
+            kwargs=kwargs
+        )
+
+    def head(self, path=None, headers=None, kwargs=None):
+        """Make a HEAD request.
+
+        :param path: ``str``
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        """
+        return self._request(
+            method='head',
+            path=path,
+            headers=headers,
+            kwargs=kwargs
+        )
+
+    def patch(self, path=None, headers=None, body=None, kwargs=None):
+        """Make a PATCH request.
+
+        :param path: ``str``
+        :param headers: ``dict``
+        :param body: ``object``
+        :param kwargs: ``dict``
+        """
+        return self._request(
+            method='patch',
+            path=path,
+            headers=headers,
+            body=body,
+            kwargs=kwargs
+        )
+
+    def put(self, path=None, headers=None, body=None, kwargs=None):
+        """Make a PUT request.
+
+        :param path: ``str``
+        :param headers: ``dict``
+        :param body: ``object``
+        :param kwargs: ``dict``
+        """
+        return self._request(
+            method='put',
+            path=path,
+            headers=headers,
+            body=body,
+            kwargs=kwargs
+        )
+
+    def delete(self, path=None, headers=None, kwargs=None):
+        """Make a DELETE request.
+
+        :param path: ``str``
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        """
+        return self._request(
+            method='delete',
+            path=path,
+            headers=headers,
+            kwargs=kwargs
+        )
+
+    def get(self, path=None, headers=None, kwargs=None):
+        """Make a GET request.
+
+        :param path: ``str``
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        """
+        return self._request(
+            method='get',
+            path=path,
+            headers=headers,
+            kwargs=kwargs
+        )
+
+    def option(self, path=None, headers=None, kwargs=None):
+        """Make a OPTION request.
+
+        :param path: ``str``
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        """
+        return self._request(
+            method='option',
+            path=path,
+            headers=headers,
+            kwargs=kwargs
+        )
+
+
+class MakeRequest(object):
+
+    def __init__(self, config=None, log_name=__name__):
+        """Make an HTTP request.
+
+        This class allows you to create custom request args and or enable
+        debug mode.
+
+        Requests are sent through a persistent session so connections are
+        pooled and reused between calls. The following ``config`` keys are
+        available:
+
+            * ``timeout`` seconds to wait on a response, default 60.
+            * ``headers`` a ``dict`` of headers sent with every request.
+            * ``debug`` enable ``httplib`` debug output.
+            * ``pool_connections`` number of host pools to keep, default 10.
+            * ``pool_maxsize`` connections kept per host pool, default 10.
+            * ``pool_block`` block when a host pool has no free connections
+              rather than opening a throwaway one, default False.
+            * ``pool_idle_timeout`` seconds a host pool may sit unused before
+              it is evicted, default None (never).
+            * ``batch_workers`` threads used by ``map`` and ``imap``,
+              default 10.
+            * ``chunk_size`` bytes read at a time when streaming a body,
+              default 65536.
+            * ``range_threshold`` size in bytes at which ``download`` fetches
+              an object as concurrent byte ranges, default None (never).
+            * ``range_size`` bytes fetched by each range request, default
+              8388608.
+            * ``range_workers`` concurrent range requests per download,
+              default 4.
+            * ``resume_interval`` bytes written between progress checkpoints
+              of a resumable download, default 8388608.
+            * ``cache`` cache GET and HEAD responses, default False.
+            * ``cache_entries`` responses kept in memory, default 1000.
+            * ``cache_size`` bytes of response body kept in memory, default
+              67108864.
+            * ``cache_dir`` directory used to also cache responses on disk,
+              default None.
+            * ``retries`` times a failed request is retried, default 0.
+            * ``retry_statuses`` response codes which are retried, default
+              ``[429, 500, 502, 503, 504]``.
+            * ``retry_methods`` methods which are retried, default the
+              idempotent methods.
+            * ``retry_backoff`` base seconds of the exponential backoff,
+              default 0.5. Each wait is a random time, "full jitter", up to
+              ``retry_backoff * 2 ** attempt`` seconds.
+            * ``retry_backoff_max`` longest wait between attempts, default 30.
+            * ``retry_budget`` retries allowed per request made, for example
+              0.2 allows a retry for every five requests, default None
+              (unlimited).
+            * ``breaker_threshold`` consecutive failures to a host which open
+              its circuit, default None (disabled).
+            * ``breaker_timeout`` seconds a host's circuit stays open,
+              default 30.
+
+            * ``rate_limit`` requests per second to all hosts, default None.
+            * ``rate_limit_per_host`` requests per second to any one host,
+              default None.
+            * ``rate_limit_hosts`` a ``dict`` of requests per second to
+              specific hosts, keyed by ``host`` or ``host:port`` as it
+              appears in the URL.
+            * ``rate_limit_burst`` requests which may be made at once,
+              default the rate.
+            * ``bandwidth_limit`` bytes per second of streamed bodies to and
+              from all hosts, default None. Streamed request bodies, and
+              response bodies read by ``iter_content``, ``download`` or
+              spooling, are throttled; small bodies sent or read at once are
+              not.
+            * ``bandwidth_limit_per_host`` bytes per second of streamed
+              bodies to and from any one host, default None.
+            * ``bandwidth_limit_hosts`` a ``dict`` of bytes per second of
+              streamed bodies to and from specific hosts, default None.
+            * ``single_flight`` share one request among concurrent identical
+              GET and HEAD requests, default False.
+            * ``hedge`` send a second GET or HEAD request when the first has
+              not answered within a percentile of the recent latency of its
+              host, returning whichever answers first, default False.
+            * ``hedge_percentile`` latency percentile to wait for, default 95.
+            * ``hedge_window`` latencies kept per host, default 100.
+            * ``hedge_min_samples`` latencies needed before requests to a
+              host are hedged, default 20.
+            * ``hedge_workers`` threads sending the second request of a
+              hedge, default twice ``batch_workers``.
+            * ``metrics`` record the timings of every request in
+              ``metrics``, default False.
+            * ``metrics_callback`` callable which receives the trace record
+              of every request, enables ``metrics``.
+            * ``metrics_buckets`` sorted upper bounds, in seconds, of the
+              timing histogram buckets.
+            * ``dns_cache`` cache host name lookups, True or a ``DNSCache``
+              shared between instances, default False.
+            * ``dns_cache_ttl`` seconds a lookup is cached, default 300.
+            * ``dns_cache_negative_ttl`` seconds a failed lookup is cached,
+              default 30.
+            * ``tls_session_cache`` resume TLS sessions when connecting to
+              a host again, True, False or a ``TLSSessionCache`` shared
+              between instances, default True.
+            * ``compress`` content encoding used to compress POST, PUT and
+              PATCH bodies, one of ``gzip``, ``deflate``, ``br`` or ``zstd``,
+              default None. Unavailable encodings fall back to ``gzip``.
+            * ``compress_min_size`` smallest body in bytes which is
+              compressed, default 1024.
+            * ``compress_level`` compression level, default the codec
+              default.
+            * ``accept_encoding`` ask for responses in every encoding which
+              can be decoded, including ``br`` and ``zstd`` when available,
+              default False. Responses are decoded as they are read.
+            * ``transport`` what requests are sent through, ``session`` for a
+              ``requests.Session``, ``urllib3`` for the connection pools
+              alone, or any ``Transport`` instance such as a
+              ``FakeTransport``, default ``session``. The transport is kept
+              in ``session``.
+            * ``spool_threshold`` bodies of responses larger than this many
+              bytes are written to a temporary file instead of being held in
+              memory, default None. The file is set as ``resp.spool``,
+              rewound, and is what ``resp.iter_content`` and ``resp.raw``
+              read; ``resp.spool`` is None for smaller bodies. Streamed
+              requests are not spooled.
+            * ``spool_dir`` directory the temporary files are made in,
+              default the system temporary directory.
+            * ``json_codec`` codec used for ``json`` request kwargs and by
+              ``decode_json``, one of ``auto``, ``orjson`` or ``json``,
+              default ``auto`` which uses ``orjson`` when it is installed.
+            * ``middleware`` a ``list`` of ``Middleware`` run around every
+              request, default None.
+            * ``token_provider`` a ``TokenProvider`` adding an auth token to
+              every request, run before any other middleware, default None.
+            * ``compact_responses`` return a ``CompactResponse``, which only
+              keeps the status, headers and body, instead of a
+              ``requests.Response``, default False. Streamed and spooled
+              responses, and responses to ``upload``, are returned as they
+              are.
+            * ``compact_headers`` names of the headers a ``CompactResponse``
+              keeps, default None (all). Keep ``Link`` for ``paginate``.
+
+        Retry counters are kept in ``retry_stats``, where ``exhausted``
+        counts retries refused by the retry budget, circuit breaker
+        counters in ``breaker.stats``, and hedging counters in
+        ``hedge_stats``, where ``wins`` counts hedges answering first.
+
+        :param config: ``dict``
+        :param log_name: ``str`` This is used to log against an existing log
+                                 handler.
+        """
+
+        self.config = config
+        if self.config is None:
+            self.config = {}
+
+        self.log = logger.getLogger(log_name)
+        self.request_kwargs = {'timeout': self.config.get('timeout', 60)}
+        self.headers = {
+            'User-Agent': 'cloudlib'
+        }
+
+        if isinstance(self.config, dict):
+            if 'headers'in self.config:
+                self.headers.update(self.config.get('headers'))
+
+            if self.config.get('debug', False):
+                httplib.HTTPConnection.debuglevel = 1
+
+        self.adapter = PoolAdapter(
+            idle_timeout=self.config.get('pool_idle_timeout'),
+            pool_connections=self.config.get(
+                'pool_connections', adapters.DEFAULT_POOLSIZE
+            ),
+            pool_maxsize=self.config.get(
+                'pool_maxsize', adapters.DEFAULT_POOLSIZE
+            ),
+            pool_block=self.config.get(
+                'pool_block', adapters.DEFAULT_POOLBLOCK
+            )
+        )
+        transport = self.config.get('transport', 'session')
+        if transport == 'session':
+            self.session = requests.Session()
+            self.session.mount('http://', self.adapter)
+            self.session.mount('https://', self.adapter)
+        elif transport == 'urllib3':
+            self.session = Urllib3Transport(
+                poolmanager=self.adapter.poolmanager
+            )
+        else:
+            self.session = transport
+
+        json_codec = self.config.get('json_codec', 'auto')
+        try:
+            self.json_codec = JSONCodec(name=json_codec)
+        except ValueError:
+            self.log.warn(
+                'JSON codec [ %s ] is not available, using json', json_codec
+            )
+            self.json_codec = JSONCodec(name='json')
+
+        self.batch_workers = self.config.get('batch_workers', 10)
+        self.chunk_size = self.config.get('chunk_size', 65536)
+        self.range_threshold = self.config.get('range_threshold')
+        self.range_size = self.config.get('range_size', 8388608)
+        self.range_workers = self.config.get('range_workers', 4)
+        self.resume_interval = self.config.get('resume_interval', 8388608)
+
+        self.cache = None
+        if self.config.get('cache', False):
+            self.cache = ResponseCache(
+                max_entries=self.config.get('cache_entries', 1000),
+                max_size=self.config.get('cache_size', 67108864),
+                cache_dir=self.config.get('cache_dir')
+            )
+
+        self.retries = self.config.get('retries', 0)
+        self.retry_statuses = self.config.get('retry_statuses', RETRY_STATUSES)
+        self.retry_methods = self.config.get('retry_methods', RETRY_METHODS)
+        self.retry_backoff = self.config.get('retry_backoff', 0.5)
+        self.retry_backoff_max = self.config.get('retry_backoff_max', 30)
+        self.retry_budget = self.config.get('retry_budget')
+        self.retry_stats = {'attempts': 0, 'retries': 0, 'exhausted': 0}
+        self._retry_tokens = 10.0
+        self._retry_lock = threading.Lock()
+
+        self.breaker = None
+        if self.config.get('breaker_threshold'):
+            self.breaker = CircuitBreaker(
+                threshold=self.config['breaker_threshold'],
+                timeout=self.config.get('breaker_timeout', 30)
+            )
+
+        self.limiter = None
+        if any([self.config.get('rate_limit'),
+                self.config.get('rate_limit_per_host'),
+                self.config.get('rate_limit_hosts')]):
+            self.limiter = RateLimiter(
+                rate=self.config.get('rate_limit'),
+                per_host=self.config.get('rate_limit_per_host'),
+                hosts=self.config.get('rate_limit_hosts'),
+                burst=self.config.get('rate_limit_burst')
+            )
+
+        self.single_flight = None
+        if self.config.get('single_flight', False):
+            # Copying a spooled response reads its body into memory.
+            self.single_flight = SingleFlight(
+                shareable=lambda resp: getattr(resp, 'spool', None) is None
+            )
+
+        self.bandwidth = None
+        if any([self.config.get('bandwidth_limit'),
+                self.config.get('bandwidth_limit_per_host'),
+                self.config.get('bandwidth_limit_hosts')]):
+            self.bandwidth = RateLimiter(
+                rate=self.config.get('bandwidth_limit'),
+                per_host=self.config.get('bandwidth_limit_per_host'),
+                hosts=self.config.get('bandwidth_limit_hosts')
+            )
+
+        self.metrics = None
+        if self.config.get('metrics') or self.config.get('metrics_callback'):
+            self.metrics = RequestMetrics(
+                buckets=self.config.get('metrics_buckets'),
+                callback=self.config.get('metrics_callback')
+            )
+
+        self.dns_cache = self.config.get('dns_cache') or None
+        if self.dns_cache is True:
+            self.dns_cache = DNSCache(
+                ttl=self.config.get('dns_cache_ttl', 300),
+                negative_ttl=self.config.get('dns_cache_negative_ttl', 30)
+            )
+
+        self.tls_sessions = self.config.get('tls_session_cache', True)
+        if self.tls_sessions is True:
+            self.tls_sessions = TLSSessionCache()
+        elif not self.tls_sessions:
+            self.tls_sessions = None
+
+        self.compress = self.config.get('compress')
+        if self.compress and self.compress not in Compressor.available():
+            self.log.warn(
+                'Content encoding [ %s ] is not available, using gzip',
+                self.compress
+            )
+            self.compress = 'gzip'
+        self.compress_min_size = self.config.get('compress_min_size', 1024)
+        self.compress_level = self.config.get('compress_level')
+        if self.config.get('accept_encoding', False):
+            self.headers.setdefault(
+                'Accept-Encoding', urllib3_util_request.ACCEPT_ENCODING
+            )
+
+        self.spool_threshold = self.config.get('spool_threshold')
+        self.spool_dir = self.config.get('spool_dir')
+
+        self.hedge = None
+        if self.config.get('hedge', False):
+            self.hedge = LatencyWindow(
+                size=self.config.get('hedge_window', 100),
+                min_samples=self.config.get('hedge_min_samples', 20)
+            )
+        self.hedge_percentile = self.config.get('hedge_percentile', 95)
+        self.hedge_stats = {'hedged': 0, 'wins': 0}
+        self._hedge_lock = threading.Lock()
+        self._hedge_executor = None
+        self._hedge_threads = set()
+
+        self.middleware = list(self.config.get('middleware') or [])
+        self.token_provider = self.config.get('token_provider')
+        if self.token_provider is not None:
+            self.middleware.insert(0, self.token_provider)
+        self._pre_request = middleware_hooks(
+            middleware=self.middleware, name='pre_request'
+        )
+        self._post_response = middleware_hooks(
+            middleware=reversed(self.middleware), name='post_response'
+        )
+        self._on_error = middleware_hooks(
+            middleware=reversed(self.middleware), name='on_error'
+        )
+        if self._pre_request or self._post_response or self._on_error:
+            # Requests without middleware keep the direct call path.
+            self._dispatch = functools.partial(
+                self._middleware_dispatch, self._dispatch
+            )
+
+        self.compact_headers = self.config.get('compact_headers')
+        if self.config.get('compact_responses', False):
+            self._dispatch = functools.partial(
+                self._compact_dispatch, self._dispatch
+            )
+
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Close the session and every pooled connection."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=True)
+            self._hedge_executor = None
+        with self._hedge_lock:
+            threads = list(self._hedge_threads)
+        for thread in threads:
+            thread.join()
+        if self.token_provider is not None:
+            self.token_provider.close()
+        self.session.close()
+
+    @property
+    def pool_stats(self):
+        """Return a ``dict`` of connection pool statistics.
+
+        :return: ``dict``
+        """
+        return self.adapter.stats
+
+    def warm(self, hosts, connections=1, kwargs=None):
+        """Open connections ahead of time and park them in the pool.
+
+        Hosts are URLs, or host names which are taken to use ``https``.
+        Connections are opened up to ``pool_maxsize`` per host, with the TLS
+        handshake done and its session kept for resumption. The first
+        connection to each host is opened before the others, which are then
+        opened concurrently and resume its TLS session. Hosts which can not
+        be reached are logged and skipped. Only the ``session`` and
+        ``urllib3`` transports have pools to warm.
+
+        :param hosts: ``list``
+        :param connections: ``int`` Connections to open per host.
+        :param kwargs: ``dict`` Request kwargs, ``timeout``, ``verify``,
+                                ``cert`` and ``proxies`` are used.
+        :return: ``int`` Connections opened.
+        """
+        _kwargs = utils.dict_update(self.request_kwargs.copy(), kwargs)
+        timeout = _kwargs.get('timeout')
+        if isinstance(timeout, tuple):
+            timeout = timeout[0]
+
+        first = []
+        rest = []
+        for host in hosts:
+            url = host if '://' in host else 'https://%s' % host
+            pool = self._warm_pool(url=url, kwargs=_kwargs)
+            if pool is None:
+                continue
+
+            for i in range(min(connections, pool.pool.maxsize)):
+                conn = pool._get_conn()
+                if conn.sock is None:
+                    conn.timeout = timeout
+                if i == 0:
+                    first.append((pool, conn))
+                else:
+                    rest.append((pool, conn))
+
+        opened = 0
+        executor = self._get_executor()
+        for idle in (first, rest):
+            for (pool, conn), state in zip(
+                    idle, executor.map(self._warm_connection, idle)):
+                if state is None:
+                    pool._put_conn(None)
+                else:
+                    opened += int(state)
+                    pool._put_conn(conn)
+
+        self.adapter.warmed(connections=opened)
+        return opened
+
+    def _warm_pool(self, url, kwargs):
+        """Return the pool requests to a URL are sent through or None.
+
+        ``verify``, ``cert`` and ``proxies`` are merged with the environment,
+        such as ``REQUESTS_CA_BUNDLE``, the way ``requests`` merges them, so
+        the pool is the one requests use.
+
+        :param url: ``str``
+        :param kwargs: ``dict``
+        :return: ``object`` || ``None``
+        """
+        if isinstance(self.session, requests.Session):
+            settings = self.session.merge_environment_settings(
+                url,
+                kwargs.get('proxies') or {},
+                None,
+                kwargs.get('verify'),
+                kwargs.get('cert')
+            )
+            return self.adapter.connection_pool(
+                url=url,
+                verify=settings['verify'],
+                cert=settings['cert'],
+                proxies=settings['proxies']
+            )
+        elif isinstance(self.session, Urllib3Transport):
+            return self.session.poolmanager.connection_from_url(url)
+        return None
+
+    def _warm_connection(self, item):
+        """Connect a pooled connection unless it is already connected.
+
+        :param item: ``tuple`` Pool and connection.
+        :return: ``bool`` || ``None`` True when the connection was opened,
+                                     False when it was already open and None
+                                     when it failed.
+        """
+        pool, conn = item
+        if conn.sock is not None:
+            return False
+
+        try:
+            with self._connection_context():
+                start = time.time()
+                conn.connect()
+                # Tickets follow about a round trip after the handshake.
+                if hasattr(conn, 'read_tickets'):
+                    conn.read_tickets(wait=max(time.time() - start, 0.01))
+        except Exception as exp:
+            self.log.warn(
+                'Failed to warm a connection to %s: %s', pool.host, exp
+            )
+            conn.close()
+            return None
+        return True
+
+    def endpoint(self, base_url, headers=None, kwargs=None):
+        """Return a request template for a base URL.
+
+        Use this for many small requests against one service, each request
+        then only takes the path suffix.
+
+        >>> api = make_req.endpoint('https://example.com/v1')
+        >>> resp = api.get('items/1')
+
+        :param base_url: ``str`` || ``object``
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        :return: ``object``
+        """
+        return Endpoint(
+            make_request=self,
+            base_url=base_url,
+            headers=headers,
+            kwargs=kwargs
+        )
+
+    @staticmethod
+    def _get_url(url):
+        """Returns a URL string.
+
+        If the ``url`` parameter is a ParsedResult from `urlparse` the full url
+        will be unparsed and made into a string. Otherwise the ``url``
+        parameter is returned as is.
+
+        :param url: ``str`` || ``object``
+        """
+        if isinstance(url, urlparse.ParseResult):
+            return urlparse.urlunparse(url)
+        else:
+            return url
+
+    def _report_error(self, request, exp):
+        """When making the request, if an error happens, log it."""
+        message = (
+            "Failure to perform %s due to [ %s ]" % (request, exp)
+        )
+        self.log.fatal(message)
+        raise requests.RequestException(message)
+
+    def _request(self, method, url, headers=None, body=None, kwargs=None):
+        """Make a request.
+
+        To make a request pass the ``method`` and the ``url``. Valid methods
+        are, ``['post', 'put', 'get', 'delete', 'patch', 'option', 'head']``.
+
+        :param url: ``str``
+        :param headers: ``dict``
+        :param body: ``object``
+        :param kwargs: ``dict``
+        """
+        return self._dispatch(
+            method=method,
+            url=self._get_url(url=url),
+            headers=utils.dict_update(self.headers.copy(), headers),
+            body=body,
+            kwargs=utils.dict_update(self.request_kwargs.copy(), kwargs)
+        )
+
+    def _dispatch(self, method, url, headers, body, kwargs):
+        """Make a request with headers and kwargs which are already merged.
+
+        Neither ``headers`` nor ``kwargs`` are modified, so callers may pass
+        the same dictionaries for every request.
+
+        :param method: ``str``
+        :param url: ``str``
+        :param headers: ``dict``
+        :param body: ``object``
+        :param kwargs: ``dict``
+        """
+        if body is None and kwargs.get('json') is not None:
+            body, headers, kwargs = self._encode_json(
+                headers=headers, kwargs=kwargs
+            )
+
+        if self.compress and method.lower() in ('post', 'put', 'patch'):
+            body, headers = self._compress(body=body, headers=headers)
+
+        try:
+            if method.lower() not in ('get', 'head') or kwargs.get('stream'):
+                return self._send(
+                    method=method,
+                    url=url,
+                    headers=headers,
+                    body=body,
+                    kwargs=kwargs
+                )
+
+            if self.cache is not None:
+                send = self._cached_send
+            else:
+                send = self._send
+
+            flight_url = None
+            if self.single_flight is not None:
+                flight_url = self._cache_url(url=url, kwargs=kwargs)
+
+            if flight_url is not None:
+                key = (
+                    method.lower(), flight_url, tuple(sorted(headers.items()))
+                )
+                return self.single_flight.do(
+                    key=key,
+                    func=send,
+                    method=method,
+                    url=url,
+                    headers=headers,
+                    body=body,
+                    kwargs=kwargs
+                )
+            else:
+                return send(
+                    method=method,
+                    url=url,
+                    headers=headers,
+                    body=body,
+                    kwargs=kwargs
+                )
+        except AttributeError as exp:
+            self._report_error(request=method.upper(), exp=exp)
+
+    def _middleware_dispatch(self, dispatch, method, url, headers, body,
+                             kwargs):
+        """Make a request through the middleware hooks.
+
+        :param dispatch: ``object`` Sends the request once the
+                                    ``pre_request`` hooks have run.
+        :param method: ``str``
+        :param url: ``str``
+        :param headers: ``dict``
+        :param body: ``object``
+        :param kwargs: ``dict``
+        :return: ``object``
+        """
+        request = {
+            'method': method,
+            'url': url,
+            'headers': headers.copy(),
+            'body': body,
+            'kwargs': kwargs.copy()
+        }
+        try:
+            for hook in self._pre_request:
+                resp = hook(request)
+                if resp is not None:
+                    break
+            else:
+                resp = dispatch(**request)
+        except Exception as exp:
+            for hook in self._on_error:
+                resp = hook(request, exp)
+                if resp is not None:
+                    break
+            else:
+                raise
+
+        for hook in self._post_response:
+            resp = hook(request, resp)
+        return resp
+
+    def _compact_dispatch(self, dispatch, method, url, headers, body,
+                          kwargs):
+        """Make a request returning a ``CompactResponse``.
+
+        :param dispatch: ``object`` Sends the request.
+        :param method: ``str``
+        :param url: ``str``
+        :param headers: ``dict``
+        :param body: ``object``
+        :param kwargs: ``dict``
+        :return: ``object``
+        """
+        resp = dispatch(
+            method=method, url=url, headers=headers, body=body, kwargs=kwargs
+        )
+        # Uploads send a StreamBody and set its md5 sum on the response.
+        if any([kwargs.get('stream'),
+                isinstance(body, StreamBody),
+                getattr(resp, 'spool', None) is not None,
+                isinstance(resp, CompactResponse)]):
+            return resp
+        return CompactResponse.from_response(
+            resp=resp, headers=self.compact_headers
+        )
+
+    def _encode_json(self, headers, kwargs):
+        """Return the ``json`` request kwarg encoded as the request body.
+
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        :return: ``tuple`` Body, headers and kwargs without ``json``.
+        """
+        kwargs = kwargs.copy()
+        body = self.json_codec.dumps(kwargs.pop('json'))
+        if 'content-type' not in [i.lower() for i in headers.keys()]:
+            headers = utils.dict_update(
+                {'Content-Type': 'application/json'}, headers
+            )
+        return body, headers, kwargs
+
+    def decode_json(self, resp):
+        """Return the JSON body of a response decoded with the JSON codec.
+
+        :param resp: ``object``
+        :return: ``object``
+        """
+        return self.json_codec.loads(resp.content)
+
+    def _compress(self, body, headers):
+        """Return a compressed request body and its headers.
+
+        Bodies smaller than ``compress_min_size``, of unknown type, or which
+        are already encoded are returned as they are. Streamed bodies of
+        unknown length are always compressed.
+
+        :param body: ``object``
+        :param headers: ``dict`` Request headers, copied when changed.
+        :return: ``tuple``
+        """
+        if body is None or 'content-encoding' in [
+                i.lower() for i in headers.keys()]:
+            return body, headers
+
+        if isinstance(body, (bytes, str)):
+            length = len(body)
+        elif self._replayable(body):
+            return body, headers
+        elif hasattr(body, 'read'):
+            length = StreamBody._file_length(body)
+        else:
+            length = getattr(body, 'len', None)
+
+        if length is not None and length < self.compress_min_size:
+            return body, headers
+
+        headers = dict(
+            [i for i in headers.items() if i[0].lower() != 'content-length']
+        )
+        headers['Content-Encoding'] = self.compress
+        body = compress_body(
+            body=body,
+            encoding=self.compress,
+            level=self.compress_level,
+            chunk_size=self.chunk_size
+        )
+        return body, headers
+
+    @staticmethod
+    def _replayable(body):
+        """Return True if a request body can be sent more than once.
+
+        :param body: ``object``
+        :return: ``bol``
+        """
+        if body is None or isinstance(body, (bytes, str, dict, list, tuple)):
+            return True
+        stream_attrs = ['read', '__iter__', 'next', '__next__']
+        return not any([hasattr(body, i) for i in stream_attrs])
+
+    def _retry_allowed(self):
+        """Return True if the retry budget allows another retry.
+
+        Every request adds ``retry_budget`` to a pool of at most ten retry
+        tokens and every retry takes one.
+
+        :return: ``bol``
+        """
+        with self._retry_lock:
+            if self.retry_budget is None:
+                return True
+            elif self._retry_tokens >= 1:
+                self._retry_tokens -= 1
+                return True
+            else:
+                return False
+
+    def _retry_delay(self, attempt, resp=None):
+        """Return the seconds to wait before retrying a request.
+
+        :param attempt: ``int`` Retries already made.
+        :param resp: ``object`` The response being retried.
+        :return: ``float``
+        """
+        delay = random.uniform(
+            0, min(self.retry_backoff_max, self.retry_backoff * 2 ** attempt)
+        )
+        if resp is not None:
+            retry_after = retry_after_seconds(resp=resp)
+            if retry_after is not None:
+                delay = max(delay, min(retry_after, self.retry_backoff_max))
+        return delay
+
+    def _send(self, method, url, headers, body, kwargs):
+        """Send a request, retrying failures.
+
+        Connection errors, timeouts and responses in ``retry_statuses`` are
+        retried up to ``retries`` times when the method is in
+        ``retry_methods`` and the body can be replayed. When the circuit
+        breaker is enabled, requests to a host whose circuit is open raise
+        ``CircuitOpen`` without being sent. When the rate limiter is enabled
+        every attempt waits for its turn.
+
+        :param method: ``str``
+        :param url: ``str``
+        :param headers: ``dict``
+        :param body: ``object``
+        :param kwargs: ``dict``
+        :return: ``object``
+        """
+        host = urlparse.urlparse(url).netloc
+        retryable = all([
+            self.retries,
+            method.lower() in self.retry_methods,
+            self._replayable(body)
+        ])
+        with self._retry_lock:
+            self.retry_stats['attempts'] += 1
+            if self.retry_budget is not None:
+                self._retry_tokens = min(
+                    self._retry_tokens + self.retry_budget, 10.0
+                )
+
+        hedge = self.hedge is not None and method.lower() in ('get', 'head')
+        if hedge and self._replayable(body):
+            send = self._hedged_send
+        else:
+            send = self._session_send
+
+        attempt = 0
+        while True:
+            if self.breaker is not None and not self.breaker.allow(host):
+                raise CircuitOpen('Circuit open for [ %s ]' % host)
+
+            if self.limiter is not None:
+                self.limiter.acquire(host=host)
+
+            try:
+                resp = send(
+                    method=method,
+                    url=url,
+                    headers=headers,
+                    body=body,
+                    kwargs=kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout) as exp:
+                if self.breaker is not None:
+                    self.breaker.failure(host)
+                if not retryable or attempt >= self.retries:
+                    raise
+                elif not self._retry_allowed():
+                    self.retry_stats['exhausted'] += 1
+                    raise
+                delay = self._retry_delay(attempt=attempt)
+                self.log.warn(
+                    'Retrying %s %s in %.2fs due to [ %s ]',
+                    method.upper(), url, delay, exp
+                )
+            except Exception:
+                # Any failure ends a half-open trial, or the circuit would
+                # refuse every later request.
+                if self.breaker is not None:
+                    self.breaker.failure(host)
+                raise
+            else:
+                if self.limiter is not None:
+                    self.limiter.update(host=host, resp=resp)
+
+                if self.breaker is not None:
+                    if resp.status_code >= 500:
+                        self.breaker.failure(host)
+                    else:
+                        self.breaker.success(host)
+
+                if any([not retryable,
+                        attempt >= self.retries,
+                        resp.status_code not in self.retry_statuses]):
+                    return resp
+                elif not self._retry_allowed():
+                    self.retry_stats['exhausted'] += 1
+                    return resp
+                delay = self._retry_delay(attempt=attempt, resp=resp)
+                self.log.warn(
+                    'Retrying %s %s in %.2fs due to [ %s %s ]',
+                    method.upper(), url, delay, resp.status_code, resp.reason
+                )
+                resp.close()
+
+            attempt += 1
+            with self._retry_lock:
+                self.retry_stats['retries'] += 1
+            time.sleep(delay)
+
+    def _get_hedge_executor(self):
+        """Return the thread pool used for hedged requests.
+
+        This is kept apart from the batch thread pool so batch requests
+        can not starve the requests they hedge.
+
+        :return: ``object``
+        """
+        if self._hedge_executor is None:
+            with self._executor_lock:
+                if self._hedge_executor is None:
+                    self._hedge_executor = futures.ThreadPoolExecutor(
+                        max_workers=self.config.get(
+                            'hedge_workers', self.batch_workers * 2
+                        )
+                    )
+        return self._hedge_executor
+
+    def _timed_send(self, host, **kwargs):
+        """Send a request through the session, recording its latency.
+
+        :param host: ``str``
+        :param kwargs: ``dict`` Arguments of ``_session_send``.
+        :return: ``object``
+        """
+        start = time.time()
+        resp = self._session_send(**kwargs)
+        self.hedge.observe(host=host, seconds=time.time() - start)
+        return resp
+
+    def _start_send(self, send_kwargs):
+        """Start sending a request on a thread of its own.
+
+        The first request of a hedge is not queued on the hedge thread
+        pool, so the hedge delay is counted from when it is actually sent
+        and the pool does not limit how many requests are in flight.
+
+        :param send_kwargs: ``dict`` Arguments of ``_timed_send``.
+        :return: ``object``
+        """
+        future = futures.Future()
+
+        def run():
+            try:
+                if future.set_running_or_notify_cancel():
+                    future.set_result(self._timed_send(**send_kwargs))
+            except Exception as exp:
+                future.set_exception(exp)
+            finally:
+                with self._hedge_lock:
+                    self._hedge_threads.discard(thread)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        with self._hedge_lock:
+            self._hedge_threads.add(thread)
+        thread.start()
+        return future
+
+    def _hedged_send(self, method, url, headers, body, kwargs):
+        """Send a request, hedging it when it is slow to answer.
+
+        When the first request has not answered within ``hedge_percentile``
+        of the recent latency of its host a second one is sent on the hedge
+        thread pool, and the first to answer is returned. A request can not
+        be stopped once it is sent, so the response of the other is closed
+        when it arrives.
+
+        :param method: ``str``
+        :param url: ``str``
+        :param headers: ``dict``
+        :param body: ``object``
+        :param kwargs: ``dict``
+        :return: ``object``
+        """
+        host = urlparse.urlparse(url).netloc
+        send_kwargs = {
+            'host': host,
+            'method': method,
+            'url': url,
+            'headers': headers,
+            'body': body,
+            'kwargs': kwargs
+        }
+        delay = self.hedge.percentile(host=host, percent=self.hedge_percentile)
+        if delay is None:
+            return self._timed_send(**send_kwargs)
+
+        first = self._start_send(send_kwargs)
+        done, _ = futures.wait([first], timeout=delay)
+        if done:
+            return first.result()
+
+        with self._hedge_lock:
+            self.hedge_stats['hedged'] += 1
+        self.log.debug(
+            'Hedging %s %s after %.3fs', method.upper(), url, delay
+        )
+        second = self._get_hedge_executor().submit(
+            self._timed_send, **send_kwargs
+        )
+        pending = set([first, second])
+        failed = None
+        while pending:
+            done, pending = futures.wait(
+                pending, return_when=futures.FIRST_COMPLETED
+            )
+            for future in done:
+                if future.exception() is not None:
+                    failed = failed or future
+                    continue
+
+                if future is second:
+                    with self._hedge_lock:
+                        self.hedge_stats['wins'] += 1
+                for other in pending:
+                    if not other.cancel():
+                        other.add_done_callback(self._close_response)
+                for other in done:
+                    if other is not future and other.exception() is None:
+                        other.result().close()
+                return future.result()
+        return failed.result()
+
+    @staticmethod
+    def _close_response(future):
+        """Close the response of a request which lost a hedge.
+
+        :param future: ``object``
+        """
+        if not future.cancelled() and future.exception() is None:
+            future.result().close()
+
+    @contextlib.contextmanager
+    def _connection_context(self):
+        """Set the DNS and TLS session caches used by new connections.
+
+        urllib3 opens connections on the thread sending the request, which
+        is where the connection classes look the caches up.
+        """
+        previous = (
+            getattr(_local, 'dns_cache', None),
+            getattr(_local, 'tls_sessions', None)
+        )
+        _local.dns_cache = self.dns_cache
+        _local.tls_sessions = self.tls_sessions
+        try:
+            yield
+        finally:
+            _local.dns_cache, _local.tls_sessions = previous
+
+    def _session_send(self, method, url, headers, body, kwargs):
+        """Send a request through the session.
+
+        :param method: ``str``
+        :param url: ``str``
+        :param headers: ``dict``
+        :param body: ``object``
+        :param kwargs: ``dict``
+        :return: ``object``
+        """
+        func = getattr(self.session, method.lower())
+        if self.bandwidth is not None and not self._replayable(body):
+            body = StreamBody(
+                source=body,
+                chunk_size=self.chunk_size,
+                length=getattr(body, 'len', None),
+                md5=False,
+                throttle=functools.partial(
+                    self.bandwidth.acquire, urlparse.urlparse(url).netloc
+                )
+            )
+
+        if body is not None:
+            kwargs = utils.dict_update({'data': body}, kwargs)
+
+        if all([self.spool_threshold is not None,
+                method.lower() != 'head',
+                not kwargs.get('stream')]):
+            func = functools.partial(self._spool_send, func)
+
+        with self._connection_context():
+            if self.metrics is None:
+                resp = func(url, headers=headers, **kwargs)
+            else:
+                resp = self._traced_send(
+                    func=func, method=method, url=url, headers=headers,
+                    kwargs=kwargs
+                )
+
+        self.log.debug(
+            '%s %s %s', resp.status_code, resp.reason, resp.request
+        )
+        return resp
+
+    def iter_content(self, resp, chunk_size=None):
+        """Iterate over the body of a streamed response.
+
+        This is ``resp.iter_content`` throttled to the bandwidth limits.
+
+        :param resp: ``object``
+        :param chunk_size: ``int`` Default ``chunk_size``.
+        :return: ``object`` generator
+        """
+        chunks = resp.iter_content(chunk_size=chunk_size or self.chunk_size)
+        if self.bandwidth is None:
+            return chunks
+        return self._throttled_chunks(resp=resp, chunks=chunks)
+
+    def _throttled_chunks(self, resp, chunks):
+        """Yield chunks of a response body within the bandwidth limits.
+
+        :param resp: ``object``
+        :param chunks: ``object``
+        :yield: ``bytes``
+        """
+        host = urlparse.urlparse(getattr(resp, 'url', None) or '').netloc
+        for chunk in chunks:
+            self.bandwidth.acquire(host=host, tokens=len(chunk))
+            yield chunk
+
+    def _spool_send(self, func, url, **kwargs):
+        """Send a request, spooling a large response body to disk.
+
+        :param func: ``object`` Session method.
+        :param url: ``str``
+        :param kwargs: ``dict``
+        :return: ``object``
+        """
+        kwargs['stream'] = True
+        resp = func(url, **kwargs)
+        raw = resp.raw
+        spool = tempfile.SpooledTemporaryFile(
+            max_size=self.spool_threshold, dir=self.spool_dir
+        )
+        try:
+            for chunk in self.iter_content(resp=resp):
+                spool.write(chunk)
+        except Exception:
+            spool.close()
+            resp.close()
+            raise
+
+        release_conn = getattr(raw, 'release_conn', None)
+        if release_conn is not None:
+            release_conn()
+
+        size = spool.tell()
+        spool.seek(0)
+        if size <= self.spool_threshold:
+            resp._content = spool.read()
+            resp.spool = None
+            spool.close()
+        else:
+            resp.raw = resp.spool = spool
+            resp._content = False
+            resp._content_consumed = False
+        return resp
+
+    def _traced_send(self, func, method, url, headers, kwargs):
+        """Send a request through the session, recording its timings.
+
+        For streamed responses ``transfer`` and ``bytes_in`` only cover what
+        was read before the response is returned.
+
+        :param func: ``object`` Session method.
+        :param method: ``str``
+        :param url: ``str``
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        :return: ``object``
+        """
+        trace = self.metrics.trace(method=method, url=url)
+        previous = getattr(_local, 'trace', None)
+        _local.trace = trace
+        try:
+            resp = func(url, headers=headers, **kwargs)
+        except Exception as exp:
+            trace['error'] = str(exp)
+            raise
+        else:
+            trace['status'] = resp.status_code
+            body = getattr(getattr(resp, 'request', None), 'body', None)
+            if isinstance(body, (bytes, str)):
+                trace['bytes_out'] = len(body)
+            elif hasattr(body, 'bytes_sent'):
+                trace['bytes_out'] = body.bytes_sent
+
+            spool = getattr(resp, 'spool', None)
+            if spool is not None:
+                spool.seek(0, 2)
+                trace['bytes_in'] = spool.tell()
+                spool.seek(0)
+            elif kwargs.get('stream'):
+                length = utils.is_int(resp.headers.get('Content-Length', 0))
+                if isinstance(length, int):
+                    trace['bytes_in'] = length
+            else:
+                trace['bytes_in'] = len(resp.content or b'')
+            return resp
+        finally:
+            _local.trace = previous
+            trace['total'] = time.time() - trace['start']
+            trace['ttfb'] = trace['ttfb'] or trace['total']
+            trace['transfer'] = trace['total'] - trace['ttfb']
+            self.metrics.record(trace)
+
+    def _cached_send(self, method, url, headers, body, kwargs):
+        """Send a request, answering it from the cache when possible.
+
+        Fresh cached responses are returned without a request. Stale ones
+        are revalidated with ``If-None-Match`` and ``If-Modified-Since`` so a
+        ``304`` response reuses the cached body.
+
+        :param method: ``str``
+        :param url: ``str``
+        :param headers: ``dict``
+        :param body: ``object``
+        :param kwargs: ``dict``
+        :return: ``object``
+        """
+        cache_url = self._cache_url(url=url, kwargs=kwargs)
+        if cache_url is None:
+            return self._send(
+                method=method,
+                url=url,
+                headers=headers,
+                body=body,
+                kwargs=kwargs
+            )
+
+        entry = self.cache.get(method=method, url=cache_url, headers=headers)
+        _headers = headers
+        if entry is not None:
+            if self.cache.is_fresh(entry=entry, headers=headers):
+                self.log.debug('Cache hit %s %s', method.upper(), cache_url)
+                return self.cache.response(entry=entry)
+            _headers = self.cache.conditional_headers(
+                entry=entry, headers=headers
+            )
+
+        resp = self._send(
+            method=method,
+            url=url,
+            headers=_headers,
+            body=body,
+            kwargs=kwargs
+        )
+        if entry is not None and resp.status_code == 304:
+            return self.cache.revalidate(
+                method=method, url=cache_url, entry=entry, resp=resp
+            )
+
+        self.cache.store(
+            method=method, url=cache_url, headers=headers, resp=resp
+        )
+        return resp
+
+    @staticmethod
+    def _cache_url(url, kwargs):
+        """Return the URL a request is cached and shared under or None.
+
+        The URL is the one ``requests`` sends, with ``params`` added.
+        Requests with kwargs which may change the response, such as
+        ``auth``, ``cert`` or ``verify``, are neither cached nor shared by
+        single flight.
+
+        :param url: ``str``
+        :param kwargs: ``dict``
+        :return: ``str`` || ``None``
+        """
+        if any([i not in ('timeout', 'stream', 'params') for i in kwargs]):
+            return None
+
+        prepared = requests.PreparedRequest()
+        prepared.prepare_url(url, kwargs.get('params'))
+        return prepared.url
+
+    def _get_executor(self):
+        """Return the thread pool used for batch requests.
+
+        :return: ``object``
+        """
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = futures.ThreadPoolExecutor(
+                        max_workers=self.batch_workers
+                    )
+        return self._executor
+
+    def _batch_request(self, item):
+        """Make a single request from a batch.
+
+        Errors are logged and returned rather than raised so that one failed
+        item does not abort the rest of the batch.
+
+        :param item: ``tuple``
+        :return: ``object``
+        """
+        try:
+            return self._request(*item)
+        except Exception as exp:
+            self.log.error('Batch request %s failed: %s', item[:2], exp)
+            return exp
+
+    def imap(self, items, ordered=True):
+        """Yield the results of many requests made concurrently.
+
+        Each item is a ``tuple`` of ``(method, url, headers, body, kwargs)``
+        where everything after ``url`` is optional. Requests are made on a
+        thread pool of ``batch_workers`` threads and no more than twice that
+        many requests are queued at any time, so ``items`` may be a very large
+        or lazy iterable.
+
+        A ``tuple`` of ``(item, result)`` is yielded for every item, in the
+        order the items were submitted when ``ordered`` is True, otherwise in
+        the order the requests complete. The result is the response or the
+        exception raised while making the request.
+
+        :param items: ``iterable``
+        :param ordered: ``bol``
+        :yield: ``tuple``
+        """
+        executor = self._get_executor()
+        window = self.batch_workers * 2
+        items = iter(items)
+        pending = collections.deque()
+        while True:
+            for item in itertools.islice(items, window - len(pending)):
+                pending.append(
+                    (item, executor.submit(self._batch_request, item))
+                )
+
+            if not pending:
+                break
+
+            if ordered:
+                item, future = pending.popleft()
+            else:
+                futures.wait(
+                    [i[1] for i in pending],
+                    return_when=futures.FIRST_COMPLETED
+                )
+                for pair in pending:
+                    if pair[1].done():
+                        pending.remove(pair)
+                        item, future = pair
+                        break
+
+            yield item, future.result()
+
+    def map(self, items):
+        """Return the results of many requests made concurrently.
+
+        Results are returned in the order the items were submitted. See
+        ``imap`` for the format of ``items``.
+
+        :param items: ``iterable``
+        :return: ``list``
+        """
+        return [i[1] for i in self.imap(items=items)]
+
+    def _get_page(self, url, headers=None, kwargs=None, items_key=None):
+        """Return a listing response and the items it holds.
+
+        JSON listings may be a list or an object holding the list under
+        ``items_key``. ``text/plain`` listings hold an item per line.
+
+        :param url: ``str``
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        :param items_key: ``str``
+        :return: ``tuple``
+        """
+        resp = self._request(
+            method='get', url=url, headers=headers, kwargs=kwargs
+        )
+        resp.raise_for_status()
+        if resp.status_code == 204 or not resp.content:
+            return resp, []
+
+        content_type = resp.headers.get('Content-Type') or ''
+        if content_type.startswith('text/plain'):
+            return resp, resp.text.splitlines()
+
+        items = self.decode_json(resp)
+        if items_key is not None:
+            items = items.get(items_key) or []
+        return resp, items
+
+    def paginate(self, url, headers=None, kwargs=None, limit=None,
+                 marker_key='name', items_key=None, prefetch=True):
+        """Yield every item of a paginated listing.
+
+        The next page is taken from a ``Link: <url>; rel="next"`` response
+        header when the server sends one, and once it has the listing ends
+        with the first page without one. Otherwise the ``marker`` query
+        parameter is set to the ``marker_key`` value of the last item, or the
+        item itself for plain items, and ``limit`` to the page size. The
+        listing ends on an empty page or a page shorter than ``limit``.
+
+        When ``prefetch`` is True the next page is fetched on a background
+        thread while the items of the current page are consumed.
+
+        :param url: ``str``
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        :param limit: ``int`` Items requested per page.
+        :param marker_key: ``str``
+        :param items_key: ``str`` Key of the item list in a JSON object.
+        :param prefetch: ``bol``
+        :yield: ``object``
+        """
+        linked = []
+
+        def next_url(page_url, resp, items):
+            links = getattr(resp, 'links', None) or {}
+            if 'next' in links:
+                linked.append(True)
+                return urlparse.urljoin(page_url, links['next']['url'])
+            elif linked or not items or (limit and len(items) < limit):
+                return None
+
+            marker = items[-1]
+            if isinstance(marker, dict):
+                marker = marker.get(marker_key)
+            if marker is None:
+                return None
+            return update_query(
+                url=page_url, params={'marker': marker, 'limit': limit}
+            )
+
+        page_url = self._get_url(url=url)
+        if limit:
+            page_url = update_query(url=page_url, params={'limit': limit})
+
+        executor = None
+        if prefetch:
+            executor = futures.ThreadPoolExecutor(max_workers=1)
+
+        future = None
+        try:
+            while page_url:
+                if future is not None:
+                    resp, items = future.result()
+                else:
+                    resp, items = self._get_page(
+                        url=page_url,
+                        headers=headers,
+                        kwargs=kwargs,
+                        items_key=items_key
+                    )
+
+                page_url = next_url(page_url, resp, items)
+                future = None
+                if page_url and executor is not None:
+                    future = executor.submit(
+                        self._get_page,
+                        url=page_url,
+                        headers=headers,
+                        kwargs=kwargs,
+                        items_key=items_key
+                    )
+
+                for item in items:
+                    yield item
+        finally:
+            if future is not None:
+                future.cancel()
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    def upload(self, url, source, method='put', headers=None, kwargs=None,
+               length=None, verify=False):
+        """Stream a request body from a file object or an iterable.
+
+        The body is wrapped in a ``StreamBody`` which keeps an md5 sum of the
+        bytes sent, available from the returned response as ``md5sum``. When
+        ``verify`` is True and the response carries an ``ETag`` which differs
+        from the sum, ``cloudlib.MD5CheckMismatch`` is raised.
+
+        :param url: ``str``
+        :param source: ``object`` File object, iterator or generator.
+        :param method: ``str``
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        :param length: ``int`` Bytes which will be read from ``source``.
+        :param verify: ``bol``
+        :return: ``object``
+        """
+        body = StreamBody(
+            source=source, chunk_size=self.chunk_size, length=length
+        )
+        resp = self._request(
+            method=method, url=url, headers=headers, body=body, kwargs=kwargs
+        )
+        resp.md5sum = body.hexdigest()
+        etag = resp.headers.get('ETag')
+        if verify and etag:
+            self._check_md5(
+                md5sum=etag.strip('"'), lmd5sum=resp.md5sum, dest=url
+            )
+        return resp
+
+    def _check_md5(self, md5sum, lmd5sum, dest):
+        """Raise ``MD5CheckMismatch`` if the two sums are not equal.
+
+        :param md5sum: ``str`` Expected sum.
+        :param lmd5sum: ``str`` Calculated sum.
+        :param dest: ``str`` || ``object``
+        """
+        msg = 'Hash comparison'
+        try:
+            if md5sum != lmd5sum:
+                msg = '%s - CheckSumm Mis-Match "%s" != "%s" for [ %s ]' % (
+                    msg, md5sum, lmd5sum, dest
+                )
+                raise cloudlib.MD5CheckMismatch(msg)
+            else:
+                msg = '%s - CheckSumm verified for [ %s ]' % (msg, dest)
+        finally:
+            self.log.debug(msg)
+
+    def _download_stream(self, url, dest, headers=None, kwargs=None):
+        """Stream a GET response body into a file in a single request.
+
+        :param url: ``str``
+        :param dest: ``str`` || ``object``
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        :return: ``str`` The md5 sum of the downloaded body.
+        """
+        _kwargs = utils.dict_update({'stream': True}, kwargs)
+        resp = self._request(
+            method='get', url=url, headers=headers, kwargs=_kwargs
+        )
+        try:
+            resp.raise_for_status()
+            md5 = hashlib.md5()
+            if hasattr(dest, 'write'):
+                for chunk in self.iter_content(resp=resp):
+                    md5.update(chunk)
+                    dest.write(chunk)
+            else:
+                with open(dest, 'wb') as f:
+                    for chunk in self.iter_content(resp=resp):
+                        md5.update(chunk)
+                        f.write(chunk)
+        finally:
+            resp.close()
+
+        return md5.hexdigest()
+
+    def _download_size(self, url, headers=None, kwargs=None):
+        """Return the size and validator of an object to fetch in ranges.
+
+        The size is ``None`` when the object is smaller than
+        ``range_threshold``, or the server does not advertise byte ranges, or
+        the body is content encoded.
+
+        :param url: ``str``
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        :return: ``tuple`` Size and validator, see ``_validator``.
+        """
+        resp = self._request(
+            method='head', url=url, headers=headers, kwargs=kwargs
+        )
+        if resp.status_code != 200:
+            return None, None
+
+        resp_headers = resp.headers
+        if resp_headers.get('Accept-Ranges', '').lower() != 'bytes':
+            return None, None
+        elif resp_headers.get('Content-Encoding'):
+            return None, None
+
+        size = utils.is_int(resp_headers.get('Content-Length', ''))
+        if not isinstance(size, int) or size < self.range_threshold:
+            return None, None
+        else:
+            return size, self._validator(headers=resp_headers)
+
+    @staticmethod
+    def _validator(headers):
+        """Return the strong ``ETag``, or else ``Last-Modified``, or None.
+
+        :param headers: ``dict``
+        :return: ``str`` || ``None``
+        """
+        etag = headers.get('ETag')
+        if etag and etag.startswith('W/'):
+            etag = None
+        return etag or headers.get('Last-Modified')
+
+    def _download_part(self, url, dest, lock, start, end, keep=False,
+                       validator=None, headers=None, kwargs=None):
+        """Fetch one byte range of an object and write it at its offset.
+
+        With a ``validator`` the range is sent with ``If-Range``, so a
+        server holding a changed object returns all of it, which fails,
+        rather than a part of the new version.
+
+        :param url: ``str``
+        :param dest: ``str`` || ``object``
+        :param lock: ``object`` Lock guarding writes to a file object.
+        :param start: ``int`` First byte of the range.
+        :param end: ``int`` Last byte of the range.
+        :param keep: ``bol`` Return the bytes fetched.
+        :param validator: ``str`` ETag or Last-Modified of the object.
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        :return: ``bytes``
+        """
+        _headers = utils.dict_update(
+            dict(headers or {}),
+            {
+                'Range': 'bytes=%d-%d' % (start, end),
+                'Accept-Encoding': 'identity'
+            }
+        )
+        if validator:
+            _headers['If-Range'] = validator
+        _kwargs = utils.dict_update({'stream': True}, kwargs)
+        resp = self._request(
+            method='get', url=url, headers=_headers, kwargs=_kwargs
+        )
+        data = []
+        offset = start
+        try:
+            if resp.status_code != 206:
+                raise requests.RequestException(
+                    'Range request for bytes %d-%d of [ %s ] returned %s'
+                    % (start, end, url, resp.status_code)
+                )
+            elif validator and validator != self._validator(
+                    headers=resp.headers):
+                raise requests.RequestException(
+                    'Object [ %s ] changed during the download' % url
+                )
+
+            if hasattr(dest, 'write'):
+                for chunk in self.iter_content(resp=resp):
+                    with lock:
+                        dest.seek(offset)
+                        dest.write(chunk)
+                    offset += len(chunk)
+                    if keep:
+                        data.append(chunk)
+            else:
+                with open(dest, 'r+b') as f:
+                    f.seek(start)
+                    for chunk in self.iter_content(resp=resp):
+                        f.write(chunk)
+                        offset += len(chunk)
+                        if keep:
+                            data.append(chunk)
+        finally:
+            resp.close()
+
+        if offset != end + 1:
+            raise requests.RequestException(
+                'Range request for bytes %d-%d of [ %s ] returned %d bytes'
+                % (start, end, url, offset - start)
+            )
+        return b''.join(data)
+
+    def _download_ranges(self, url, dest, size, keep=False, validator=None,
+                         headers=None, kwargs=None):
+        """Fetch an object as concurrent byte ranges.
+
+        A path ``dest`` is preallocated to ``size`` bytes. Parts are fetched
+        by ``range_workers`` threads and written at their offsets. When
+        ``keep`` is True the md5 sum is calculated as parts complete, in order,
+        holding no more than twice ``range_workers`` parts in memory.
+
+        :param url: ``str``
+        :param dest: ``str`` || ``object``
+        :param size: ``int``
+        :param keep: ``bol`` Calculate the md5 sum of the object.
+        :param validator: ``str`` ETag or Last-Modified every part must
+                                  match.
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        :return: ``str`` || ``None`` The md5 sum of the downloaded body.
+        """
+        if not hasattr(dest, 'write'):
+            with open(dest, 'wb') as f:
+                f.truncate(size)
+
+        lock = threading.Lock()
+        md5 = hashlib.md5()
+        ranges = iter(
+            [(i, min(i + self.range_size, size) - 1)
+             for i in range(0, size, self.range_size)]
+        )
+        window = self.range_workers * 2
+        pending = collections.deque()
+        executor = futures.ThreadPoolExecutor(max_workers=self.range_workers)
+        try:
+            while True:
+                for start, end in itertools.islice(
+                        ranges, window - len(pending)):
+                    pending.append(
+                        executor.submit(
+                            self._download_part,
+                            url=url,
+                            dest=dest,
+                            lock=lock,
+                            start=start,
+                            end=end,
+                            keep=keep,
+                            validator=validator,
+                            headers=headers,
+                            kwargs=kwargs
+                        )
+                    )
+
+                if not pending:
+                    break
+
+                md5.update(pending.popleft().result())
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+        if keep:
+            return md5.hexdigest()
+
+    @staticmethod
+    def _load_resume_state(url, dest):
+        """Return the saved progress of a download or None.
+
+        :param url: ``str``
+        :param dest: ``str``
+        :return: ``dict`` || ``None``
+        """
+        try:
+            with open('%s%s' % (dest, RESUME_SUFFIX), 'r') as f:
+                state = json.load(f)
+            size = os.path.getsize(dest)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if state.get('url') != url or state.get('offset', 0) > size:
+            return None
+        else:
+            return state
+
+    @staticmethod
+    def _save_resume_state(dest, state):
+        """Atomically write the progress of a download next to the file.
+
+        :param dest: ``str``
+        :param state: ``dict``
+        """
+        sidecar = '%s%s' % (dest, RESUME_SUFFIX)
+        with open('%s.tmp' % sidecar, 'w') as f:
+            json.dump(state, f)
+        replace_file('%s.tmp' % sidecar, sidecar)
+
+    @staticmethod
+    def _remove_resume_state(dest):
+        """Remove the saved progress of a download.
+
+        :param dest: ``str``
+        """
+        try:
+            os.remove('%s%s' % (dest, RESUME_SUFFIX))
+        except OSError:
+            pass
+
+    def _download_resumable(self, url, dest, headers=None, kwargs=None):
+        """Stream a GET response body into a file, resuming earlier progress.
+
+        Progress and the object validator, the strong ``ETag`` or else the
+        ``Last-Modified`` header, are checkpointed to a sidecar file every
+        ``resume_interval`` bytes and when the transfer fails. The next
+        attempt sends a ``Range`` request with an ``If-Range`` validator so
+        the server only returns the remainder if the object has not changed,
+        otherwise the download starts over.
+
+        :param url: ``str``
+        :param dest: ``str``
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        :return: ``str`` The md5 sum of the downloaded body.
+        """
+        state = self._load_resume_state(url=url, dest=dest)
+        # Byte offsets must count the body as sent, not as decoded.
+        _headers = utils.dict_update(
+            {'Accept-Encoding': 'identity'}, headers
+        )
+        if state and state.get('validator') and state.get('offset'):
+            _headers['Range'] = 'bytes=%d-' % state['offset']
+            _headers['If-Range'] = state['validator']
+        else:
+            state = None
+
+        _kwargs = utils.dict_update({'stream': True}, kwargs)
+        resp = self._request(
+            method='get', url=url, headers=_headers, kwargs=_kwargs
+        )
+        try:
+            if resp.status_code == 416 and state:
+                self.log.debug('Restarting download of [ %s ]', url)
+                self._remove_resume_state(dest=dest)
+                resp.close()
+                return self._download_resumable(
+                    url=url, dest=dest, headers=headers, kwargs=kwargs
+                )
+
+            resp.raise_for_status()
+            etag = resp.headers.get('ETag')
+            if etag and etag.startswith('W/'):
+                etag = None
+            last_modified = resp.headers.get('Last-Modified')
+            validator = etag or last_modified
+
+            if resp.status_code == 206 and state:
+                if validator != state['validator']:
+                    self._remove_resume_state(dest=dest)
+                    raise requests.RequestException(
+                        'Object [ %s ] changed while resuming' % url
+                    )
+                offset = state['offset']
+                self.log.debug('Resuming [ %s ] at byte %d', url, offset)
+            else:
+                offset = 0
+
+            md5 = hashlib.md5()
+            with open(dest, 'r+b' if offset else 'wb') as f:
+                if offset:
+                    f.truncate(offset)
+                    for chunk in iter(
+                            lambda: f.read(self.chunk_size), b''):
+                        md5.update(chunk)
+
+                state = {
+                    'url': url,
+                    'etag': etag,
+                    'last_modified': last_modified,
+                    'validator': validator,
+                    'offset': offset
+                }
+                try:
+                    for chunk in self.iter_content(resp=resp):
+                        md5.update(chunk)
+                        f.write(chunk)
+                        offset += len(chunk)
+                        unsaved = offset - state['offset']
+                        if validator and unsaved >= self.resume_interval:
+                            f.flush()
+                            state['offset'] = offset
+                            self._save_resume_state(dest=dest, state=state)
+                except Exception:
+                    if validator:
+                        f.flush()
+                        state['offset'] = offset
+                        self._save_resume_state(dest=dest, state=state)
+                    raise
+        finally:
+            resp.close()
+
+        self._remove_resume_state(dest=dest)
+        return md5.hexdigest()
+
+    def download(self, url, dest, md5sum=None, headers=None, kwargs=None,
+                 resume=False):
+        """Stream a GET response body into a file.
+
+        The body is read ``chunk_size`` bytes at a time and written straight
+        to ``dest`` while its md5 sum is calculated, so the body is never held
+        in memory nor read back from disk. If ``md5sum`` is given and does not
+        match the body, ``cloudlib.MD5CheckMismatch`` is raised.
+
+        When ``range_threshold`` is set, objects at least that large are
+        fetched as concurrent ``Range`` requests of ``range_size`` bytes.
+        Servers which do not advertise ``Accept-Ranges: bytes`` are read in a
+        single stream. A file object ``dest`` must be seekable to be fetched
+        in ranges.
+
+        When ``resume`` is True and ``dest`` is a path the download is read
+        in a single stream which records its progress in a sidecar file,
+        ``dest`` + ``.resume``, so a failed download continues where it left
+        off the next time it is called.
+
+        :param url: ``str``
+        :param dest: ``str`` || ``object`` A file path or writable file object.
+        :param md5sum: ``str``
+        :param headers: ``dict``
+        :param kwargs: ``dict``
+        :param resume: ``bol``
+        :return: ``str`` The md5 sum of the downloaded body.
+        """
+        size = validator = None
+        if resume and not hasattr(dest, 'write'):
+            lmd5sum = self._download_resumable(
+                url=url, dest=dest, headers=headers, kwargs=kwargs
+            )
+        else:
+            if self.range_threshold is not None:
+                size, validator = self._download_size(
+                    url=url, headers=headers, kwargs=kwargs
+                )
+
+            if size is None:
+                lmd5sum = self._download_stream(
+                    url=url, dest=dest, headers=headers, kwargs=kwargs
+                )
+            else:
+                lmd5sum = self._download_ranges(
+                    url=url,
+                    dest=dest,
+                    size=size,
+                    keep=True,
+                    validator=validator,
+                    headers=headers,
+                    kwargs=kwargs
+                )
+
+        if md5sum is not None:
+            self._check_md5(md5sum=md5sum, lmd5sum=lmd5sum, dest=dest)
+        return lmd5sum
 
     def post(self, url, headers=None, body=None, kwargs=None):
         """Make a POST request.
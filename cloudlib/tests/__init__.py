@@ -118,6 +118,20 @@ class FakeHttpResponse(object):
         self.headers = {'test-headers': 'test'}
         self.response = 'response'
         self.request = 'FakeRequest'
+        self.kwargs = kwargs
+
+    def iter_content(self, chunk_size=1):
+        content = self.content
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        for i in range(0, len(content), chunk_size):
+            yield content[i:i + chunk_size]
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
 
 
 class FakeHttp(object):
@@ -0,0 +1,201 @@
+# Copyright 2015, Kevin Carter.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import mock
+import requests
+
+try:
+    import asyncio
+    from cloudlib import async_http
+except (ImportError, SyntaxError):
+    async_http = None
+
+from cloudlib import tests
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+@unittest.skipIf(
+    async_http is None or async_http.aiohttp is None,
+    'asyncio and aiohttp are required'
+)
+class TestAsyncHttpMakeRequest(unittest.TestCase):
+    def setUp(self):
+        self.url = 'http://example.com'
+
+        self.logger_patched = mock.patch(
+            'cloudlib.async_http.logger.getLogger'
+        )
+        self.logger = self.logger_patched.start()
+        self.logger.return_value = tests.Logger()
+
+        self.make_req = async_http.AsyncMakeRequest()
+        self.response = tests.FakeHttpResponse()
+        self.response.status = 200
+        self.response.url = self.url
+        self.response.read = mock.AsyncMock(return_value=b'testbody')
+
+    def tearDown(self):
+        self.logger_patched.stop()
+
+    def _session(self):
+        session = mock.MagicMock()
+        for method in ['get', 'put', 'post', 'patch', 'delete', 'head',
+                       'options']:
+            setattr(
+                session, method, mock.AsyncMock(return_value=self.response)
+            )
+        session.close = mock.AsyncMock()
+        del session.badmethod
+        return session
+
+    def test_timeout_set(self):
+        make_request = async_http.AsyncMakeRequest(config={'timeout': 120})
+        self.assertEqual(make_request.request_kwargs['timeout'], 120)
+
+    def test_get_request(self):
+        session = self._session()
+        with mock.patch.object(self.make_req, '_get_session') as get_session:
+            get_session.return_value = session
+            self.make_req._semaphore = asyncio.Semaphore(1)
+            resp = run(self.make_req.get(self.url, headers={'test': 'test'}))
+        self.assertEqual(resp.status, 200)
+        self.assertTrue(self.response.read.called)
+        kwargs = session.get.call_args[1]
+        self.assertEqual(kwargs['headers']['test'], 'test')
+        self.assertEqual(kwargs['timeout'].total, 60)
+
+    def test_request_kwargs(self):
+        session = self._session()
+        with mock.patch.object(self.make_req, '_get_session') as get_session:
+            get_session.return_value = session
+            self.make_req._semaphore = asyncio.Semaphore(1)
+            run(self.make_req.get(
+                self.url,
+                kwargs={'verify': False, 'timeout': (3, 7), 'stream': True}
+            ))
+        kwargs = session.get.call_args[1]
+        self.assertIs(kwargs['ssl'], False)
+        self.assertEqual(kwargs['timeout'].sock_connect, 3)
+        self.assertEqual(kwargs['timeout'].sock_read, 7)
+        self.assertNotIn('verify', kwargs)
+        self.assertNotIn('stream', kwargs)
+
+    def test_put_request_body(self):
+        session = self._session()
+        with mock.patch.object(self.make_req, '_get_session') as get_session:
+            get_session.return_value = session
+            self.make_req._semaphore = asyncio.Semaphore(1)
+            resp = run(self.make_req.put(self.url, body='TestBody'))
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(session.put.call_args[1]['data'], 'TestBody')
+
+    def test_option_request(self):
+        session = self._session()
+        with mock.patch.object(self.make_req, '_get_session') as get_session:
+            get_session.return_value = session
+            self.make_req._semaphore = asyncio.Semaphore(1)
+            resp = run(self.make_req.option(self.url))
+        self.assertEqual(resp.status, 200)
+
+    def test_request_failure(self):
+        session = self._session()
+        with mock.patch.object(self.make_req, '_get_session') as get_session:
+            get_session.return_value = session
+            self.assertRaises(
+                requests.RequestException,
+                run,
+                self.make_req._request('BadMethod', self.url)
+            )
+
+    def test_shared_session(self):
+        async def sessions():
+            first = self.make_req._get_session()
+            second = self.make_req._get_session()
+            await self.make_req.close()
+            return first, second
+
+        first, second = run(sessions())
+        self.assertIs(first, second)
+        self.assertIsNone(self.make_req._session)
+
+
+@unittest.skipIf(
+    async_http is None or async_http.aiohttp is None,
+    'asyncio and aiohttp are required'
+)
+class TestAsyncTransport(unittest.TestCase):
+    def setUp(self):
+        self.url = 'http://example.com'
+        self.transport = async_http.AsyncTransport()
+
+        self.response = mock.MagicMock()
+        self.response.status = 200
+        self.response.reason = 'OK'
+        self.response.url = self.url
+        self.response.headers = {'Content-Type': 'text/plain'}
+        self.response.read = mock.AsyncMock(return_value=b'testbody')
+
+        self.session = mock.MagicMock()
+        self.session.request.return_value.__aenter__.return_value = (
+            self.response
+        )
+        self.session.close = mock.AsyncMock()
+        self.transport._session = self.session
+
+    def tearDown(self):
+        self.transport.close()
+
+    def test_request(self):
+        resp = self.transport.get(self.url, headers={'test': 'test'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.text, 'testbody')
+        args, kwargs = self.session.request.call_args
+        self.assertEqual(args, ('GET', self.url))
+        self.assertEqual(kwargs['headers'], {'test': 'test'})
+
+    def test_request_body(self):
+        self.transport.put(
+            self.url, data=iter([b'test', b'body']), timeout=5, stream=True
+        )
+        kwargs = self.session.request.call_args[1]
+        self.assertEqual(kwargs['data'], b'testbody')
+        self.assertEqual(kwargs['timeout'].total, 5)
+        self.assertNotIn('stream', kwargs)
+
+    def test_request_verify(self):
+        self.transport.get(self.url, verify=False, timeout=(3, 7))
+        kwargs = self.session.request.call_args[1]
+        self.assertIs(kwargs['ssl'], False)
+        self.assertEqual(kwargs['timeout'].sock_read, 7)
+        self.assertNotIn('verify', kwargs)
+
+    def test_request_failure(self):
+        self.session.request.side_effect = async_http.aiohttp.ClientError()
+        self.assertRaises(
+            requests.ConnectionError, self.transport.get, self.url
+        )
+
+    def test_close(self):
+        self.transport.close()
+        self.assertTrue(self.session.close.called)
+        self.assertTrue(self.transport.loop.is_closed())
@@ -12,11 +12,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+import zlib
 
 import mock
 import requests
+import urllib3
 
+import cloudlib
 from cloudlib import http
 from cloudlib import tests
 
@@ -57,6 +68,1808 @@ class TestHttpMakeRequest(unittest.TestCase):
         timeout = make_request.request_kwargs['timeout']
         self.assertEqual(config['timeout'], timeout)
 
+    def test_pool_config(self):
+        config = {
+            'pool_connections': 2,
+            'pool_maxsize': 20,
+            'pool_block': True,
+            'pool_idle_timeout': 30
+        }
+        make_request = http.MakeRequest(config=config)
+        adapter = make_request.session.get_adapter(self.url)
+        self.assertIs(adapter, make_request.adapter)
+        self.assertEqual(adapter._pool_connections, 2)
+        self.assertEqual(adapter._pool_maxsize, 20)
+        self.assertTrue(adapter._pool_block)
+        self.assertEqual(adapter.idle_timeout, 30)
+
+    def test_pool_stats(self):
+        pool = self.make_req.adapter.poolmanager.connection_from_url(self.url)
+        pool.num_connections = 2
+        pool.num_requests = 5
+        stats = self.make_req.pool_stats
+        self.assertEqual(stats['opened'], 2)
+        self.assertEqual(stats['reused'], 3)
+        self.assertEqual(stats['evicted'], 0)
+        self.assertEqual(stats['pools'], 1)
+
+    def test_pool_idle_eviction(self):
+        make_request = http.MakeRequest(config={'pool_idle_timeout': 1})
+        adapter = make_request.adapter
+        pool = adapter.poolmanager.connection_from_url(self.url)
+        pool.num_connections = 1
+        pool.num_requests = 1
+        adapter._last_used[adapter._pool_key(self.url)] = 0
+        adapter._evict_idle()
+        stats = make_request.pool_stats
+        self.assertEqual(stats['pools'], 0)
+        self.assertEqual(stats['opened'], 1)
+
+    def test_map_requests(self):
+        items = [
+            ('get', self.url),
+            ('put', self.url, {'test1': 'test1'}, 'TestBody'),
+            ('BadMethod', self.url)
+        ]
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.get = self.fakehttp.get
+            mock_session.put = self.fakehttp.put
+            del mock_session.badmethod
+            results = self.make_req.map(items)
+        self.make_req.close()
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0].status_code, 200)
+        self.assertEqual(results[1].status_code, 200)
+        self.assertIsInstance(results[2], requests.RequestException)
+
+    def test_imap_unordered_requests(self):
+        items = [('get', '%s/%s' % (self.url, i)) for i in range(50)]
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.get = self.fakehttp.get
+            results = list(self.make_req.imap(items, ordered=False))
+        self.make_req.close()
+        self.assertEqual(len(results), 50)
+        self.assertEqual(
+            sorted([i[0] for i in results]), sorted(items)
+        )
+
+    def test_download_file_object(self):
+        dest = io.BytesIO()
+        md5sum = hashlib.md5(b'testbody').hexdigest()
+        self.make_req.chunk_size = 3
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.get = self.fakehttp.get
+            resp = self.make_req.download(self.url, dest, md5sum=md5sum)
+        self.assertEqual(resp, md5sum)
+        self.assertEqual(dest.getvalue(), b'testbody')
+
+    def test_download_file_path(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            dest = os.path.join(tmp_dir, 'download')
+            with mock.patch.object(self.make_req, 'session') as mock_session:
+                mock_session.get = self.fakehttp.get
+                self.make_req.download(self.url, dest)
+            with open(dest, 'rb') as f:
+                self.assertEqual(f.read(), b'testbody')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_download_stream_kwarg(self):
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.get = mock.Mock(side_effect=self.fakehttp.get)
+            self.make_req.download(self.url, io.BytesIO())
+        self.assertTrue(mock_session.get.call_args[1]['stream'])
+
+    def test_download_md5_failure(self):
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.get = self.fakehttp.get
+            self.assertRaises(
+                cloudlib.MD5CheckMismatch,
+                self.make_req.download,
+                self.url,
+                io.BytesIO(),
+                md5sum='00000000'
+            )
+
+    def _ranged_session(self, mock_session, content, accept='bytes',
+                        etag=None):
+        def head(*args, **kwargs):
+            resp = self.fakehttp.head(*args, **kwargs)
+            resp.headers = {
+                'Accept-Ranges': accept,
+                'Content-Length': str(len(content))
+            }
+            if etag:
+                resp.headers['ETag'] = etag[0]
+            return resp
+
+        def get(*args, **kwargs):
+            resp = self.fakehttp.get(*args, **kwargs)
+            byte_range = kwargs['headers'].get('Range')
+            if_range = kwargs['headers'].get('If-Range')
+            if etag:
+                resp.headers = {'ETag': etag[-1]}
+            if if_range and if_range != etag[-1]:
+                resp.content = content
+            elif byte_range:
+                start, end = byte_range.split('=')[1].split('-')
+                resp.content = content[int(start):int(end) + 1]
+                resp.status_code = 206
+            else:
+                resp.content = content
+            return resp
+
+        mock_session.head = head
+        mock_session.get = mock.Mock(side_effect=get)
+
+    def test_download_ranges_file_path(self):
+        content = os.urandom(1000)
+        self.make_req.range_threshold = 100
+        self.make_req.range_size = 64
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            dest = os.path.join(tmp_dir, 'download')
+            with mock.patch.object(self.make_req, 'session') as mock_session:
+                self._ranged_session(mock_session, content)
+                md5sum = self.make_req.download(
+                    self.url, dest, md5sum=hashlib.md5(content).hexdigest()
+                )
+            with open(dest, 'rb') as f:
+                self.assertEqual(f.read(), content)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(md5sum, hashlib.md5(content).hexdigest())
+        self.assertEqual(mock_session.get.call_count, 16)
+
+    def test_download_ranges_file_object(self):
+        content = os.urandom(1000)
+        self.make_req.range_threshold = 100
+        self.make_req.range_size = 300
+        dest = io.BytesIO()
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            self._ranged_session(mock_session, content)
+            self.make_req.download(self.url, dest)
+        self.assertEqual(dest.getvalue(), content)
+        self.assertEqual(mock_session.get.call_count, 4)
+
+    def test_download_ranges_validator(self):
+        content = os.urandom(1000)
+        self.make_req.range_threshold = 100
+        self.make_req.range_size = 300
+        dest = io.BytesIO()
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            self._ranged_session(mock_session, content, etag=['"a"'])
+            self.make_req.download(self.url, dest)
+        self.assertEqual(dest.getvalue(), content)
+        for call in mock_session.get.call_args_list:
+            self.assertEqual(call[1]['headers']['If-Range'], '"a"')
+
+    def test_download_ranges_object_changed(self):
+        content = os.urandom(1000)
+        self.make_req.range_threshold = 100
+        self.make_req.range_size = 300
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            self._ranged_session(mock_session, content, etag=['"a"', '"b"'])
+            self.assertRaises(
+                requests.RequestException,
+                self.make_req.download,
+                self.url,
+                io.BytesIO()
+            )
+
+    def test_download_ranges_not_accepted(self):
+        content = os.urandom(1000)
+        self.make_req.range_threshold = 100
+        dest = io.BytesIO()
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            self._ranged_session(mock_session, content, accept='none')
+            self.make_req.download(self.url, dest)
+        self.assertEqual(dest.getvalue(), content)
+        self.assertEqual(mock_session.get.call_count, 1)
+
+    def test_download_ranges_below_threshold(self):
+        content = os.urandom(1000)
+        self.make_req.range_threshold = 2000
+        dest = io.BytesIO()
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            self._ranged_session(mock_session, content)
+            self.make_req.download(self.url, dest)
+        self.assertEqual(dest.getvalue(), content)
+        self.assertEqual(mock_session.get.call_count, 1)
+
+    def _resumable_session(self, mock_session, content, etag, fail_at=None):
+        def get(*args, **kwargs):
+            resp = self.fakehttp.get(*args, **kwargs)
+            resp.headers = {'ETag': etag}
+            byte_range = kwargs['headers'].get('Range')
+            if_range = kwargs['headers'].get('If-Range')
+            if byte_range and if_range == etag:
+                start = int(byte_range.split('=')[1].rstrip('-'))
+                resp.content = content[start:]
+                resp.status_code = 206
+            else:
+                resp.content = content
+
+            if fail_at is not None:
+                def iter_content(chunk_size=1):
+                    yield resp.content[:fail_at]
+                    raise requests.ConnectionError('connection reset')
+                resp.iter_content = iter_content
+            return resp
+
+        mock_session.get = mock.Mock(side_effect=get)
+
+    def test_download_resume(self):
+        content = os.urandom(1000)
+        md5sum = hashlib.md5(content).hexdigest()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            dest = os.path.join(tmp_dir, 'download')
+            sidecar = dest + http.RESUME_SUFFIX
+            with mock.patch.object(self.make_req, 'session') as mock_session:
+                self._resumable_session(
+                    mock_session, content, '"etag1"', fail_at=400
+                )
+                self.assertRaises(
+                    requests.ConnectionError,
+                    self.make_req.download,
+                    self.url,
+                    dest,
+                    resume=True
+                )
+            with open(sidecar) as f:
+                self.assertEqual(json.load(f)['offset'], 400)
+
+            with mock.patch.object(self.make_req, 'session') as mock_session:
+                self._resumable_session(mock_session, content, '"etag1"')
+                resp = self.make_req.download(
+                    self.url, dest, md5sum=md5sum, resume=True
+                )
+            headers = mock_session.get.call_args[1]['headers']
+            self.assertEqual(headers['Range'], 'bytes=400-')
+            self.assertEqual(headers['If-Range'], '"etag1"')
+            self.assertEqual(resp, md5sum)
+            self.assertFalse(os.path.exists(sidecar))
+            with open(dest, 'rb') as f:
+                self.assertEqual(f.read(), content)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_download_resume_object_changed(self):
+        content = os.urandom(1000)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            dest = os.path.join(tmp_dir, 'download')
+            with mock.patch.object(self.make_req, 'session') as mock_session:
+                self._resumable_session(
+                    mock_session, content, '"etag1"', fail_at=400
+                )
+                self.assertRaises(
+                    requests.ConnectionError,
+                    self.make_req.download,
+                    self.url,
+                    dest,
+                    resume=True
+                )
+
+            content = os.urandom(1000)
+            with mock.patch.object(self.make_req, 'session') as mock_session:
+                self._resumable_session(mock_session, content, '"etag2"')
+                resp = self.make_req.download(self.url, dest, resume=True)
+            self.assertEqual(resp, hashlib.md5(content).hexdigest())
+            with open(dest, 'rb') as f:
+                self.assertEqual(f.read(), content)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def _cache_session(self, mock_session, headers, status_code=200):
+        def get(*args, **kwargs):
+            resp = self.fakehttp.get(*args, **kwargs)
+            resp.headers = headers
+            etag = kwargs['headers'].get('If-None-Match')
+            if etag and etag == headers.get('ETag'):
+                resp.status_code = status_code
+                resp.content = ''
+            return resp
+
+        mock_session.get = mock.Mock(side_effect=get)
+
+    def test_cache_fresh_response(self):
+        make_request = http.MakeRequest(config={'cache': True})
+        with mock.patch.object(make_request, 'session') as mock_session:
+            self._cache_session(mock_session, {'Cache-Control': 'max-age=60'})
+            make_request.get(self.url)
+            resp = make_request.get(self.url)
+        self.assertEqual(mock_session.get.call_count, 1)
+        self.assertEqual(resp.content, 'testbody')
+        self.assertEqual(make_request.cache.stats['hits'], 1)
+
+    def test_cache_response_copies(self):
+        make_request = http.MakeRequest(config={'cache': True})
+        with mock.patch.object(make_request, 'session') as mock_session:
+            self._cache_session(mock_session, {'Cache-Control': 'max-age=60'})
+            first = make_request.get(self.url)
+            first.headers['X-First'] = 'first'
+            second = make_request.get(self.url)
+            second.headers['X-Second'] = 'second'
+            third = make_request.get(self.url)
+        self.assertEqual(mock_session.get.call_count, 1)
+        self.assertIsNot(second, third)
+        self.assertIsNot(second.headers, third.headers)
+        self.assertNotIn('X-First', third.headers)
+        self.assertNotIn('X-Second', third.headers)
+        self.assertEqual(third.headers['cache-control'], 'max-age=60')
+
+    def test_cache_revalidate(self):
+        make_request = http.MakeRequest(config={'cache': True})
+        headers = {'Cache-Control': 'no-cache', 'ETag': '"etag1"'}
+        with mock.patch.object(make_request, 'session') as mock_session:
+            self._cache_session(mock_session, headers, status_code=304)
+            make_request.get(self.url)
+            resp = make_request.get(self.url)
+        self.assertEqual(mock_session.get.call_count, 2)
+        request_headers = mock_session.get.call_args[1]['headers']
+        self.assertEqual(request_headers['If-None-Match'], '"etag1"')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content, 'testbody')
+        self.assertEqual(make_request.cache.stats['revalidated'], 1)
+
+    def test_cache_no_store(self):
+        make_request = http.MakeRequest(config={'cache': True})
+        with mock.patch.object(make_request, 'session') as mock_session:
+            self._cache_session(
+                mock_session, {'Cache-Control': 'no-store, max-age=60'}
+            )
+            make_request.get(self.url)
+            make_request.get(self.url)
+        self.assertEqual(mock_session.get.call_count, 2)
+
+    def test_cache_vary(self):
+        make_request = http.MakeRequest(config={'cache': True})
+        with mock.patch.object(make_request, 'session') as mock_session:
+            self._cache_session(
+                mock_session, {'Cache-Control': 'max-age=60', 'Vary': 'Accept'}
+            )
+            make_request.get(self.url, headers={'Accept': 'text/plain'})
+            make_request.get(self.url, headers={'Accept': 'text/html'})
+            make_request.get(self.url, headers={'Accept': 'text/html'})
+        self.assertEqual(mock_session.get.call_count, 2)
+
+    def test_cache_lru_eviction(self):
+        cache = http.ResponseCache(max_entries=2)
+        for i in range(3):
+            resp = tests.FakeHttpResponse()
+            resp.headers = {'Cache-Control': 'max-age=60'}
+            cache.store('get', '%s/%s' % (self.url, i), {}, resp)
+        self.assertIsNone(cache.get('get', '%s/0' % self.url))
+        self.assertIsNotNone(cache.get('get', '%s/2' % self.url))
+
+    def test_cache_disk_tier(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config = {'cache': True, 'cache_dir': tmp_dir}
+            make_request = http.MakeRequest(config=config)
+            with mock.patch.object(make_request, 'session') as mock_session:
+                self._cache_session(
+                    mock_session, {'Cache-Control': 'max-age=60'}
+                )
+                make_request.get(self.url)
+
+            make_request = http.MakeRequest(config=config)
+            with mock.patch.object(make_request, 'session') as mock_session:
+                resp = make_request.get(self.url)
+            self.assertFalse(mock_session.get.called)
+            self.assertEqual(resp.content, b'testbody')
+            self.assertEqual(resp.headers['Cache-Control'], 'max-age=60')
+            self.assertEqual(
+                sorted([os.path.splitext(i)[1] for i in os.listdir(tmp_dir)]),
+                ['.body', '.json']
+            )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_cache_disk_tier_mismatch(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            cache = http.ResponseCache(cache_dir=tmp_dir)
+            resp = tests.FakeHttpResponse()
+            resp.headers = {'Cache-Control': 'max-age=60'}
+            cache.store('get', self.url, {}, resp)
+            body = [i for i in os.listdir(tmp_dir) if i.endswith('.body')]
+            with open(os.path.join(tmp_dir, body[0]), 'wb') as f:
+                f.write(b'otherbody')
+            cache = http.ResponseCache(cache_dir=tmp_dir)
+            self.assertIsNone(cache.get('get', self.url))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_cache_params(self):
+        transport = http.FakeTransport()
+        transport.add(
+            'get', '%s/l?p=1' % self.url, body=b'one',
+            headers={'Cache-Control': 'max-age=60'}
+        )
+        transport.add(
+            'get', '%s/l?p=2' % self.url, body=b'two',
+            headers={'Cache-Control': 'max-age=60'}
+        )
+        make_request = http.MakeRequest(
+            config={'transport': transport, 'cache': True}
+        )
+        url = '%s/l' % self.url
+        for _ in range(2):
+            for i, body in [(1, b'one'), (2, b'two')]:
+                resp = make_request.get(url, kwargs={'params': {'p': i}})
+                self.assertEqual(resp.content, body)
+        self.assertEqual(len(transport.calls), 2)
+
+        # Kwargs which may change the response bypass the cache.
+        make_request.get(url, kwargs={'params': {'p': 1}, 'auth': ('a', 'b')})
+        self.assertEqual(len(transport.calls), 3)
+
+    def test_cache_request_directives(self):
+        make_request = http.MakeRequest(config={'cache': True})
+        with mock.patch.object(make_request, 'session') as mock_session:
+            self._cache_session(mock_session, {'Cache-Control': 'max-age=60'})
+            make_request.get(self.url, headers={'Cache-Control': 'no-store'})
+            make_request.get(self.url)
+            self.assertEqual(mock_session.get.call_count, 2)
+            make_request.get(self.url, headers={'Cache-Control': 'no-cache'})
+            make_request.get(self.url, headers={'cache-control': 'max-age=0'})
+            self.assertEqual(mock_session.get.call_count, 4)
+            make_request.get(self.url)
+            self.assertEqual(mock_session.get.call_count, 4)
+
+    def _status_responses(self, *statuses):
+        responses = []
+        for status in statuses:
+            if isinstance(status, Exception):
+                responses.append(status)
+            else:
+                resp = self.fakehttp.get()
+                resp.status_code = status
+                responses.append(resp)
+        return responses
+
+    def test_retry_status(self):
+        make_request = http.MakeRequest(config={'retries': 2})
+        with mock.patch.object(make_request, 'session') as mock_session:
+            mock_session.get = mock.Mock(
+                side_effect=self._status_responses(503, 502, 200)
+            )
+            with mock.patch('cloudlib.http.time.sleep') as sleep:
+                resp = make_request.get(self.url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(make_request.retry_stats['retries'], 2)
+
+    def test_retry_attempts_exceeded(self):
+        make_request = http.MakeRequest(config={'retries': 1})
+        with mock.patch.object(make_request, 'session') as mock_session:
+            mock_session.get = mock.Mock(
+                side_effect=self._status_responses(503, 503, 200)
+            )
+            with mock.patch('cloudlib.http.time.sleep'):
+                resp = make_request.get(self.url)
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(mock_session.get.call_count, 2)
+
+    def test_retry_connection_error(self):
+        make_request = http.MakeRequest(config={'retries': 1})
+        with mock.patch.object(make_request, 'session') as mock_session:
+            mock_session.get = mock.Mock(
+                side_effect=self._status_responses(
+                    requests.ConnectionError('reset'), 200
+                )
+            )
+            with mock.patch('cloudlib.http.time.sleep'):
+                resp = make_request.get(self.url)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_retry_method_not_retried(self):
+        make_request = http.MakeRequest(config={'retries': 2})
+        with mock.patch.object(make_request, 'session') as mock_session:
+            mock_session.post = mock.Mock(
+                side_effect=self._status_responses(503, 200)
+            )
+            resp = make_request.post(self.url, body='TestBody')
+        self.assertEqual(resp.status_code, 503)
+
+    def test_retry_after(self):
+        resp = self.fakehttp.get()
+        resp.headers = {'Retry-After': '5'}
+        self.assertEqual(self.make_req._retry_delay(0, resp), 5)
+
+    def test_retry_budget(self):
+        make_request = http.MakeRequest(
+            config={'retries': 1, 'retry_budget': 0.1}
+        )
+        make_request._retry_tokens = 0
+        with mock.patch.object(make_request, 'session') as mock_session:
+            mock_session.get = mock.Mock(
+                side_effect=self._status_responses(503, 200)
+            )
+            resp = make_request.get(self.url)
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(make_request.retry_stats['exhausted'], 1)
+
+    def test_circuit_breaker(self):
+        make_request = http.MakeRequest(
+            config={'breaker_threshold': 2, 'breaker_timeout': 30}
+        )
+        with mock.patch.object(make_request, 'session') as mock_session:
+            mock_session.get = mock.Mock(
+                side_effect=self._status_responses(500, 500, 200, 200)
+            )
+            make_request.get(self.url)
+            make_request.get(self.url)
+            self.assertRaises(
+                http.CircuitOpen, make_request.get, self.url
+            )
+            self.assertEqual(
+                make_request.breaker.state('example.com'), 'open'
+            )
+
+            make_request.breaker._hosts['example.com']['opened'] = 0
+            self.assertEqual(
+                make_request.breaker.state('example.com'), 'half-open'
+            )
+            resp = make_request.get(self.url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(make_request.breaker.state('example.com'), 'closed')
+        self.assertEqual(make_request.breaker.stats['trips'], 1)
+        self.assertEqual(make_request.breaker.stats['rejected'], 1)
+
+    def test_circuit_breaker_trial_error(self):
+        make_request = http.MakeRequest(config={'breaker_threshold': 1})
+        with mock.patch.object(make_request, 'session') as mock_session:
+            mock_session.get = mock.Mock(
+                side_effect=[
+                    requests.ConnectionError('down'),
+                    requests.exceptions.ChunkedEncodingError('broken'),
+                    self.fakehttp.get()
+                ]
+            )
+            self.assertRaises(
+                requests.ConnectionError, make_request.get, self.url
+            )
+            make_request.breaker._hosts['example.com']['opened'] = 0
+            self.assertRaises(
+                requests.exceptions.ChunkedEncodingError,
+                make_request.get,
+                self.url
+            )
+            self.assertEqual(
+                make_request.breaker.state('example.com'), 'open'
+            )
+            make_request.breaker._hosts['example.com']['opened'] = 0
+            resp = make_request.get(self.url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(make_request.breaker.state('example.com'), 'closed')
+
+    def _fake_clock(self):
+        clock = {'now': 1000.0, 'slept': []}
+
+        def sleep(seconds):
+            clock['slept'].append(seconds)
+            clock['now'] += seconds
+
+        time_patched = mock.patch(
+            'cloudlib.http.time.time', side_effect=lambda: clock['now']
+        )
+        sleep_patched = mock.patch(
+            'cloudlib.http.time.sleep', side_effect=sleep
+        )
+        time_patched.start()
+        sleep_patched.start()
+        self.addCleanup(time_patched.stop)
+        self.addCleanup(sleep_patched.stop)
+        return clock
+
+    def test_token_bucket(self):
+        clock = self._fake_clock()
+        bucket = http.TokenBucket(rate=10, burst=2)
+        for _ in range(4):
+            bucket.acquire()
+        self.assertEqual(len(clock['slept']), 2)
+        self.assertAlmostEqual(sum(clock['slept']), 0.2)
+
+    def test_token_bucket_penalize(self):
+        clock = self._fake_clock()
+        bucket = http.TokenBucket(rate=10, burst=1)
+        bucket.penalize(seconds=5)
+        self.assertEqual(bucket.rate, 5)
+        bucket.acquire()
+        self.assertAlmostEqual(sum(clock['slept']), 5)
+        for _ in range(20):
+            bucket.reward()
+        self.assertEqual(bucket.rate, 10)
+
+    def test_token_bucket_tokens(self):
+        clock = self._fake_clock()
+        bucket = http.TokenBucket(rate=100)
+        bucket.acquire(tokens=50)
+        # Taking more than the burst waits for a full bucket then owes.
+        bucket.acquire(tokens=250)
+        self.assertAlmostEqual(sum(clock['slept']), 0.5)
+        bucket.acquire(tokens=10)
+        self.assertAlmostEqual(sum(clock['slept']), 2.1)
+
+    def test_bandwidth_limit_upload(self):
+        clock = self._fake_clock()
+        transport = http.FakeTransport()
+        make_request = http.MakeRequest(
+            config={'transport': transport, 'bandwidth_limit_per_host': 100}
+        )
+        make_request.chunk_size = 100
+        resp = make_request.upload(self.url, io.BytesIO(b'a' * 400))
+        self.assertEqual(transport.calls[0]['body'], b'a' * 400)
+        self.assertEqual(resp.request.body.len, 400)
+        self.assertAlmostEqual(sum(clock['slept']), 3)
+        # Bodies sent at once are not throttled.
+        make_request.put(self.url, body=b'a' * 400)
+        self.assertAlmostEqual(sum(clock['slept']), 3)
+
+    def test_bandwidth_limit_download(self):
+        clock = self._fake_clock()
+        transport = http.FakeTransport()
+        transport.add('get', self.url, body=b'a' * 400)
+        make_request = http.MakeRequest(
+            config={
+                'transport': transport,
+                'bandwidth_limit_hosts': {'example.com': 100}
+            }
+        )
+        make_request.chunk_size = 100
+        dest = io.BytesIO()
+        make_request.download(self.url, dest)
+        self.assertEqual(dest.getvalue(), b'a' * 400)
+        self.assertAlmostEqual(sum(clock['slept']), 3)
+
+    def test_rate_limit_hosts(self):
+        self._fake_clock()
+        config = {
+            'rate_limit': 100,
+            'rate_limit_hosts': {'example.com': 1}
+        }
+        make_request = http.MakeRequest(config=config)
+        with mock.patch.object(make_request, 'session') as mock_session:
+            mock_session.get = self.fakehttp.get
+            make_request.get(self.url)
+            make_request.get('http://other.example.com')
+        limiter = make_request.limiter
+        self.assertEqual(limiter.bucket('example.com').rate, 1)
+        self.assertIsNone(limiter.bucket('other.example.com'))
+        self.assertEqual(limiter.global_bucket.rate, 100)
+
+    def test_rate_limit_retry_after(self):
+        self._fake_clock()
+        make_request = http.MakeRequest(config={'rate_limit_per_host': 10})
+        with mock.patch.object(make_request, 'session') as mock_session:
+            resp = self.fakehttp.get()
+            resp.status_code = 429
+            resp.headers = {'Retry-After': '2'}
+            mock_session.get = mock.Mock(return_value=resp)
+            make_request.get(self.url)
+        bucket = make_request.limiter.bucket('example.com')
+        self.assertEqual(bucket.rate, 5)
+        self.assertEqual(bucket._blocked_until, 1002.0)
+
+    def test_single_flight(self):
+        make_request = http.MakeRequest(config={'single_flight': True})
+        release = threading.Event()
+
+        def get(*args, **kwargs):
+            release.wait(5)
+            return self.fakehttp.get(*args, **kwargs)
+
+        results = []
+        with mock.patch.object(make_request, 'session') as mock_session:
+            mock_session.get = mock.Mock(side_effect=get)
+            threads = [
+                threading.Thread(
+                    target=lambda: results.append(make_request.get(self.url))
+                )
+                for _ in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            for _ in range(500):
+                if make_request.single_flight.stats['shared'] == 4:
+                    break
+                time.sleep(0.01)
+            release.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(mock_session.get.call_count, 1)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len(set([id(i) for i in results])), 5)
+
+    def test_single_flight_params(self):
+        make_request = http.MakeRequest(config={'single_flight': True})
+        release = threading.Event()
+
+        def get(url, *args, **kwargs):
+            release.wait(5)
+            resp = self.fakehttp.get(url, *args, **kwargs)
+            resp.content = kwargs['params']['marker']
+            return resp
+
+        results = {}
+
+        def request(marker):
+            results[marker] = make_request.get(
+                self.url, kwargs={'params': {'marker': marker}}
+            ).content
+
+        with mock.patch.object(make_request, 'session') as mock_session:
+            mock_session.get = mock.Mock(side_effect=get)
+            threads = [
+                threading.Thread(target=request, args=(i,)) for i in 'abc'
+            ]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.05)
+            release.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(mock_session.get.call_count, 3)
+        self.assertEqual(results, {'a': 'a', 'b': 'b', 'c': 'c'})
+
+    def test_single_flight_error(self):
+        flight = http.SingleFlight()
+        self.assertRaises(
+            requests.RequestException,
+            flight.do,
+            key='key',
+            func=mock.Mock(side_effect=requests.RequestException('fail'))
+        )
+        self.assertEqual(flight._calls, {})
+
+    def test_update_query(self):
+        url = http.update_query(
+            'http://example.com/path?marker=a&format=json',
+            {'marker': 'b c', 'limit': None}
+        )
+        self.assertEqual(url, 'http://example.com/path?format=json&marker=b+c')
+
+    def _listing_session(self, mock_session, objects, links=False):
+        def get(url, *args, **kwargs):
+            resp = self.fakehttp.get(url, *args, **kwargs)
+            query = dict(http.urlparse.parse_qsl(http.urlparse.urlparse(
+                url).query))
+            limit = int(query.get('limit', 2))
+            start = 0
+            if 'marker' in query:
+                start = objects.index(query['marker']) + 1
+            elif 'page' in query:
+                start = int(query['page'])
+            page = objects[start:start + limit]
+            resp.content = json.dumps([{'name': i} for i in page])
+            resp.json = lambda: json.loads(resp.content)
+            resp.links = {}
+            if links and start + limit < len(objects):
+                resp.links = {
+                    'next': {'url': '/list?page=%s' % (start + limit)}
+                }
+            return resp
+
+        mock_session.get = mock.Mock(side_effect=get)
+
+    def test_paginate_marker(self):
+        objects = ['obj%s' % i for i in range(7)]
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            self._listing_session(mock_session, objects)
+            items = list(self.make_req.paginate(self.url, limit=3))
+        self.assertEqual([i['name'] for i in items], objects)
+        self.assertEqual(mock_session.get.call_count, 3)
+
+    def test_paginate_marker_no_prefetch(self):
+        objects = ['obj%s' % i for i in range(4)]
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            self._listing_session(mock_session, objects)
+            items = list(self.make_req.paginate(self.url, prefetch=False))
+        self.assertEqual([i['name'] for i in items], objects)
+        self.assertEqual(mock_session.get.call_count, 3)
+
+    def test_paginate_link_header(self):
+        objects = ['obj%s' % i for i in range(5)]
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            self._listing_session(mock_session, objects, links=True)
+            items = list(self.make_req.paginate(self.url + '/list'))
+        self.assertEqual([i['name'] for i in items], objects)
+        self.assertEqual(
+            mock_session.get.call_args[0][0], 'http://example.com/list?page=4'
+        )
+
+    def test_paginate_text_listing(self):
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            resp = self.fakehttp.get()
+            resp.headers = {'Content-Type': 'text/plain; charset=utf-8'}
+            resp.text = 'obj1\nobj2\n'
+            empty = self.fakehttp.get()
+            empty.status_code = 204
+            mock_session.get = mock.Mock(side_effect=[resp, empty])
+            items = list(self.make_req.paginate(self.url))
+        self.assertEqual(items, ['obj1', 'obj2'])
+        self.assertIn('marker=obj2', mock_session.get.call_args[0][0])
+
+    def test_stream_body_file(self):
+        body = http.StreamBody(io.BytesIO(b'testbody'), chunk_size=3)
+        prepared = requests.Request('PUT', self.url, data=body).prepare()
+        self.assertEqual(prepared.headers['Content-Length'], '8')
+        self.assertEqual(b''.join(body), b'testbody')
+        md5sum = hashlib.md5(b'testbody').hexdigest()
+        self.assertEqual(body.hexdigest(), md5sum)
+
+    def test_stream_body_text_file(self):
+        body = http.StreamBody(io.StringIO(u'testbodé'), chunk_size=3)
+        self.assertIsNone(body.len)
+        self.assertEqual(b''.join(body), u'testbodé'.encode('utf-8'))
+        transport = http.FakeTransport()
+        make_request = http.MakeRequest(
+            config={'transport': transport, 'compress': 'gzip'}
+        )
+        make_request.upload(self.url, io.StringIO(u'abc'))
+        self.assertEqual(
+            zlib.decompress(transport.calls[0]['body'], 31), b'abc'
+        )
+
+    def test_stream_body_generator(self):
+        body = http.StreamBody(i for i in ['test', b'body'])
+        prepared = requests.Request('PUT', self.url, data=body).prepare()
+        self.assertEqual(prepared.headers['Transfer-Encoding'], 'chunked')
+        self.assertEqual(b''.join(body), b'testbody')
+        self.assertEqual(body.bytes_sent, 8)
+
+    def test_stream_body_not_retried(self):
+        self.assertFalse(
+            self.make_req._replayable(http.StreamBody(io.BytesIO()))
+        )
+        self.assertTrue(self.make_req._replayable('TestBody'))
+
+    def _upload_session(self, mock_session, etag):
+        def put(*args, **kwargs):
+            resp = self.fakehttp.put(*args, **kwargs)
+            resp.headers = {'ETag': etag}
+            self.assertEqual(b''.join(kwargs['data']), b'testbody')
+            return resp
+
+        mock_session.put = mock.Mock(side_effect=put)
+
+    def test_upload(self):
+        md5sum = hashlib.md5(b'testbody').hexdigest()
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            self._upload_session(mock_session, '"%s"' % md5sum)
+            resp = self.make_req.upload(
+                self.url, io.BytesIO(b'testbody'), verify=True
+            )
+        self.assertEqual(resp.md5sum, md5sum)
+
+    def test_upload_etag_mismatch(self):
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            self._upload_session(mock_session, '00000000')
+            self.assertRaises(
+                cloudlib.MD5CheckMismatch,
+                self.make_req.upload,
+                self.url,
+                iter([b'test', b'body']),
+                verify=True
+            )
+
+    def test_histogram(self):
+        histogram = http.Histogram(buckets=[0.1, 1])
+        for value in [0.05, 0.5, 0.7, 5]:
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual(
+            snapshot['buckets'], [(0.1, 1), (1, 2), ('+Inf', 1)]
+        )
+        self.assertEqual(snapshot['count'], 4)
+        self.assertEqual(snapshot['min'], 0.05)
+        self.assertEqual(snapshot['max'], 5)
+
+    def test_metrics(self):
+        callback = mock.Mock()
+        make_request = http.MakeRequest(config={'metrics_callback': callback})
+        with mock.patch.object(make_request, 'session') as mock_session:
+            resp = self.fakehttp.put()
+            resp.request = mock.Mock(body=b'TestBody')
+            mock_session.put = mock.Mock(return_value=resp)
+            make_request.put(self.url, body=b'TestBody')
+            make_request.put(self.url, body=b'TestBody')
+        trace = callback.call_args[0][0]
+        self.assertEqual(trace['status'], 200)
+        self.assertEqual(trace['bytes_out'], 8)
+        self.assertEqual(trace['bytes_in'], 8)
+        stats = make_request.metrics.snapshot()['example.com']['PUT']
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['bytes_out'], 16)
+        self.assertEqual(stats['total']['count'], 2)
+        make_request.metrics.reset()
+        self.assertEqual(make_request.metrics.snapshot(), {})
+
+    def test_metrics_error(self):
+        make_request = http.MakeRequest(config={'metrics': True})
+        with mock.patch.object(make_request, 'session') as mock_session:
+            mock_session.get = mock.Mock(
+                side_effect=requests.ConnectionError('reset')
+            )
+            self.assertRaises(
+                requests.ConnectionError, make_request.get, self.url
+            )
+        stats = make_request.metrics.snapshot()['example.com']['GET']
+        self.assertEqual(stats['errors'], 1)
+
+    def test_create_connection_trace(self):
+        trace = http.RequestMetrics.trace('get', self.url)
+        addresses = [
+            (2, 1, 6, '', ('192.0.2.1', 80)),
+            (2, 1, 6, '', ('192.0.2.2', 80))
+        ]
+        sock = mock.Mock()
+        sock.connect.side_effect = [http.socket.error('refused'), None]
+        with mock.patch('cloudlib.http.socket.getaddrinfo') as getaddrinfo:
+            getaddrinfo.return_value = addresses
+            with mock.patch('cloudlib.http.socket.socket') as new_socket:
+                new_socket.return_value = sock
+                conn = http.create_connection(
+                    ('example.com', 80), timeout=5, trace=trace
+                )
+        self.assertIs(conn, sock)
+        self.assertEqual(sock.connect.call_count, 2)
+        sock.connect.assert_called_with(('192.0.2.2', 80))
+        sock.settimeout.assert_called_with(5)
+        self.assertTrue(trace['dns'] >= 0)
+        self.assertTrue(trace['connect'] >= 0)
+
+    def test_dns_cache(self):
+        cache = http.DNSCache(ttl=60)
+        addresses = [(2, 1, 6, '', ('192.0.2.1', 80))]
+        with mock.patch('cloudlib.http.socket.getaddrinfo') as getaddrinfo:
+            getaddrinfo.return_value = addresses
+            self.assertEqual(cache.resolve('example.com', 80), addresses)
+            self.assertEqual(cache.resolve('example.com', 80), addresses)
+        self.assertEqual(getaddrinfo.call_count, 1)
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertEqual(cache.stats['misses'], 1)
+
+    def test_dns_cache_expired(self):
+        cache = http.DNSCache(ttl=0)
+        with mock.patch('cloudlib.http.socket.getaddrinfo') as getaddrinfo:
+            getaddrinfo.return_value = []
+            cache.resolve('example.com', 80)
+            cache.resolve('example.com', 80)
+        self.assertEqual(getaddrinfo.call_count, 2)
+
+    def test_dns_cache_negative(self):
+        cache = http.DNSCache(negative_ttl=60)
+        with mock.patch('cloudlib.http.socket.getaddrinfo') as getaddrinfo:
+            getaddrinfo.side_effect = http.socket.gaierror('not found')
+            for _ in range(2):
+                self.assertRaises(
+                    http.socket.gaierror,
+                    cache.resolve,
+                    'example.invalid',
+                    80
+                )
+        self.assertEqual(getaddrinfo.call_count, 1)
+        self.assertEqual(cache.stats['negative_hits'], 1)
+
+    def test_dns_cache_negative_fresh_error(self):
+        cache = http.DNSCache(negative_ttl=60)
+        errors = []
+        with mock.patch('cloudlib.http.socket.getaddrinfo') as getaddrinfo:
+            getaddrinfo.side_effect = http.socket.gaierror(-2, 'not found')
+            for _ in range(3):
+                try:
+                    cache.resolve('example.invalid', 80)
+                except http.socket.gaierror as exp:
+                    errors.append(exp)
+        self.assertEqual(len(errors), 3)
+        self.assertIsNot(errors[1], errors[0])
+        self.assertIsNot(errors[2], errors[1])
+        self.assertEqual(errors[2].args, (-2, 'not found'))
+        self.assertEqual(errors[2].errno, -2)
+
+    def test_dns_cache_max_entries(self):
+        cache = http.DNSCache(max_entries=2)
+        with mock.patch('cloudlib.http.socket.getaddrinfo') as getaddrinfo:
+            getaddrinfo.return_value = []
+            for i in range(3):
+                cache.resolve('host%s' % i, 80)
+        self.assertEqual(len(cache._entries), 2)
+        self.assertNotIn(('host0', 80, 0, 0), cache._entries)
+
+    def test_dns_cache_shared(self):
+        cache = http.DNSCache()
+        make_request = http.MakeRequest(config={'dns_cache': cache})
+        self.assertIs(make_request.dns_cache, cache)
+        make_request = http.MakeRequest(config={'dns_cache': True})
+        self.assertIsInstance(make_request.dns_cache, http.DNSCache)
+        self.assertIsNone(self.make_req.dns_cache)
+
+    def test_create_connection_resolver(self):
+        resolver = mock.Mock(return_value=[(2, 1, 6, '', ('192.0.2.1', 80))])
+        with mock.patch('cloudlib.http.socket.socket') as new_socket:
+            http.create_connection(('example.com', 80), resolver=resolver)
+        self.assertEqual(resolver.call_args[0][:2], ('example.com', 80))
+        new_socket.return_value.connect.assert_called_with(
+            ('192.0.2.1', 80)
+        )
+
+    def test_compress_body(self):
+        body = http.compress_body(b'testbody' * 10, 'gzip')
+        self.assertEqual(zlib.decompress(body, 31), b'testbody' * 10)
+        body = http.compress_body(iter([b'test', 'body']), 'deflate')
+        self.assertEqual(zlib.decompress(b''.join(body)), b'testbody')
+
+    def test_compress_unavailable(self):
+        with mock.patch('cloudlib.http.brotli', None):
+            self.assertRaises(ValueError, http.Compressor, 'br')
+            make_request = http.MakeRequest(config={'compress': 'br'})
+        self.assertEqual(make_request.compress, 'gzip')
+
+    def test_compress_request(self):
+        make_request = http.MakeRequest(
+            config={'compress': 'gzip', 'compress_min_size': 16}
+        )
+        with mock.patch.object(make_request, 'session') as mock_session:
+            mock_session.post = mock.Mock(return_value=self.fakehttp.post())
+            make_request.post(self.url, body=b'testbody' * 4)
+            make_request.post(self.url, body=b'small')
+            make_request.post(self.url, body={'test': 'body'})
+        calls = mock_session.post.call_args_list
+        self.assertEqual(calls[0][1]['headers']['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            zlib.decompress(calls[0][1]['data'], 31), b'testbody' * 4
+        )
+        self.assertEqual(calls[1][1]['data'], b'small')
+        self.assertNotIn('Content-Encoding', calls[1][1]['headers'])
+        self.assertEqual(calls[2][1]['data'], {'test': 'body'})
+
+    def test_compress_request_stream(self):
+        make_request = http.MakeRequest(config={'compress': 'deflate'})
+        with mock.patch.object(make_request, 'session') as mock_session:
+            mock_session.put = mock.Mock(return_value=self.fakehttp.put())
+            make_request.put(self.url, body=iter([b'test', b'body']))
+            make_request.put(self.url, body=io.BytesIO(b'testbody'))
+        calls = mock_session.put.call_args_list
+        self.assertEqual(
+            zlib.decompress(b''.join(calls[0][1]['data'])), b'testbody'
+        )
+        # A file smaller than compress_min_size is sent as it is.
+        self.assertNotIn('Content-Encoding', calls[1][1]['headers'])
+
+    def test_compress_request_encoded(self):
+        make_request = http.MakeRequest(
+            config={'compress': 'gzip', 'compress_min_size': 0}
+        )
+        with mock.patch.object(make_request, 'session') as mock_session:
+            mock_session.post = mock.Mock(return_value=self.fakehttp.post())
+            make_request.post(
+                self.url,
+                headers={'content-encoding': 'identity'},
+                body=b'testbody'
+            )
+        self.assertEqual(
+            mock_session.post.call_args[1]['data'], b'testbody'
+        )
+
+    def test_accept_encoding(self):
+        make_request = http.MakeRequest(config={'accept_encoding': True})
+        self.assertEqual(
+            make_request.headers['Accept-Encoding'],
+            http.urllib3_util_request.ACCEPT_ENCODING
+        )
+
+    def test_endpoint_url(self):
+        endpoint = self.make_req.endpoint('http://example.com/v1/')
+        self.assertEqual(endpoint.url(), 'http://example.com/v1')
+        self.assertEqual(
+            endpoint.url('/items/1'), 'http://example.com/v1/items/1'
+        )
+        endpoint = self.make_req.endpoint(http.parse_url(self.url))
+        self.assertEqual(endpoint.url('items'), 'http://example.com/items')
+
+    def test_endpoint_request(self):
+        endpoint = self.make_req.endpoint(
+            self.url, headers={'X-Test': 'test'}, kwargs={'timeout': 5}
+        )
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.get = mock.Mock(return_value=self.fakehttp.get())
+            mock_session.put = mock.Mock(return_value=self.fakehttp.put())
+            endpoint.get('items/1')
+            endpoint.put('items/2', headers={'X-Other': 'other'}, body=b'a')
+        args, kwargs = mock_session.get.call_args
+        self.assertEqual(args[0], 'http://example.com/items/1')
+        self.assertEqual(kwargs['headers']['X-Test'], 'test')
+        self.assertEqual(kwargs['timeout'], 5)
+        self.assertIs(kwargs['headers'], endpoint.headers)
+        kwargs = mock_session.put.call_args[1]
+        self.assertEqual(kwargs['headers']['X-Other'], 'other')
+        self.assertEqual(kwargs['data'], b'a')
+        self.assertNotIn('X-Other', endpoint.headers)
+        self.assertNotIn('X-Test', self.make_req.headers)
+
+    def test_middleware(self):
+        calls = []
+
+        class Auth(http.Middleware):
+            def pre_request(self, request):
+                calls.append('auth')
+                request['headers']['X-Auth-Token'] = 'token'
+
+        class Record(http.Middleware):
+            def pre_request(self, request):
+                calls.append('pre')
+
+            def post_response(self, request, resp):
+                calls.append('post')
+                resp.recorded = True
+                return resp
+
+        transport = http.FakeTransport()
+        make_request = http.MakeRequest(
+            config={'transport': transport, 'middleware': [Auth(), Record()]}
+        )
+        self.assertEqual(len(make_request._pre_request), 2)
+        self.assertEqual(len(make_request._post_response), 1)
+        self.assertEqual(make_request._on_error, ())
+        resp = make_request.endpoint(self.url).get('items')
+        self.assertTrue(resp.recorded)
+        self.assertEqual(calls, ['auth', 'pre', 'post'])
+        self.assertEqual(
+            transport.calls[0]['headers']['X-Auth-Token'], 'token'
+        )
+        self.assertNotIn('X-Auth-Token', make_request.headers)
+
+    def test_middleware_short_circuit(self):
+        cached = self.fakehttp.get()
+        cache = mock.Mock(spec=['pre_request'])
+        cache.pre_request.return_value = cached
+        make_request = http.MakeRequest(config={'middleware': [cache]})
+        with mock.patch.object(make_request, 'session') as mock_session:
+            self.assertIs(make_request.get(self.url), cached)
+        self.assertFalse(mock_session.get.called)
+
+    def test_middleware_on_error(self):
+        fallback = self.fakehttp.get()
+
+        class Fallback(http.Middleware):
+            def on_error(self, request, exp):
+                if request['method'] == 'get':
+                    return fallback
+
+        make_request = http.MakeRequest(config={'middleware': [Fallback()]})
+        with mock.patch.object(make_request, 'session') as mock_session:
+            mock_session.get.side_effect = requests.ConnectionError('down')
+            mock_session.put.side_effect = requests.ConnectionError('down')
+            self.assertIs(make_request.get(self.url), fallback)
+            self.assertRaises(
+                requests.ConnectionError, make_request.put, self.url
+            )
+
+    def test_token_provider(self):
+        fetch = mock.Mock(side_effect=[('token1', 600), ('token2', 600)])
+        provider = http.TokenProvider(fetch=fetch, header_format='Bearer %s')
+        transport = http.FakeTransport()
+        transport.add('get', '%s/denied' % self.url, status=401)
+        make_request = http.MakeRequest(
+            config={'transport': transport, 'token_provider': provider}
+        )
+        with mock.patch('cloudlib.http.threading.Timer') as timer:
+            make_request.get(self.url)
+            make_request.get(self.url)
+            self.assertEqual(fetch.call_count, 1)
+            # The refresh is due between 60 and 30 seconds before expiry.
+            delay = timer.call_args[0][0]
+            self.assertTrue(540 <= delay <= 570, delay)
+            make_request.get('%s/denied' % self.url)
+            make_request.get(self.url)
+        make_request.close()
+        self.assertEqual(
+            [i['headers']['X-Auth-Token'] for i in transport.calls],
+            ['Bearer token1', 'Bearer token1', 'Bearer token1',
+             'Bearer token2']
+        )
+        self.assertTrue(timer.return_value.cancel.called)
+
+    def test_token_provider_background_refresh(self):
+        fetch = mock.Mock(
+            side_effect=['token1', requests.ConnectionError('down'), 'token2']
+        )
+        provider = http.TokenProvider(fetch=fetch, retry_interval=5)
+        with mock.patch('cloudlib.http.threading.Timer') as timer:
+            self.assertEqual(provider.token(), 'token1')
+            provider._background_refresh()
+            self.assertEqual(timer.call_args[0][0], 5)
+            self.assertEqual(provider.token(), 'token1')
+            provider._background_refresh()
+            self.assertEqual(provider.token(), 'token2')
+        self.assertEqual(provider.stats['failed'], 1)
+        self.assertEqual(fetch.call_count, 3)
+
+    def test_token_provider_short_ttl(self):
+        provider = http.TokenProvider(
+            fetch=mock.Mock(return_value=('token', 30)), refresh_margin=60
+        )
+        entry = provider._fetch()
+        self.assertAlmostEqual(entry['expires'] - entry['refresh'], 15)
+
+    def test_token_provider_cache_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            cache_file = os.path.join(tmp_dir, 'token')
+            fetch = mock.Mock(side_effect=['token1', 'token2'])
+            with mock.patch('cloudlib.http.threading.Timer'):
+                first = http.TokenProvider(fetch=fetch, cache_file=cache_file)
+                second = http.TokenProvider(
+                    fetch=fetch, cache_file=cache_file
+                )
+                self.assertEqual(first.token(), 'token1')
+                self.assertEqual(second.token(), 'token1')
+                self.assertEqual(second.stats['shared'], 1)
+                self.assertEqual(os.stat(cache_file).st_mode & 0o777, 0o600)
+
+                # Once due, the first refresh is shared by the other.
+                with open(cache_file) as f:
+                    entry = json.load(f)
+                entry['refresh'] = 0
+                with open(cache_file, 'w') as f:
+                    json.dump(entry, f)
+                first._background_refresh()
+                second._background_refresh()
+                self.assertEqual(second.token(), 'token2')
+            self.assertEqual(fetch.call_count, 2)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_compact_responses(self):
+        transport = http.FakeTransport()
+        transport.add(
+            'get', self.url, body=b'{"name": "caf\\u00e9"}',
+            headers={
+                'Content-Type': 'application/json',
+                'Link': '<http://example.com/?marker=2>; rel="next"',
+                'X-Other': 'other'
+            }
+        )
+        transport.add('get', '%s/missing' % self.url, status=404)
+        make_request = http.MakeRequest(
+            config={
+                'transport': transport,
+                'compact_responses': True,
+                'compact_headers': ['content-type', 'Link']
+            }
+        )
+        resp = make_request.get(self.url)
+        self.assertIsInstance(resp, http.CompactResponse)
+        self.assertFalse(hasattr(resp, '__dict__'))
+        self.assertTrue(resp.ok)
+        self.assertEqual(resp.json(), {'name': u'caf\xe9'})
+        self.assertEqual(
+            resp.links['next']['url'], 'http://example.com/?marker=2'
+        )
+        self.assertEqual(resp.headers['Content-Type'], 'application/json')
+        self.assertNotIn('X-Other', resp.headers)
+        self.assertEqual(list(resp.iter_content(chunk_size=None)),
+                         [resp.content])
+
+        resp = make_request.get('%s/missing' % self.url)
+        self.assertFalse(resp)
+        self.assertRaises(requests.HTTPError, resp.raise_for_status)
+
+        resp = make_request.get(self.url, kwargs={'stream': True})
+        self.assertIsInstance(resp, requests.Response)
+
+    def test_compact_responses_upload(self):
+        md5sum = hashlib.md5(b'data').hexdigest()
+        transport = http.FakeTransport()
+        transport.add('put', self.url, headers={'ETag': '"%s"' % md5sum})
+        make_request = http.MakeRequest(
+            config={'transport': transport, 'compact_responses': True}
+        )
+        resp = make_request.upload(self.url, io.BytesIO(b'data'), verify=True)
+        self.assertEqual(resp.md5sum, md5sum)
+        self.assertIsInstance(
+            make_request.put(self.url, body=b'data'), http.CompactResponse
+        )
+
+    def test_compact_responses_paginate(self):
+        transport = http.FakeTransport()
+        transport.add('get', '%s/?limit=2' % self.url, body=b'[1, 2]')
+        transport.add(
+            'get', '%s/?limit=2&marker=2' % self.url, body=b'[3]'
+        )
+        make_request = http.MakeRequest(
+            config={'transport': transport, 'compact_responses': True}
+        )
+        self.assertEqual(
+            list(make_request.paginate('%s/' % self.url, limit=2)), [1, 2, 3]
+        )
+
+    def test_token_provider_cache_file_rejected(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            cache_file = os.path.join(tmp_dir, 'token')
+            fetch = mock.Mock(side_effect=['tok1', 'tok2'])
+            transport = http.FakeTransport()
+            transport.add('get', '%s/denied' % self.url, status=401)
+            with mock.patch('cloudlib.http.threading.Timer'):
+                first = http.TokenProvider(fetch=fetch, cache_file=cache_file)
+                second = http.TokenProvider(
+                    fetch=fetch, cache_file=cache_file
+                )
+                make_request = http.MakeRequest(
+                    config={'transport': transport, 'token_provider': first}
+                )
+                make_request.get('%s/denied' % self.url)
+                make_request.get(self.url)
+                make_request.get(self.url)
+                self.assertEqual(second.token(), 'tok2')
+                # A token rejected elsewhere is not loaded from the file.
+                second.invalidate()
+                self.assertRaises(StopIteration, second.token)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(
+            [i['headers']['X-Auth-Token'] for i in transport.calls],
+            ['tok1', 'tok2', 'tok2']
+        )
+        self.assertEqual(first.stats['fetched'], 2)
+        self.assertEqual(second.stats['shared'], 1)
+
+    def test_token_provider_replaces_cache_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            cache_file = os.path.join(tmp_dir, 'token')
+            provider = http.TokenProvider(
+                fetch=mock.Mock(), cache_file=cache_file
+            )
+            # Windows refuses to rename over an existing file.
+            with mock.patch('cloudlib.http.os.rename',
+                            side_effect=OSError('exists')):
+                for token in ('token1', 'token2'):
+                    provider._save(
+                        {'token': token, 'expires': 1, 'refresh': 0}
+                    )
+            self.assertEqual(provider._load()['token'], 'token2')
+            self.assertEqual(os.listdir(tmp_dir), ['token'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_no_middleware(self):
+        self.assertNotIn('_dispatch', vars(self.make_req))
+
+    def _json_response(self, content, content_type='application/json'):
+        resp = self.fakehttp.get()
+        resp.content = content
+        resp.headers = {'Content-Type': content_type}
+        resp.close = mock.Mock()
+        return resp
+
+    def test_iter_json_array(self):
+        items = [1, 22, {'test': [1, 2]}, 'testé', 3.5, None, []]
+        resp = self._json_response(json.dumps(items).encode('utf-8'))
+        self.assertEqual(list(http.iter_json(resp, chunk_size=3)), items)
+        resp.close.assert_called_with()
+
+    def test_iter_json_empty_array(self):
+        resp = self._json_response(b' [ ] ')
+        self.assertEqual(list(http.iter_json(resp, chunk_size=1)), [])
+
+    def test_iter_json_large_value(self):
+        value = {'items': ['a' * 100] * 10000}
+        resp = self._json_response(json.dumps(value).encode('utf-8'))
+        raw_decode = json.JSONDecoder.raw_decode
+        with mock.patch.object(json.JSONDecoder, 'raw_decode', autospec=True,
+                               side_effect=raw_decode) as mock_decode:
+            self.assertEqual(
+                list(http.iter_json(resp, chunk_size=1024)), [value]
+            )
+        # The value spans about a thousand chunks.
+        self.assertLess(mock_decode.call_count, 20)
+
+    def test_iter_json_ndjson(self):
+        resp = self._json_response(
+            b'{"test": 1}\n{"test": 2}\n[3]\n', 'application/x-ndjson'
+        )
+        self.assertEqual(
+            list(http.iter_json(resp, chunk_size=4)),
+            [{'test': 1}, {'test': 2}, [3]]
+        )
+
+    def test_iter_json_invalid(self):
+        for content in [b'[1,]', b'[1 2]', b'[1, 2', b'{"test": ']:
+            resp = self._json_response(content)
+            self.assertRaises(
+                ValueError, list, http.iter_json(resp, chunk_size=2)
+            )
+
+    def test_fake_transport(self):
+        transport = http.FakeTransport()
+        transport.add('get', self.url, headers={'ETag': 'test'}, body='test')
+        make_request = http.MakeRequest(config={'transport': transport})
+        resp = make_request.get(self.url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content, b'test')
+        self.assertEqual(resp.headers['etag'], 'test')
+        self.assertEqual(make_request.head(self.url).status_code, 404)
+        self.assertEqual(
+            [i['method'] for i in transport.calls], ['GET', 'HEAD']
+        )
+
+    def test_fake_transport_handler(self):
+        def handler(method, url, headers, body):
+            return 201, {'Content-Type': 'application/json'}, body
+
+        transport = http.FakeTransport(handler=handler)
+        make_request = http.MakeRequest(config={'transport': transport})
+        body = http.StreamBody(iter([b'test', b'body']))
+        resp = make_request.put(self.url, body=body)
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.content, b'testbody')
+        self.assertEqual(body.bytes_sent, 8)
+        self.assertEqual(transport.calls[0]['body'], b'testbody')
+
+    def test_json_kwarg(self):
+        transport = http.FakeTransport()
+        make_request = http.MakeRequest(
+            config={'transport': transport, 'json_codec': 'json'}
+        )
+        make_request.post(self.url, kwargs={'json': {'test': 1}})
+        call = transport.calls[0]
+        self.assertEqual(json.loads(call['body']), {'test': 1})
+        self.assertEqual(call['headers']['Content-Type'], 'application/json')
+        self.assertNotIn('json', call['kwargs'])
+
+    def test_json_codec(self):
+        codec = http.JSONCodec(name='json')
+        self.assertEqual(
+            codec.loads(codec.dumps({'test': [1]})), {'test': [1]}
+        )
+        with mock.patch('cloudlib.http.orjson', None):
+            self.assertEqual(http.JSONCodec().name, 'json')
+            self.assertRaises(ValueError, http.JSONCodec, 'orjson')
+            make_request = http.MakeRequest(config={'json_codec': 'orjson'})
+        self.assertEqual(make_request.json_codec.name, 'json')
+
+    @unittest.skipIf(http.orjson is None, 'orjson is required')
+    def test_json_codec_orjson(self):
+        codec = http.JSONCodec()
+        self.assertEqual(codec.name, 'orjson')
+        self.assertEqual(codec.loads(b'{"test": [1]}'), {'test': [1]})
+        # Non-string keys are left to the standard library.
+        self.assertEqual(json.loads(codec.dumps({1: 'test'})), {'1': 'test'})
+
+    def test_urllib3_transport(self):
+        raw = urllib3.HTTPResponse(
+            body=io.BytesIO(b'testbody'),
+            headers={'Content-Type': 'text/plain'},
+            status=200,
+            preload_content=False
+        )
+        poolmanager = mock.Mock()
+        poolmanager.urlopen.return_value = raw
+        make_request = http.MakeRequest(config={'transport': 'urllib3'})
+        make_request.session.poolmanager = poolmanager
+        resp = make_request.get(self.url, kwargs={'params': {'test': 1}})
+        self.assertEqual(resp.text, 'testbody')
+        args, kwargs = poolmanager.urlopen.call_args
+        self.assertEqual(args, ('GET', 'http://example.com?test=1'))
+        self.assertFalse(kwargs['preload_content'])
+        self.assertRaises(
+            TypeError, make_request.get, self.url, kwargs={'verify': False}
+        )
+
+    def test_urllib3_transport_errors(self):
+        transport = http.Urllib3Transport(poolmanager=mock.Mock())
+        transport.poolmanager.urlopen.side_effect = (
+            http.urllib3_exceptions.MaxRetryError(
+                None,
+                self.url,
+                http.urllib3_exceptions.NewConnectionError(None, 'refused')
+            )
+        )
+        self.assertRaises(requests.ConnectionError, transport.get, self.url)
+        transport.poolmanager.urlopen.side_effect = (
+            http.urllib3_exceptions.ReadTimeoutError(None, self.url, 'slow')
+        )
+        self.assertRaises(requests.ReadTimeout, transport.get, self.url)
+
+    def test_latency_window(self):
+        window = http.LatencyWindow(size=10, min_samples=5)
+        for i in range(4):
+            window.observe('example.com', i)
+        self.assertIsNone(window.percentile('example.com', 50))
+        for i in range(4, 20):
+            window.observe('example.com', i)
+        self.assertEqual(window.percentile('example.com', 0), 10)
+        self.assertEqual(window.percentile('example.com', 100), 19)
+        self.assertIsNone(window.percentile('example.org', 50))
+
+    def _hedge_request(self, delays):
+        make_request = http.MakeRequest(
+            config={'hedge': True, 'hedge_min_samples': 1}
+        )
+        make_request.hedge.observe('example.com', 0.01)
+        delays = list(delays)
+        responses = []
+
+        def get(*args, **kwargs):
+            delay = delays.pop(0)
+            resp = self.fakehttp.get()
+            resp.close = mock.Mock()
+            responses.append(resp)
+            time.sleep(abs(delay))
+            if delay < 0:
+                raise requests.ConnectionError('failed')
+            return resp
+
+        return make_request, responses, get
+
+    def test_hedge_slow_request(self):
+        make_request, responses, get = self._hedge_request([0.5, 0])
+        with mock.patch.object(make_request, 'session') as mock_session:
+            mock_session.get = mock.Mock(side_effect=get)
+            resp = make_request.get(self.url)
+            make_request.close()
+        self.assertIs(resp, responses[1])
+        self.assertEqual(mock_session.get.call_count, 2)
+        self.assertEqual(make_request.hedge_stats, {'hedged': 1, 'wins': 1})
+        responses[0].close.assert_called_with()
+
+    def test_hedge_fast_request(self):
+        make_request, responses, get = self._hedge_request([0])
+        with mock.patch.object(make_request, 'session') as mock_session:
+            mock_session.get = mock.Mock(side_effect=get)
+            make_request.get(self.url)
+            make_request.put(self.url, body=b'test')
+        self.assertEqual(mock_session.get.call_count, 1)
+        self.assertEqual(make_request.hedge_stats['hedged'], 0)
+
+    def test_hedge_failure(self):
+        make_request, responses, get = self._hedge_request([0.2, -0.01])
+        with mock.patch.object(make_request, 'session') as mock_session:
+            mock_session.get = mock.Mock(side_effect=get)
+            resp = make_request.get(self.url)
+        self.assertIs(resp, responses[0])
+        self.assertEqual(make_request.hedge_stats, {'hedged': 1, 'wins': 0})
+
+        make_request, responses, get = self._hedge_request([-0.2, -0.01])
+        with mock.patch.object(make_request, 'session') as mock_session:
+            mock_session.get = mock.Mock(side_effect=get)
+            self.assertRaises(
+                requests.ConnectionError, make_request.get, self.url
+            )
+
+    def test_hedge_concurrent_requests(self):
+        make_request = http.MakeRequest(
+            config={'hedge': True, 'hedge_min_samples': 1, 'batch_workers': 2}
+        )
+        make_request.hedge.observe('example.com', 0.3)
+
+        def get(*args, **kwargs):
+            time.sleep(0.1)
+            return self.fakehttp.get()
+
+        with mock.patch.object(make_request, 'session') as mock_session:
+            mock_session.get = mock.Mock(side_effect=get)
+            threads = [
+                threading.Thread(target=make_request.get, args=(self.url,))
+                for _ in range(20)
+            ]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.time() - start
+            make_request.close()
+        self.assertLess(elapsed, 0.3)
+        self.assertEqual(mock_session.get.call_count, 20)
+        self.assertEqual(make_request.hedge_stats['hedged'], 0)
+
+    def test_spool_large_response(self):
+        content = os.urandom(1000)
+        transport = http.FakeTransport()
+        transport.add('get', self.url, body=content)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            make_request = http.MakeRequest(
+                config={
+                    'transport': transport,
+                    'spool_threshold': 100,
+                    'spool_dir': tmp_dir,
+                    'metrics': True
+                }
+            )
+            resp = make_request.get(self.url)
+            self.assertEqual(resp.spool.read(), content)
+            resp.spool.seek(0)
+            self.assertEqual(resp.content, content)
+            self.assertTrue(transport.calls[0]['kwargs']['stream'])
+            snapshot = make_request.metrics.snapshot()
+            self.assertEqual(snapshot['example.com']['GET']['bytes_in'], 1000)
+            resp.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_spool_small_response(self):
+        transport = http.FakeTransport()
+        transport.add('get', self.url, body=b'testbody')
+        make_request = http.MakeRequest(
+            config={'transport': transport, 'spool_threshold': 100}
+        )
+        resp = make_request.get(self.url)
+        self.assertIsNone(resp.spool)
+        self.assertEqual(resp.content, b'testbody')
+
+    def test_spool_not_cached(self):
+        transport = http.FakeTransport()
+        transport.add(
+            'get',
+            self.url,
+            headers={'Cache-Control': 'max-age=60'},
+            body=b'testbody' * 10
+        )
+        make_request = http.MakeRequest(
+            config={
+                'transport': transport,
+                'spool_threshold': 10,
+                'cache': True
+            }
+        )
+        make_request.get(self.url).close()
+        make_request.get(self.url).close()
+        self.assertEqual(len(transport.calls), 2)
+
+    def test_spool_single_flight(self):
+        content = os.urandom(1000)
+        make_request = None
+
+        def handler(method, url, headers, body):
+            for _ in range(500):
+                if make_request.single_flight.stats['shared'] == 2:
+                    break
+                time.sleep(0.01)
+            return 200, None, content
+
+        transport = http.FakeTransport(handler=handler)
+        make_request = http.MakeRequest(
+            config={
+                'transport': transport,
+                'spool_threshold': 100,
+                'single_flight': True
+            }
+        )
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(make_request.get(self.url))
+            )
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(make_request.single_flight.stats['shared'], 2)
+        self.assertEqual(len(transport.calls), 3)
+        self.assertEqual(len(set([id(i.spool) for i in results])), 3)
+        for resp in results:
+            self.assertEqual(resp.spool.read(), content)
+            resp.close()
+
+    def test_tls_session_cache(self):
+        cache = http.TLSSessionCache(max_entries=1)
+        context = mock.Mock()
+        sock = mock.Mock(context=context, session='session1')
+        cache.save('example.com', 443, sock)
+        self.assertEqual(cache.get('example.com', 443, context), 'session1')
+        # Sessions only resume with the context they were made with.
+        self.assertIsNone(cache.get('example.com', 443, mock.Mock()))
+        cache.save('example.org', 443, sock)
+        self.assertIsNone(cache.get('example.com', 443, context))
+
+    def test_tls_session_cache_context(self):
+        cache = http.TLSSessionCache()
+        conn = mock.Mock(
+            cert_reqs='CERT_REQUIRED', ssl_version=None, ca_certs=None,
+            ca_cert_dir=None, ca_cert_data=None, cert_file=None,
+            key_file=None, ssl_minimum_version=None, ssl_maximum_version=None
+        )
+        context = cache.context(conn)
+        self.assertIs(cache.context(conn), context)
+        conn.cert_reqs = 'CERT_NONE'
+        self.assertIsNot(cache.context(conn), context)
+
+    def test_resuming_context(self):
+        cache = http.TLSSessionCache()
+        context = mock.Mock()
+        context.wrap_socket.return_value = mock.Mock(session_reused=True)
+        cache.save('example.com', 443, mock.Mock(context=context, session='s'))
+        proxy = http.ResumingContext(context, cache, 'example.com', 443)
+        proxy.check_hostname = False
+        self.assertFalse(context.check_hostname)
+        proxy.wrap_socket('sock', server_hostname='example.com')
+        context.wrap_socket.assert_called_with(
+            'sock', server_hostname='example.com', session='s'
+        )
+        self.assertEqual(cache.stats, {'resumed': 1, 'full': 0})
+
+    def test_warm(self):
+        pool = urllib3.HTTPSConnectionPool('example.com', maxsize=2)
+        conns = [
+            mock.Mock(sock=None),
+            mock.Mock(sock=None),
+            mock.Mock(sock='open'),
+            mock.Mock(sock='open')
+        ]
+        conns[1].connect.side_effect = OSError('refused')
+        with mock.patch.object(self.make_req.adapter, 'connection_pool',
+                               return_value=pool):
+            with mock.patch.object(pool, '_get_conn', side_effect=conns):
+                with mock.patch.object(pool, '_put_conn') as put_conn:
+                    opened = self.make_req.warm(
+                        ['example.com', 'https://example.org'],
+                        connections=5
+                    )
+        self.make_req.close()
+        self.assertEqual(opened, 1)
+        self.assertEqual(conns[0].timeout, 60)
+        conns[1].close.assert_called_with()
+        self.assertFalse(conns[2].connect.called)
+        self.assertEqual(
+            [i[0][0] for i in put_conn.call_args_list],
+            [conns[0], conns[2], None, conns[3]]
+        )
+        self.assertEqual(self.make_req.pool_stats['warmed'], 1)
+
+    def test_warm_environment_ca_bundle(self):
+        environ = {'REQUESTS_CA_BUNDLE': '/tmp/ca.pem'}
+        with mock.patch.dict(os.environ, environ):
+            with mock.patch.object(self.make_req, '_warm_connection',
+                                   return_value=False):
+                self.make_req.warm(['example.com'])
+        keys = list(self.make_req.adapter.poolmanager.pools.keys())
+        self.make_req.close()
+        self.assertEqual(len(keys), 1)
+        self.assertEqual(keys[0].key_ca_certs, '/tmp/ca.pem')
+
+    def test_tls_session_saved(self):
+        cache = http.TLSSessionCache()
+        conn = http.TracedHTTPSConnection('example.com', 443)
+        sock = mock.Mock(context='context', session='session1')
+
+        def connect(self):
+            self.sock = sock
+
+        def getresponse(self, *args, **kwargs):
+            # Responses closing the connection take its socket.
+            self.sock = None
+            return 'resp'
+
+        http._local.tls_sessions = cache
+        try:
+            with mock.patch.object(urllib3.connection.HTTPSConnection,
+                                   'connect', connect):
+                conn.connect()
+            self.assertEqual(
+                cache.get('example.com', 443, 'context'), 'session1'
+            )
+            sock.session = 'session2'
+            with mock.patch.object(urllib3.connection.HTTPSConnection,
+                                   'getresponse', getresponse):
+                self.assertEqual(conn.getresponse(), 'resp')
+            self.assertEqual(
+                cache.get('example.com', 443, 'context'), 'session2'
+            )
+        finally:
+            http._local.tls_sessions = None
+
     def test_report_error(self):
         self.assertRaises(
             requests.RequestException,
@@ -66,146 +1879,146 @@ class TestHttpMakeRequest(unittest.TestCase):
         )
 
     def test_get_request(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.get = self.fakehttp.get
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.get = self.fakehttp.get
             resp = self.make_req.get(self.url)
         self.assertEqual(resp.status_code, 200)
 
     def test_get_request_headers(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.get = self.fakehttp.get
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.get = self.fakehttp.get
             resp = self.make_req.get(self.url, headers={'test1': 'test1'})
         self.assertEqual(resp.status_code, 200)
 
     def test_get_request_kwargs(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.get = self.fakehttp.get
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.get = self.fakehttp.get
             resp = self.make_req.get(self.url, kwargs={'timeout': 1})
         self.assertEqual(resp.status_code, 200)
 
     def test_head_request(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.head = self.fakehttp.head
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.head = self.fakehttp.head
             resp = self.make_req.head(self.url)
         self.assertEqual(resp.status_code, 200)
 
     def test_head_request_headers(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.head = self.fakehttp.head
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.head = self.fakehttp.head
             resp = self.make_req.head(self.url, headers={'test1': 'test1'})
         self.assertEqual(resp.status_code, 200)
 
     def test_head_request_kwargs(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.head = self.fakehttp.head
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.head = self.fakehttp.head
             resp = self.make_req.head(self.url, kwargs={'timeout': 1})
         self.assertEqual(resp.status_code, 200)
 
     def test_put_request(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.put = self.fakehttp.put
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.put = self.fakehttp.put
             resp = self.make_req.put(self.url)
         self.assertEqual(resp.status_code, 200)
 
     def test_put_request_headers(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.put = self.fakehttp.put
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.put = self.fakehttp.put
             resp = self.make_req.put(self.url, headers={'test1': 'test1'})
         self.assertEqual(resp.status_code, 200)
 
     def test_put_request_kwargs(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.put = self.fakehttp.put
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.put = self.fakehttp.put
             resp = self.make_req.put(self.url, kwargs={'timeout': 1})
         self.assertEqual(resp.status_code, 200)
 
     def test_put_request_body(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.put = self.fakehttp.put
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.put = self.fakehttp.put
             resp = self.make_req.put(self.url, body='TestBody')
         self.assertEqual(resp.status_code, 200)
 
     def test_delete_request(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.delete = self.fakehttp.delete
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.delete = self.fakehttp.delete
             resp = self.make_req.delete(self.url)
         self.assertEqual(resp.status_code, 200)
 
     def test_delete_request_headers(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.delete = self.fakehttp.delete
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.delete = self.fakehttp.delete
             resp = self.make_req.delete(self.url, headers={'test1': 'test1'})
         self.assertEqual(resp.status_code, 200)
 
     def test_delete_request_kwargs(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.delete = self.fakehttp.delete
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.delete = self.fakehttp.delete
             resp = self.make_req.delete(self.url, kwargs={'timeout': 1})
         self.assertEqual(resp.status_code, 200)
 
     def test_post_request(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.post = self.fakehttp.post
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.post = self.fakehttp.post
             resp = self.make_req.post(self.url)
         self.assertEqual(resp.status_code, 200)
 
     def test_post_request_headers(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.post = self.fakehttp.post
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.post = self.fakehttp.post
             resp = self.make_req.post(self.url, headers={'test1': 'test1'})
         self.assertEqual(resp.status_code, 200)
 
     def test_post_request_kwargs(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.post = self.fakehttp.post
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.post = self.fakehttp.post
             resp = self.make_req.post(self.url, kwargs={'timeout': 1})
         self.assertEqual(resp.status_code, 200)
 
     def test_post_request_body(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.post = self.fakehttp.post
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.post = self.fakehttp.post
             resp = self.make_req.post(self.url, body='TestBody')
         self.assertEqual(resp.status_code, 200)
 
     def test_patch_request(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.patch = self.fakehttp.patch
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.patch = self.fakehttp.patch
             resp = self.make_req.patch(self.url)
         self.assertEqual(resp.status_code, 200)
 
     def test_patch_request_headers(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.patch = self.fakehttp.patch
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.patch = self.fakehttp.patch
             resp = self.make_req.patch(self.url, headers={'test1': 'test1'})
         self.assertEqual(resp.status_code, 200)
 
     def test_patch_request_kwargs(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.patch = self.fakehttp.patch
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.patch = self.fakehttp.patch
             resp = self.make_req.patch(self.url, kwargs={'timeout': 1})
         self.assertEqual(resp.status_code, 200)
 
     def test_patch_request_body(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.patch = self.fakehttp.patch
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.patch = self.fakehttp.patch
             resp = self.make_req.patch(self.url, body='TestBody')
         self.assertEqual(resp.status_code, 200)
 
     def test_option_request(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.option = self.fakehttp.option
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.option = self.fakehttp.option
             resp = self.make_req.option(self.url)
         self.assertEqual(resp.status_code, 200)
 
     def test_option_request_headers(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.option = self.fakehttp.option
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.option = self.fakehttp.option
             resp = self.make_req.option(self.url, headers={'test1': 'test1'})
         self.assertEqual(resp.status_code, 200)
 
     def test_option_request_kwargs(self):
-        with mock.patch('cloudlib.http.requests') as mock_request:
-            mock_request.option = self.fakehttp.option
+        with mock.patch.object(self.make_req, 'session') as mock_session:
+            mock_session.option = self.fakehttp.option
             resp = self.make_req.option(self.url, kwargs={'timeout': 1})
         self.assertEqual(resp.status_code, 200)
 
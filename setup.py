@@ -37,6 +37,10 @@ elif sys.version_info < (2, 7, 0):
     if 'argparse' not in required:
         required.append('argparse')
 
+if sys.version_info < (3, 2, 0):
+    if 'futures' not in required:
+        required.append('futures')
+
 
 with open('README', 'rb') as r_file:
     LDINFO = r_file.read()